@@ -0,0 +1,141 @@
+import os
+import uuid
+from typing import AsyncIterator, Optional
+
+from google.adk import types
+from google.adk.events import Event, EventActions
+from pydantic import ValidationError
+
+from app.common.latency_stats import LatencyStats
+from app.common.models import RegionPayload, RoiMarkedPayload, SlideLoadedPayload
+from app.common.slide_io import get_slide_io
+from app.common.stats_registry import register_stats
+from .tools.medgemma_tools import invoke_medgemma
+from .tools.storage_tools import archive_note_to_firestore, update_recent_snapshots
+from .tools.wsi_tools import capture_snapshot_uri, generate_global_wsi_summary
+
+# Set to 0 to route every UI event through the LLM agents, e.g. to compare latencies.
+UI_FAST_PATH = os.getenv("UI_FAST_PATH", "1") == "1"
+
+# Latency of UI events per path ("fast_path" or "llm_path") and event type.
+ui_event_latency = LatencyStats()
+register_stats("ui-latency", lambda: {"fast_path_enabled": UI_FAST_PATH, "latency": ui_event_latency.snapshot()})
+
+
+class _TrackedState:
+    """Session state seen by the tools, recording every top-level assignment as a state delta."""
+
+    def __init__(self, state: dict):
+        self._state = state
+        self.delta = {}
+
+    def __contains__(self, key):
+        return key in self._state
+
+    def __getitem__(self, key):
+        return self._state[key]
+
+    def get(self, key, default=None):
+        return self._state.get(key, default)
+
+    def __setitem__(self, key, value):
+        self._state[key] = value
+        self.delta[key] = value
+
+
+class FastPathToolContext:
+    """
+    The subset of ADK's ToolContext the PathoLens tools use (session, state, artifacts), backed
+    directly by the runner's services so the tools can be called without an LLM invocation.
+    """
+
+    def __init__(self, runner, session, invocation_id: str):
+        self.app_name = runner.app_name
+        self.user_id = session.user_id
+        self.session_id = session.id
+        self.session = session
+        self.invocation_id = invocation_id
+        self.artifact_service = runner.artifact_service
+        self.state = _TrackedState(session.state)
+
+    def save_artifact(self, filename: str, artifact: types.Part) -> int:
+        return self.artifact_service.save_artifact(
+            app_name=self.app_name,
+            user_id=self.user_id,
+            session_id=self.session_id,
+            filename=filename,
+            artifact=artifact,
+        )
+
+
+class UIEventDispatcher:
+    """
+    Deterministic handling of structured UI events.
+
+    `viewport_update`, `roi_marked` and `slide_loaded` always run the same tool sequence, so they are
+    executed directly (capture -> infer -> persist) instead of being routed through several LLM calls.
+    The result is appended to the session and yielded as an ADK Event with the author the matching
+    sub-agent would have used, so clients see the same event shape as before.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    @staticmethod
+    def handles(event_type: Optional[str]) -> bool:
+        return UI_FAST_PATH and event_type in ("viewport_update", "roi_marked", "slide_loaded")
+
+    def _get_session(self, user_id: str, session_id: str):
+        session_service = self.runner.session_service
+        session = session_service.get_session(app_name=self.runner.app_name, user_id=user_id, session_id=session_id)
+        if session is None:
+            session = session_service.create_session(app_name=self.runner.app_name, user_id=user_id, session_id=session_id)
+        return session
+
+    async def dispatch(self, event_type: str, payload: dict, user_id: str, session_id: str) -> AsyncIterator[Event]:
+        """Runs the pipeline for one UI event and yields the resulting event."""
+        session = await get_slide_io().run("fetch", None, self._get_session, user_id, session_id)
+        invocation_id = f"fast-{uuid.uuid4().hex[:12]}"
+        tool_context = FastPathToolContext(self.runner, session, invocation_id)
+
+        try:
+            if event_type == "viewport_update":
+                author, text = "SnapshotManagerAgent", await self._snapshot_summary(RegionPayload(**payload), tool_context)
+            elif event_type == "roi_marked":
+                author, text = "MarkedRegionManagerAgent", await self._roi_note(RoiMarkedPayload(**payload), tool_context)
+            else:
+                author, text = "SlideManagerAgent", await self._global_summary(SlideLoadedPayload(**payload), tool_context)
+        except ValidationError as e:
+            author, text = "UITelemetryCoordinatorAgent", f"Invalid '{event_type}' payload: {e}"
+        except Exception as e:
+            author, text = "UITelemetryCoordinatorAgent", f"Error handling '{event_type}' event: {e}"
+
+        event = Event(
+            invocation_id=invocation_id,
+            author=author,
+            content=types.Content(role="model", parts=[types.Part.from_text(text)]),
+            actions=EventActions(state_delta=tool_context.state.delta),
+        )
+        await get_slide_io().run("fetch", None, self.runner.session_service.append_event, session, event)
+        yield event
+
+    async def _snapshot_summary(self, payload: RegionPayload, tool_context: FastPathToolContext) -> str:
+        uri = await capture_snapshot_uri(payload.slide_id, payload.x, payload.y, payload.width, payload.height, payload.level, tool_context)
+        summary = await invoke_medgemma(uri, "snapshot_summary", tool_context)
+        # A failed model call is reported to the client but is not a summary worth remembering.
+        if not summary.startswith("Error:"):
+            update_recent_snapshots(uri, summary, tool_context)
+        return summary
+
+    async def _roi_note(self, payload: RoiMarkedPayload, tool_context: FastPathToolContext) -> str:
+        uri = await capture_snapshot_uri(payload.slide_id, payload.x, payload.y, payload.width, payload.height, payload.level, tool_context)
+        note = await invoke_medgemma(uri, "roi_note", tool_context)
+        if note.startswith("Error:"):
+            return note
+        archived = await get_slide_io().run(
+            "fetch", payload.slide_id, archive_note_to_firestore, payload.slide_id, uri, note, payload.annotations, tool_context,
+        )
+        return f"{note}\n\n{archived}"
+
+    async def _global_summary(self, payload: SlideLoadedPayload, tool_context: FastPathToolContext) -> str:
+        return await generate_global_wsi_summary(payload.slide_id, tool_context)
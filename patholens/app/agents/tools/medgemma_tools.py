@@ -1,5 +1,14 @@
+import asyncio
+import os
+import time
+import uuid
 from google.adk.tools import FunctionTool, ToolContext
+from app.common.inference_cache import get_inference_cache, make_inference_key, prompt_version
+from app.common.medgemma_batcher import batcher_from_env
 from app.common.medgemma_client import MedGemmaClient
+from app.common.snapshot_buffer import snapshot_buffer
+from app.common.stats_registry import register_stats
+from app.common.stream_bus import stream_bus
 from app.agents.prompts import medgemma_prompts
 from typing import Literal
 
@@ -8,11 +17,13 @@ from typing import Literal
 # For now, we'll initialize it with placeholder values for structure.
 # In a later step, we'll get these values from environment variables.
 medgemma_client_instance = None # To be initialized later
+# Collects concurrent requests into multi-instance predict calls; None when batching is disabled.
+medgemma_batcher_instance = None
 
 
 def _initialize_client():
     """Lazy initializer for the client."""
-    global medgemma_client_instance
+    global medgemma_client_instance, medgemma_batcher_instance
     if medgemma_client_instance is None:
         try:
             from dotenv import load_dotenv
@@ -23,6 +34,7 @@ def _initialize_client():
                 region=os.getenv("GCP_REGION", "placeholder"),
                 endpoint_id=os.getenv("MEDGEMMA_ENDPOINT_ID", "placeholder")
             )
+            medgemma_batcher_instance = batcher_from_env(medgemma_client_instance)
         except (ValueError, ImportError) as e:
             print(f"Could not initialize MedGemmaClient: {e}")
             medgemma_client_instance = "Dummy" # Avoid re-initialization failure
@@ -36,11 +48,55 @@ PROMPT_MAPPING = {
 
 PromptKey = Literal["global_summary", "snapshot_summary", "roi_note"]
 
+# Generation parameters are part of the inference cache key, so they are fixed here rather than left to client defaults.
+MEDGEMMA_MAX_TOKENS = int(os.getenv("MEDGEMMA_MAX_TOKENS", "512"))
+MEDGEMMA_TEMPERATURE = float(os.getenv("MEDGEMMA_TEMPERATURE", "0.2"))
 
-def invoke_medgemma(image_gcs_uri: str, prompt_key: PromptKey, tool_context: ToolContext) -> str:
+# URI scheme of snapshots that only exist in the local snapshot buffer (SNAPSHOT_PERSIST_MODE=off).
+LOCAL_SNAPSHOT_SCHEME = "snapshot://"
+
+# Stream partial model output to the session's connected clients while the completion is generated.
+MEDGEMMA_STREAMING = os.getenv("MEDGEMMA_STREAMING", "1") == "1"
+
+
+def _stream_to_session(session_id: str, prompt_key: str, chunks) -> str:
+    """
+    Publishes each chunk as a partial `model_stream` message for the session and returns the full
+    text. A final message carries the consolidated text once the completion is done. If the stream
+    fails, the final message carries the error instead and an "Error: ..." string is returned, so the
+    partial text is never taken for a complete answer.
+    """
+    stream_id = uuid.uuid4().hex
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            stream_bus.publish(session_id, {"type": "model_stream", "stream_id": stream_id, "prompt_key": prompt_key, "delta": chunk, "done": False})
+    except Exception as e:
+        print(f"Error streaming from MedGemma endpoint: {e}")
+        error = f"Error: Could not get a response from the model. Details: {e}"
+        stream_bus.publish(session_id, {"type": "model_stream", "stream_id": stream_id, "prompt_key": prompt_key, "error": error, "done": True})
+        return error
+    text = "".join(parts)
+    stream_bus.publish(session_id, {"type": "model_stream", "stream_id": stream_id, "prompt_key": prompt_key, "text": text, "done": True})
+    return text
+
+
+async def invoke_medgemma(image_gcs_uri: str, prompt_key: PromptKey, tool_context: ToolContext) -> str:
     """
     Sends an image (by GCS URI) and a selected prompt to the MedGemma Vertex AI endpoint for summarization.
     """
+    # The model call blocks on the network. On a worker thread it leaves the event loop free to
+    # deliver streamed chunks to clients as they arrive, not after the completion.
+    return await asyncio.to_thread(_invoke_medgemma, image_gcs_uri, prompt_key, tool_context)
+
+
+def _invoke_medgemma(image_gcs_uri: str, prompt_key: PromptKey, tool_context: ToolContext) -> str:
+    # Snapshots captured in this process are still in memory at model resolution; send them inline.
+    image_bytes = snapshot_buffer.get(image_gcs_uri)
+    if image_bytes is None and image_gcs_uri.startswith(LOCAL_SNAPSHOT_SCHEME):
+        return f"Error: Snapshot {image_gcs_uri} is no longer available. Please capture it again."
+
     client = _initialize_client()
     if not isinstance(client, MedGemmaClient):
         return "Error: MedGemma client is not available or failed to initialize."
@@ -49,13 +105,63 @@ def invoke_medgemma(image_gcs_uri: str, prompt_key: PromptKey, tool_context: Too
         return f"Error: Invalid prompt key '{prompt_key}'. Valid keys are: {list(PROMPT_MAPPING.keys())}"
 
     system_instruction, prompt = PROMPT_MAPPING[prompt_key]
-    
-    summary = client.generate_summary(
-        image_uri=image_gcs_uri,
-        prompt=prompt,
-        system_instruction=system_instruction
-    )
+
+    # Images captured by the snapshot tools are content-addressed; reuse the answer for an identical image and prompt.
+    inference_cache = get_inference_cache()
+    image_hash = inference_cache.image_for_artifact(image_gcs_uri)
+    cache_key = None
+    if image_hash is not None:
+        cache_key = make_inference_key(
+            image_hash, prompt_key, prompt_version(system_instruction, prompt), MEDGEMMA_MAX_TOKENS, MEDGEMMA_TEMPERATURE,
+        )
+        cached_summary = inference_cache.get_response(cache_key)
+        if cached_summary is not None:
+            return cached_summary
+
+    start = time.perf_counter()
+    session = getattr(tool_context, "session", None)
+    session_id = getattr(session, "id", None)
+    if MEDGEMMA_STREAMING and session_id is not None and stream_bus.has_subscribers(session_id):
+        # A client of the session asked for partial output: stream the completion instead of batching it.
+        summary = _stream_to_session(session_id, prompt_key, client.stream_summary(
+            image_uri=image_gcs_uri,
+            prompt=prompt,
+            system_instruction=system_instruction,
+            max_tokens=MEDGEMMA_MAX_TOKENS,
+            temperature=MEDGEMMA_TEMPERATURE,
+            image_bytes=image_bytes,
+        ))
+    elif medgemma_batcher_instance is not None:
+        summary = medgemma_batcher_instance.generate_summary(
+            image_uri=image_gcs_uri,
+            prompt=prompt,
+            system_instruction=system_instruction,
+            max_tokens=MEDGEMMA_MAX_TOKENS,
+            temperature=MEDGEMMA_TEMPERATURE,
+            image_bytes=image_bytes,
+            group_key=prompt_key,
+        )
+    else:
+        summary = client.generate_summary(
+            image_uri=image_gcs_uri,
+            prompt=prompt,
+            system_instruction=system_instruction,
+            max_tokens=MEDGEMMA_MAX_TOKENS,
+            temperature=MEDGEMMA_TEMPERATURE,
+            image_bytes=image_bytes,
+        )
+    if cache_key is not None and isinstance(summary, str) and not summary.startswith("Error:"):
+        inference_cache.put_response(cache_key, summary, time.perf_counter() - start)
     return summary
 
 
 invoke_medgemma_tool = FunctionTool.from_function(invoke_medgemma)
+
+
+def _batcher_stats() -> dict:
+    if medgemma_batcher_instance is None:
+        return {"enabled": False}
+    return {"enabled": True, **medgemma_batcher_instance.stats()}
+
+
+register_stats("medgemma-batcher", _batcher_stats)
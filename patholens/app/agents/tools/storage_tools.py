@@ -1,22 +1,24 @@
 from google.adk.tools import FunctionTool, ToolContext
-from google.cloud import firestore
+from app.common.firestore_store import get_firestore_client, get_firestore_writer, new_document_id
+from app.common.slide_io import get_slide_io
+from app.common.metadata_cache import slide_metadata_cache
+from .medgemma_tools import LOCAL_SNAPSHOT_SCHEME
 from datetime import datetime, timezone
-from typing import Optional
-
-# Placeholder for Firestore client
-db_client = None
+from typing import Iterable, Optional
 
 
 def _initialize_client():
-    """Lazy initializer for the Firestore client."""
-    global db_client
-    if db_client is None:
-        try:
-            db_client = firestore.Client()
-        except Exception as e:
-            print(f"Could not initialize Firestore client: {e}")
-            db_client = "Dummy"
-    return db_client
+    """Returns the shared Firestore client, or None if it cannot be created."""
+    try:
+        return get_firestore_client()
+    except Exception as e:
+        print(f"Could not initialize Firestore client: {e}")
+        return None
+
+
+def _persistent_uri(uri: str) -> Optional[str]:
+    """The URI to store for a snapshot; None for local snapshots, which do not outlive this process."""
+    return None if uri.startswith(LOCAL_SNAPSHOT_SCHEME) else uri
 
 
 def archive_note_to_firestore(
@@ -29,41 +31,45 @@ def archive_note_to_firestore(
     """
     Saves a detailed note for a Region of Interest (ROI) to the 'pathology_notes' collection in Firestore.
     """
-    client = _initialize_client()
-    if not isinstance(client, firestore.Client):
-        return "Error: Firestore client is not available."
-
+    # The note is queued for a batched write-behind commit; its ID is assigned here so it can be
+    # returned without waiting for Firestore.
     try:
-        doc_ref = client.collection("pathology_notes").document()
-        doc_ref.set({
+        note_id = new_document_id()
+        get_firestore_writer().set("pathology_notes", note_id, {
             "slide_id": slide_id,
-            "roi_image_uri": roi_snapshot_gcs_uri,
+            "roi_image_uri": _persistent_uri(roi_snapshot_gcs_uri),
             "summary_text": note_summary,
             "user_annotations": user_annotations or {},
             "user_id": tool_context.session.user_id,
             "timestamp": datetime.now(timezone.utc),
         })
-        return f"Successfully archived note with ID: {doc_ref.id}"
+        return f"Successfully archived note with ID: {note_id}"
     except Exception as e:
         return f"Error archiving note to Firestore: {e}"
 
 
+# Number of snapshots kept in the session's recent-snapshot ring.
+RECENT_SNAPSHOTS_CAPACITY = 5
+
+
 def update_recent_snapshots(snapshot_gcs_uri: str, summary: str, tool_context: ToolContext) -> str:
     """
-    Adds the latest snapshot URI and its summary to a rolling list in the session state. Keeps the last 5.
+    Adds the latest snapshot URI and its summary to the session's recent snapshots. They are kept
+    in state as a ring of the last 5, `{"next": n, "slots": [...]}`: each entry overwrites slot
+    `n % 5`, so the newest is in slot `(n - 1) % 5` and empty slots are null.
     """
-    if "recent_snapshots" not in tool_context.state:
-        tool_context.state["recent_snapshots"] = []
-
-    # Prepend the new snapshot to the list
-    tool_context.state["recent_snapshots"].insert(0, {
-        "image_uri": snapshot_gcs_uri,
+    # A fixed-size ring: the newest entry overwrites the oldest slot, so the stored state never grows.
+    ring = tool_context.state.get("recent_snapshots")
+    if not isinstance(ring, dict):
+        ring = {"next": 0, "slots": [None] * RECENT_SNAPSHOTS_CAPACITY}
+    ring["slots"][ring["next"] % len(ring["slots"])] = {
+        "image_uri": _persistent_uri(snapshot_gcs_uri),
         "summary": summary,
         "timestamp": datetime.now(timezone.utc).isoformat(),
-    })
-
-    # Keep only the most recent 5 snapshots
-    tool_context.state["recent_snapshots"] = tool_context.state["recent_snapshots"][:5]
+    }
+    ring["next"] += 1
+    # Reassigned so the update is recorded in the event's state delta.
+    tool_context.state["recent_snapshots"] = ring
 
     return "Successfully updated the list of recent snapshots in the session."
 
@@ -71,23 +77,51 @@ def update_recent_snapshots(snapshot_gcs_uri: str, summary: str, tool_context: T
 archive_note_tool = FunctionTool.from_function(archive_note_to_firestore)
 update_recent_snapshots_tool = FunctionTool.from_function(update_recent_snapshots)
 
+def _fetch_slide_metadata(client, slide_id: str) -> Optional[dict]:
+    """Reads one slide_metadata document. Returns None if it does not exist."""
+    doc = client.collection("slide_metadata").document(slide_id).get()
+    return doc.to_dict() if doc.exists else None
+
+
 def get_slide_metadata(slide_id: str) -> dict:
     """
     Retrieves metadata for a given slide_id from the 'slide_metadata' collection in Firestore.
-    This tool does not require ToolContext.
+    Results are cached with a TTL (unknown IDs for a shorter time), and concurrent lookups of the
+    same slide share one read. This tool does not require ToolContext.
     """
     client = _initialize_client()
-    if not isinstance(client, firestore.Client):
+    if client is None:
         return {"error": "Firestore client is not available."}
     
     try:
-        doc_ref = client.collection("slide_metadata").document(slide_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict()
+        metadata = slide_metadata_cache.get_or_load(slide_id, lambda: _fetch_slide_metadata(client, slide_id))
+        if metadata is not None:
+            return dict(metadata)
         else:
             return {"error": f"No metadata found for slide_id: {slide_id}"}
     except Exception as e:
         return {"error": f"Error fetching slide metadata: {e}"}
 
+
+def prefetch_slide_metadata(slide_ids: Iterable[str]) -> int:
+    """
+    Loads metadata for several slides with a single batched Firestore read and primes the cache.
+    Slides that are already cached are skipped. Returns the number of documents fetched.
+    """
+    client = _initialize_client()
+    if client is None:
+        return 0
+
+    def load(missing):
+        refs = [client.collection("slide_metadata").document(slide_id) for slide_id in missing]
+        return {doc.id: doc.to_dict() if doc.exists else None for doc in client.get_all(refs)}
+
+    return slide_metadata_cache.load_many(slide_ids, load)
+
+
+async def get_slide_metadata_async(slide_id: str) -> dict:
+    """Runs get_slide_metadata on the slide I/O fetch pool so async callers never block on Firestore."""
+    return await get_slide_io().run("fetch", slide_id, get_slide_metadata, slide_id)
+
+
 get_slide_metadata_tool = FunctionTool.from_function(get_slide_metadata)
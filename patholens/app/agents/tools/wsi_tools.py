@@ -1,108 +1,194 @@
-import io
-import openslide
+import asyncio
+import os
+from contextlib import contextmanager
 from PIL import Image
-from google.cloud import storage
 from google.adk.tools import FunctionTool, ToolContext
 from google.adk import types
-from .storage_tools import get_slide_metadata
-
-storage_client = None
+from app.common.inference_cache import artifact_scope, get_inference_cache, hash_snapshot
+from app.common.medgemma_client import prepare_model_image
+from app.common.mosaic import build_mosaic
+from app.common.snapshot_buffer import snapshot_buffer
+from app.common.slide_cache import get_slide_cache
+from app.common.slide_io import get_slide_io
+from app.common.tiff_region_reader import get_streaming_pool
+from app.common.tile_encoding import encode_image_async, normalize_format
+from app.common.trident_outputs import load_patch_coords
+from .medgemma_tools import LOCAL_SNAPSHOT_SCHEME
+from .storage_tools import get_slide_metadata_async
+
+# Snapshots sent to the model default to high-quality JPEG, which is much smaller and faster to encode than PNG.
+SNAPSHOT_FORMAT = normalize_format(os.getenv("SNAPSHOT_FORMAT", "jpeg"))
+SNAPSHOT_QUALITY = int(os.getenv("SNAPSHOT_QUALITY", "90"))
+
+
+@contextmanager
+def open_wsi_reader(slide_gcs_uri: str):
+    """
+    Yields an OpenSlide-like reader for a WSI stored in GCS.
 
+    Slides already in the local cache are read with OpenSlide. Otherwise TIFF-family slides are
+    streamed with ranged reads so the first tile does not wait for a full download.
+    """
+    slide_cache = get_slide_cache()
+    streaming_pool = get_streaming_pool()
+    if streaming_pool is not None and not slide_cache.is_cached(slide_gcs_uri):
+        reader = streaming_pool.get_reader(slide_gcs_uri)
+        if reader is not None:
+            yield reader
+            return
 
-def _initialize_gcs_client():
-    """Lazy initializer for the GCS client."""
-    global storage_client
-    if storage_client is None:
-        try:
-            storage_client = storage.Client()
-        except Exception as e:
-            print(f"Could not initialize GCS client: {e}")
-            storage_client = "Dummy"
-    return storage_client
+    with slide_cache.open_slide(slide_gcs_uri) as slide:
+        yield slide
 
 
 def load_wsi_tile(slide_gcs_uri: str, x: int, y: int, width: int, height: int, level: int) -> Image.Image:
     """ Fetches a specific tile/region from a WSI stored in GCS. """
-    client = _initialize_gcs_client()
-    if not isinstance(client, storage.Client):
-        raise ConnectionError("GCS client is not available.")
-
-    bucket_name, blob_name = slide_gcs_uri.replace("gs://", "").split("/", 1)
-    blob = client.bucket(bucket_name).blob(blob_name)
-
-    with io.BytesIO(blob.download_as_bytes()) as slide_bytes:
-        slide = openslide.OpenSlide(slide_bytes)
+    with open_wsi_reader(slide_gcs_uri) as slide:
         tile = slide.read_region((x, y), level, (width, height))
         return tile.convert("RGB")
 
 
-def capture_snapshot(slide_id: str, x: int, y: int, width: int, height: int, level: int, tool_context: ToolContext) -> str:
+def prepare_wsi_region(slide_gcs_uri: str, x: int, y: int, width: int, height: int, level: int):
     """
-    Captures a viewport/ROI, saves it to GCS Artifact Service, and returns the URI.
+    Network stage of a region read: fetches the compressed tiles the region needs with ranged reads,
+    or downloads the slide into the local cache when it cannot be streamed.
+    """
+    slide_cache = get_slide_cache()
+    streaming_pool = get_streaming_pool()
+    if streaming_pool is not None and not slide_cache.is_cached(slide_gcs_uri):
+        reader = streaming_pool.get_reader(slide_gcs_uri)
+        if reader is not None:
+            reader.prefetch_region((x, y), level, (width, height))
+            return
+    slide_cache.ensure_local(slide_gcs_uri)
+
+
+async def load_wsi_tile_async(slide_gcs_uri: str, x: int, y: int, width: int, height: int, level: int) -> Image.Image:
     """
-    metadata = get_slide_metadata(slide_id)
+    Reads a region through the slide I/O executor: the fetch runs on the network pool and the
+    decode on the decode pool, both subject to the per-slide concurrency limit.
+    """
+    slide_io = get_slide_io()
+    await slide_io.run("fetch", slide_gcs_uri, prepare_wsi_region, slide_gcs_uri, x, y, width, height, level)
+    return await slide_io.run("decode", slide_gcs_uri, load_wsi_tile, slide_gcs_uri, x, y, width, height, level)
+
+
+# How snapshot artifacts are written: "async" (in the background, off the response path), "sync", or "off".
+SNAPSHOT_PERSIST_MODE = os.getenv("SNAPSHOT_PERSIST_MODE", "async")
+
+# Background artifact writes, referenced so they are not garbage collected before completing.
+_pending_artifact_writes = set()
+
+
+def _save_artifact(tool_context: ToolContext, filename: str, content: bytes, media_type: str):
+    part = types.Part.from_blob(content, media_type)
+    tool_context.save_artifact(filename, part)
+
+
+def _finish_artifact_write(filename: str, scope: str, image_hash: str, artifact_uri: str, future: asyncio.Future):
+    """Makes a background-written artifact available for dedup once, and only if, the write succeeded."""
+    _pending_artifact_writes.discard(future)
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        print(f"Error saving snapshot artifact {filename}: {future.exception()}")
+        return
+    get_inference_cache().record_artifact(scope, image_hash, artifact_uri)
+
+
+async def store_snapshot(tool_context: ToolContext, filename: str, image: Image.Image, slide_key: str) -> str:
+    """
+    Stores a rendered snapshot and returns the URI the agents should refer to it by.
+
+    The image is kept in memory at model resolution so invoke_medgemma can send it inline, and the
+    artifact is written according to SNAPSHOT_PERSIST_MODE. Images are content-addressed: when the
+    session stored an identical image before, its existing URI is returned and nothing is written again,
+    which also lets invoke_medgemma answer from the inference cache. Background writes only become
+    available for dedup once they have succeeded.
+    """
+    content, media_type = await encode_image_async(image, SNAPSHOT_FORMAT, SNAPSHOT_QUALITY, slide_key=slide_key)
+    inference_cache = get_inference_cache()
+    image_hash = hash_snapshot(image, content)
+    scope = artifact_scope(tool_context.session)
+    slide_io = get_slide_io()
+    artifact_uri = inference_cache.artifact_for_image(scope, image_hash)
+    if artifact_uri is not None:
+        # A local snapshot only exists in the buffer, which may have evicted it since.
+        if artifact_uri.startswith(LOCAL_SNAPSHOT_SCHEME) and not snapshot_buffer.contains(artifact_uri):
+            snapshot_buffer.put(artifact_uri, await slide_io.run("decode", slide_key, prepare_model_image, image))
+        return artifact_uri
+
+    model_image = await slide_io.run("decode", slide_key, prepare_model_image, image)
+    if SNAPSHOT_PERSIST_MODE == "off":
+        artifact_uri = f"{LOCAL_SNAPSHOT_SCHEME}{image_hash}"
+    else:
+        artifact_uri = f"gs://{tool_context.artifact_service.bucket_name}/{tool_context.artifact_service.get_artifact_path(tool_context, filename)}"
+    snapshot_buffer.put(artifact_uri, model_image)
+    # The image behind the URI is known now, so invoke_medgemma can use the response cache right away.
+    inference_cache.record_image(artifact_uri, image_hash)
+
+    if SNAPSHOT_PERSIST_MODE == "async":
+        write = asyncio.ensure_future(slide_io.run("fetch", slide_key, _save_artifact, tool_context, filename, content, media_type))
+        _pending_artifact_writes.add(write)
+        write.add_done_callback(lambda future: _finish_artifact_write(filename, scope, image_hash, artifact_uri, future))
+        return artifact_uri
+    if SNAPSHOT_PERSIST_MODE == "sync":
+        await slide_io.run("fetch", slide_key, _save_artifact, tool_context, filename, content, media_type)
+    inference_cache.record_artifact(scope, image_hash, artifact_uri)
+    return artifact_uri
+
+
+async def capture_snapshot_uri(slide_id: str, x: int, y: int, width: int, height: int, level: int, tool_context: ToolContext) -> str:
+    """Captures a viewport/ROI and returns the URI of the stored snapshot. Raises ValueError for unknown slides."""
+    metadata = await get_slide_metadata_async(slide_id)
     slide_gcs_uri = metadata.get("gcs_original_path")
     if not slide_gcs_uri:
-        return f"Error: Could not find GCS path in metadata for slide {slide_id}"
+        raise ValueError(f"Could not find GCS path in metadata for slide {slide_id}")
+
+    image = await load_wsi_tile_async(slide_gcs_uri, x, y, width, height, level)
+    filename = f"snapshot_{slide_id}_L{level}_{x}_{y}.{SNAPSHOT_FORMAT}"
+    return await store_snapshot(tool_context, filename, image, slide_gcs_uri)
 
+
+async def capture_snapshot(slide_id: str, x: int, y: int, width: int, height: int, level: int, tool_context: ToolContext) -> str:
+    """
+    Captures a viewport/ROI, saves it to GCS Artifact Service, and returns the URI.
+    """
     try:
-        image = load_wsi_tile(slide_gcs_uri, x, y, width, height, level)
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        filename = f"snapshot_{slide_id}_L{level}_{x}_{y}.png"
-        part = types.Part.from_blob(img_byte_arr.getvalue(), "image/png")
-        tool_context.save_artifact(filename, part)
-        artifact_uri = f"gs://{tool_context.artifact_service.bucket_name}/{tool_context.artifact_service.get_artifact_path(tool_context, filename)}"
+        artifact_uri = await capture_snapshot_uri(slide_id, x, y, width, height, level, tool_context)
         return f"Successfully saved snapshot to {artifact_uri}"
+    except ValueError as e:
+        return f"Error: {e}"
     except Exception as e:
         return f"Error capturing snapshot: {e}"
 
 
-def generate_global_wsi_summary(slide_id: str, tool_context: ToolContext) -> str:
+def _build_summary_composite(slide_gcs_uri: str, trident_coords=None) -> Image.Image:
+    """Builds a mosaic of tissue-rich, well-spread patches (see common.mosaic)."""
+    with get_slide_cache().open_slide(slide_gcs_uri) as slide:
+        return build_mosaic(slide, trident_coords)
+
+
+async def generate_global_wsi_summary(slide_id: str, tool_context: ToolContext) -> str:
     """
     Orchestrates generating a global summary for a WSI by creating a composite image.
     """
-    metadata = get_slide_metadata(slide_id)
+    metadata = await get_slide_metadata_async(slide_id)
     slide_gcs_uri = metadata.get("gcs_original_path")
     if not slide_gcs_uri:
         return f"Error: Could not find GCS path in metadata for slide {slide_id}"
 
     try:
-        client = _initialize_gcs_client()
-        if not isinstance(client, storage.Client):
-            raise ConnectionError("GCS client is not available.")
-
-        bucket_name, blob_name = slide_gcs_uri.replace("gs://", "").split("/", 1)
-        blob = client.bucket(bucket_name).blob(blob_name)
-
-        with io.BytesIO(blob.download_as_bytes()) as slide_bytes:
-            slide = openslide.OpenSlide(slide_bytes)
-            level = 2
-            if level >= slide.level_count:
-                level = slide.level_count - 1
-            level_dims = slide.level_dimensions[level]
-            tile_w, tile_h = 256, 256
-            coords = [
-                (0, 0), (level_dims[0] // 2, 0),
-                (0, level_dims[1] // 2), (level_dims[0] // 2, level_dims[1] // 2)
-            ]
-            tiles = [slide.read_region(coord, level, (tile_w, tile_h)).convert("RGB") for coord in coords]
-
-        composite_image = Image.new('RGB', (tile_w * 2, tile_h * 2))
-        composite_image.paste(tiles[0], (0, 0)); composite_image.paste(tiles[1], (tile_w, 0))
-        composite_image.paste(tiles[2], (0, tile_h)); composite_image.paste(tiles[3], (tile_w, tile_h))
-        
-        img_byte_arr = io.BytesIO()
-        composite_image.save(img_byte_arr, format='PNG')
-        
-        filename = f"global_summary_composite_{slide_id}.png"
-        part = types.Part.from_blob(img_byte_arr.getvalue(), "image/png")
-        tool_context.save_artifact(filename, part)
-        
-        composite_artifact_uri = f"gs://{tool_context.artifact_service.bucket_name}/{tool_context.artifact_service.get_artifact_path(tool_context, filename)}"
+        slide_io = get_slide_io()
+        await slide_io.run("fetch", slide_gcs_uri, get_slide_cache().ensure_local, slide_gcs_uri)
+        trident_coords = await slide_io.run("fetch", slide_gcs_uri, load_patch_coords, metadata.get("trident_output_path"))
+        composite_image = await slide_io.run("decode", slide_gcs_uri, _build_summary_composite, slide_gcs_uri, trident_coords)
+
+        filename = f"global_summary_composite_{slide_id}.{SNAPSHOT_FORMAT}"
+        composite_artifact_uri = await store_snapshot(tool_context, filename, composite_image, slide_gcs_uri)
 
         from .medgemma_tools import invoke_medgemma
-        return invoke_medgemma(composite_artifact_uri, "global_summary", tool_context)
+        return await invoke_medgemma(composite_artifact_uri, "global_summary", tool_context)
     except Exception as e:
         return f"Error generating global summary for slide {slide_id}: {e}"
 
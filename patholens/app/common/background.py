@@ -0,0 +1,113 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.common.mosaic import tissue_mask
+from app.common.stats_registry import register_stats
+
+BACKGROUND_DETECTION = os.getenv("BACKGROUND_DETECTION", "1") == "1"
+# A tile is background when at most this fraction of its sampled pixels look like tissue...
+BACKGROUND_MAX_TISSUE_FRACTION = float(os.getenv("BACKGROUND_MAX_TISSUE_FRACTION", "0.01"))
+# ...and its luminance barely varies (rules out faint unstained structures and edges).
+BACKGROUND_MAX_LUMA_STD = float(os.getenv("BACKGROUND_MAX_LUMA_STD", "8"))
+# Every Nth pixel on each axis is sampled; 4 keeps 1/16 of a tile.
+BACKGROUND_SAMPLE_STRIDE = int(os.getenv("BACKGROUND_SAMPLE_STRIDE", "4"))
+
+
+def is_background(image: Image.Image) -> bool:
+    """
+    Classifies a decoded RGB region as glass background, using a strided view of its pixels:
+    the same saturation/brightness tissue test as the mosaic, plus a luminance variance bound.
+    """
+    rgb = np.asarray(image)[::BACKGROUND_SAMPLE_STRIDE, ::BACKGROUND_SAMPLE_STRIDE, :3]
+    if rgb.size == 0:
+        return True
+    if tissue_mask(rgb).mean() > BACKGROUND_MAX_TISSUE_FRACTION:
+        return False
+    luma = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return float(luma.std()) <= BACKGROUND_MAX_LUMA_STD
+
+
+class BackgroundBitmap:
+    """
+    Per slide, level and tile size: one bit per grid-aligned tile, set once the tile was classified
+    as background, so later requests for it skip the read entirely.
+    """
+
+    def __init__(self, max_bitmaps: int = 512):
+        self.max_bitmaps = max_bitmaps
+        self._bitmaps: "OrderedDict[Tuple[str, int, int], Tuple[np.ndarray, int, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "classified": 0, "background": 0}
+
+    @staticmethod
+    def _cell(x: int, y: int, tile_size: int, downsample: float) -> Optional[Tuple[int, int]]:
+        """Grid position of a level-0 tile origin, or None if the tile is not aligned to the grid."""
+        step = tile_size * downsample
+        col, row = round(x / step), round(y / step)
+        if abs(col * step - x) > 1 or abs(row * step - y) > 1:
+            return None
+        return col, row
+
+    def _bit(self, key, col: int, row: int, level_dimensions: Tuple[int, int], create: bool):
+        """Returns (bitmap, bit index) or None. Caller holds the lock."""
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            if not create:
+                return None
+            cols = math.ceil(level_dimensions[0] / key[2])
+            rows = math.ceil(level_dimensions[1] / key[2])
+            bitmap = (np.zeros((rows * cols + 7) // 8, dtype=np.uint8), rows, cols)
+            self._bitmaps[key] = bitmap
+            while len(self._bitmaps) > self.max_bitmaps:
+                self._bitmaps.popitem(last=False)
+        self._bitmaps.move_to_end(key)
+        bits, rows, cols = bitmap
+        if not (0 <= col < cols and 0 <= row < rows):
+            return None
+        return bits, row * cols + col
+
+    def is_known_background(self, slide_id: str, level: int, x: int, y: int, tile_size: int, downsample: float) -> bool:
+        cell = self._cell(x, y, tile_size, downsample)
+        if cell is None:
+            return False
+        with self._lock:
+            found = self._bit((slide_id, level, tile_size), cell[0], cell[1], (0, 0), create=False)
+            if found is None:
+                return False
+            bits, index = found
+            if bits[index >> 3] & (1 << (index & 7)):
+                self._stats["hits"] += 1
+                return True
+        return False
+
+    def record(self, slide_id: str, level: int, x: int, y: int, tile_size: int, downsample: float, level_dimensions: Tuple[int, int], background: bool):
+        with self._lock:
+            self._stats["classified"] += 1
+            if not background:
+                return
+            self._stats["background"] += 1
+            cell = self._cell(x, y, tile_size, downsample)
+            if cell is None:
+                return
+            found = self._bit((slide_id, level, tile_size), cell[0], cell[1], level_dimensions, create=True)
+            if found is not None:
+                bits, index = found
+                bits[index >> 3] |= 1 << (index & 7)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "bitmaps": len(self._bitmaps),
+                "bitmap_bytes": sum(bits.nbytes for bits, _, _ in self._bitmaps.values()),
+            }
+
+
+background_bitmap = BackgroundBitmap()
+register_stats("background-tiles", background_bitmap.stats)
@@ -0,0 +1,123 @@
+import math
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from app.common.tile_encoding import encode_image
+
+DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+DEFAULT_TILE_SIZE = 256
+
+
+class DeepZoomGeometry:
+    """
+    Deep Zoom pyramid layout for a slide of a given level-0 size.
+
+    Level `level_count - 1` is full resolution and each lower level halves the size, down to 1x1.
+    With the tile size set to the slide's native tile size and no overlap, full-resolution tiles map
+    one-to-one onto native tiles, and every other tile onto a whole block of native tiles.
+    """
+
+    def __init__(self, width: int, height: int, tile_size: int = DEFAULT_TILE_SIZE, overlap: int = 0):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.level_count = int(math.ceil(math.log2(max(width, height)))) + 1
+        self.level_dimensions = tuple(
+            (int(math.ceil(width / 2 ** (self.level_count - 1 - level))), int(math.ceil(height / 2 ** (self.level_count - 1 - level))))
+            for level in range(self.level_count)
+        )
+
+    def to_dict(self) -> dict:
+        return {"width": self.width, "height": self.height, "tile_size": self.tile_size, "overlap": self.overlap}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DeepZoomGeometry":
+        return cls(int(data["width"]), int(data["height"]), int(data["tile_size"]), int(data.get("overlap", 0)))
+
+    def downsample(self, level: int) -> int:
+        return 2 ** (self.level_count - 1 - level)
+
+    def tile_count(self, level: int) -> Tuple[int, int]:
+        width, height = self.level_dimensions[level]
+        return int(math.ceil(width / self.tile_size)), int(math.ceil(height / self.tile_size))
+
+    def tile_bounds(self, level: int, col: int, row: int) -> Tuple[int, int, int, int]:
+        """Returns (x0, y0, x1, y1) of a tile in pixels of the given Deep Zoom level, overlap included."""
+        if not 0 <= level < self.level_count:
+            raise ValueError(f"Invalid Deep Zoom level {level}")
+        cols, rows = self.tile_count(level)
+        if not (0 <= col < cols and 0 <= row < rows):
+            raise ValueError(f"Invalid tile address {col}_{row} at level {level}")
+        width, height = self.level_dimensions[level]
+        x0 = col * self.tile_size - (self.overlap if col > 0 else 0)
+        y0 = row * self.tile_size - (self.overlap if row > 0 else 0)
+        x1 = min(width, (col + 1) * self.tile_size + self.overlap)
+        y1 = min(height, (row + 1) * self.tile_size + self.overlap)
+        return x0, y0, x1, y1
+
+    def descriptor(self, fmt: str) -> str:
+        """Returns the .dzi XML descriptor."""
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="{DZI_NAMESPACE}" Format="{fmt}" Overlap="{self.overlap}" TileSize="{self.tile_size}">'
+            f'<Size Width="{self.width}" Height="{self.height}"/>'
+            '</Image>'
+        )
+
+
+def native_tile_size(reader, default: int = DEFAULT_TILE_SIZE) -> int:
+    """Returns the level-0 tile width of an OpenSlide handle or TiffRegionReader."""
+    tile_sizes = getattr(reader, "tile_sizes", None)
+    if tile_sizes:
+        return int(tile_sizes[0][0])
+    properties = getattr(reader, "properties", {}) or {}
+    return int(properties.get("openslide.level[0].tile-width", default))
+
+
+def geometry_for_reader(reader, overlap: int = 0) -> DeepZoomGeometry:
+    width, height = reader.level_dimensions[0]
+    return DeepZoomGeometry(width, height, native_tile_size(reader), overlap)
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    """Flattens OpenSlide's RGBA output onto white so areas outside the scan are not black."""
+    if image.mode == "RGBA":
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        return background
+    return image.convert("RGB")
+
+
+def render_tile(reader, geometry: DeepZoomGeometry, level: int, col: int, row: int) -> Image.Image:
+    """Renders one Deep Zoom tile from the closest slide level at or above the required resolution."""
+    x0, y0, x1, y1 = geometry.tile_bounds(level, col, row)
+    dz_downsample = geometry.downsample(level)
+    slide_level = reader.get_best_level_for_downsample(dz_downsample)
+    slide_downsample = reader.level_downsamples[slide_level]
+
+    read_width = int(math.ceil((x1 - x0) * dz_downsample / slide_downsample))
+    read_height = int(math.ceil((y1 - y0) * dz_downsample / slide_downsample))
+    region = _to_rgb(reader.read_region((x0 * dz_downsample, y0 * dz_downsample), slide_level, (read_width, read_height)))
+    if region.size != (x1 - x0, y1 - y0):
+        region = region.resize((x1 - x0, y1 - y0), Image.LANCZOS)
+    return region
+
+
+def prerender_levels(reader, geometry: DeepZoomGeometry, tile_store, slide_id: str, max_dimension: int, fmt: str, quality: Optional[int] = None) -> int:
+    """
+    Renders every Deep Zoom level whose larger side is at most `max_dimension` pixels into the tile store.
+    Returns the highest level rendered, or -1 if none was.
+    """
+    max_level = -1
+    for level in range(geometry.level_count):
+        if max(geometry.level_dimensions[level]) > max_dimension:
+            break
+        cols, rows = geometry.tile_count(level)
+        for row in range(rows):
+            for col in range(cols):
+                content, _ = encode_image(render_tile(reader, geometry, level, col, row), fmt, quality)
+                tile_store.put(slide_id, level, col, row, fmt, content)
+        max_level = level
+    return max_level
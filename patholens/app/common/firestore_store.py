@@ -0,0 +1,331 @@
+import atexit
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from google.cloud import firestore
+
+from app.common.stats_registry import register_stats
+
+# Writes committed per WriteBatch (Firestore allows at most 500).
+FIRESTORE_BATCH_SIZE = min(500, int(os.getenv("FIRESTORE_BATCH_SIZE", "200")))
+# Longest a queued write waits before its batch is committed.
+FIRESTORE_FLUSH_SECONDS = float(os.getenv("FIRESTORE_FLUSH_SECONDS", "0.5"))
+# Failed commits of a write before it is set aside as `dead` (kept in the spill file, not retried).
+FIRESTORE_MAX_ATTEMPTS = int(os.getenv("FIRESTORE_MAX_ATTEMPTS", "12"))
+# How long an exiting process waits for its queued writes; anything left is replayed on the next start.
+FIRESTORE_EXIT_FLUSH_SECONDS = float(os.getenv("FIRESTORE_EXIT_FLUSH_SECONDS", "10"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS writes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    merge INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS writes_pending ON writes (status, seq);
+CREATE TABLE IF NOT EXISTS flusher (id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT NOT NULL, lease_expires_at REAL NOT NULL);
+"""
+
+_AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+
+firestore_client = None
+_firestore_client_lock = threading.Lock()
+
+
+def get_firestore_client():
+    """
+    Returns the process-wide Firestore client, creating it on first use. Set FIRESTORE_EMULATOR_HOST
+    to talk to the emulator, or install another client (e.g. an in-process fake) with set_firestore_client.
+    """
+    global firestore_client
+    with _firestore_client_lock:
+        if firestore_client is None:
+            firestore_client = firestore.Client()
+    return firestore_client
+
+
+def set_firestore_client(client):
+    """Replaces the shared client; reads and the write-behind queue use it from then on."""
+    global firestore_client
+    with _firestore_client_lock:
+        firestore_client = client
+
+
+def new_document_id() -> str:
+    """A random 20-character document ID in the same form Firestore generates."""
+    return "".join(secrets.choice(_AUTO_ID_ALPHABET) for _ in range(20))
+
+
+def _encode(value):
+    """Makes a document JSON-serializable for the spill file, tagging datetimes and SERVER_TIMESTAMP."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {"$server_timestamp": True}
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if value.keys() == {"$server_timestamp"}:
+            return firestore.SERVER_TIMESTAMP
+        if value.keys() == {"$datetime"}:
+            return datetime.fromisoformat(value["$datetime"])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class FirestoreWriteQueue:
+    """
+    Write-behind queue for Firestore document writes.
+
+    `set` appends the write to a SQLite spill file and returns at once. A background thread commits
+    queued writes in WriteBatch groups of up to `batch_size`, at least every `flush_seconds`, and
+    deletes them from the file only after the commit succeeded, so writes survive a crash and are
+    replayed on the next start (at-least-once). Processes sharing the file take turns through a
+    flusher lease, so writes are committed in the order they were queued. Failed commits are retried
+    with backoff in shrinking batches; a write that keeps failing is set aside after `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        spill_path: str,
+        client_factory: Callable[[], object] = get_firestore_client,
+        batch_size: int = FIRESTORE_BATCH_SIZE,
+        flush_seconds: float = FIRESTORE_FLUSH_SECONDS,
+        max_attempts: int = FIRESTORE_MAX_ATTEMPTS,
+        lease_seconds: float = 120,
+        max_backoff_seconds: float = 30,
+    ):
+        self.spill_path = spill_path
+        self.client_factory = client_factory
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+        self._condition = threading.Condition()
+        self._size_reached = False
+        # Writes queued by this process that are not committed yet, with their on_commit callbacks.
+        self._local: Dict[int, Optional[Callable[[], None]]] = {}
+        self._stats = {"queued": 0, "committed": 0, "batches": 0, "failed_commits": 0, "dead": 0, "last_error": None}
+        self._thread = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def _connect(self):
+        """Opens an autocommit connection for one operation; multi-statement updates use explicit transactions."""
+        conn = sqlite3.connect(self.spill_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # Queued writes must be on disk before `set` returns.
+        conn.execute("PRAGMA synchronous=FULL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def set(self, collection: str, document_id: str, data: dict, merge: bool = False, on_commit: Optional[Callable[[], None]] = None) -> int:
+        """
+        Queues `collection/document_id`.set(data, merge=merge) and returns its sequence number.
+        `on_commit` runs on the writer thread once the write is committed.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO writes (collection, document_id, data, merge, created_at) VALUES (?, ?, ?, ?, ?)",
+                (collection, document_id, json.dumps(_encode(data)), int(merge), time.time()),
+            )
+            seq = cursor.lastrowid
+        with self._condition:
+            self._local[seq] = on_commit
+            self._stats["queued"] += 1
+            if len(self._local) >= self.batch_size:
+                self._size_reached = True
+                self._condition.notify_all()
+        return seq
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every write queued by this process is committed. Returns False on timeout."""
+        with self._condition:
+            self._size_reached = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self._local, timeout=timeout)
+
+    # --- Writer thread ---
+
+    def _claim(self) -> list:
+        """Takes the oldest pending writes if this process holds (or can take) the flusher lease."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                lease = conn.execute("SELECT owner, lease_expires_at FROM flusher WHERE id = 1").fetchone()
+                if lease is not None and lease["owner"] != self.owner and lease["lease_expires_at"] > now:
+                    conn.execute("COMMIT")
+                    return []
+                rows = conn.execute("SELECT * FROM writes WHERE status = 'pending' ORDER BY seq LIMIT ?", (self.batch_size,)).fetchall()
+                # Batches shrink by half with each failed attempt of the oldest write, so a bad write
+                # ends up being retried alone instead of holding back the writes queued after it.
+                if rows:
+                    rows = rows[:max(1, self.batch_size >> rows[0]["attempts"])]
+                if rows:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO flusher (id, owner, lease_expires_at) VALUES (1, ?, ?)", (self.owner, now + self.lease_seconds)
+                    )
+                else:
+                    conn.execute("DELETE FROM flusher WHERE owner = ?", (self.owner,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _commit(self, rows: list):
+        client = self.client_factory()
+        batch = client.batch()
+        for row in rows:
+            ref = client.collection(row["collection"]).document(row["document_id"])
+            batch.set(ref, _decode(json.loads(row["data"])), merge=bool(row["merge"]))
+        batch.commit()
+
+    def _flush_once(self) -> bool:
+        """Commits one batch. Returns True if a full batch was committed, i.e. more may be waiting."""
+        rows = self._claim()
+        if not rows:
+            return False
+        seqs = [row["seq"] for row in rows]
+        placeholders = ",".join("?" * len(seqs))
+        try:
+            self._commit(rows)
+        except Exception as e:
+            with self._connect() as conn:
+                conn.execute(f"UPDATE writes SET attempts = attempts + 1, error = ? WHERE seq IN ({placeholders})", [str(e), *seqs])
+                dead = conn.execute(
+                    f"UPDATE writes SET status = 'dead' WHERE seq IN ({placeholders}) AND attempts >= ?", [*seqs, self.max_attempts]
+                ).rowcount
+            with self._condition:
+                self._stats["failed_commits"] += 1
+                self._stats["dead"] += dead
+                self._stats["last_error"] = str(e)
+            if dead:
+                print(f"Gave up on {dead} Firestore write(s) after {self.max_attempts} attempts: {e}")
+            raise
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM writes WHERE seq IN ({placeholders})", seqs)
+        with self._condition:
+            self._stats["committed"] += len(rows)
+            self._stats["batches"] += 1
+        return len(rows) == self.batch_size
+
+    def _settle_local(self):
+        """Runs callbacks of this process's writes that were committed (by any process) and wakes flush()."""
+        with self._condition:
+            seqs = list(self._local)
+        if not seqs:
+            return
+        with self._connect() as conn:
+            remaining = dict(
+                conn.execute("SELECT seq, status FROM writes WHERE seq BETWEEN ? AND ?", (min(seqs), max(seqs))).fetchall()
+            )
+        callbacks = []
+        with self._condition:
+            for seq in seqs:
+                status = remaining.get(seq)
+                if status == "pending":
+                    continue
+                callback = self._local.pop(seq, None)
+                # Dead writes stop being waited for, but their callbacks do not run.
+                if status is None:
+                    callbacks.append(callback)
+            self._condition.notify_all()
+        for callback in callbacks:
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception as e:
+                print(f"Firestore write callback failed: {e}")
+
+    def _run(self):
+        failures = 0
+        while True:
+            delay = self.flush_seconds if failures == 0 else min(self.max_backoff_seconds, self.flush_seconds * 2 ** failures)
+            with self._condition:
+                if failures == 0:
+                    self._condition.wait_for(lambda: self._size_reached, timeout=delay)
+                else:
+                    self._condition.wait(delay)
+                self._size_reached = False
+            try:
+                while self._flush_once():
+                    pass
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print(f"Firestore batch commit failed (attempt {failures}); retrying: {e}")
+            try:
+                self._settle_local()
+            except Exception as e:
+                print(f"Could not check committed Firestore writes: {e}")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM writes GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM writes WHERE status = 'pending'").fetchone()[0]
+        with self._condition:
+            return {
+                **self._stats,
+                "pending": counts.get("pending", 0),
+                "dead_in_spill_file": counts.get("dead", 0),
+                "oldest_pending_seconds": round(time.time() - oldest, 3) if oldest is not None else None,
+                "awaiting_commit_here": len(self._local),
+            }
+
+
+firestore_writer = None
+_firestore_writer_lock = threading.Lock()
+
+
+def get_firestore_writer() -> FirestoreWriteQueue:
+    """
+    Lazy initializer for the process's write-behind queue. Creating it starts the writer thread,
+    which also replays writes a previous run left in the spill file.
+    """
+    global firestore_writer
+    with _firestore_writer_lock:
+        if firestore_writer is None:
+            firestore_writer = FirestoreWriteQueue(
+                spill_path=os.getenv("FIRESTORE_SPILL_DB", os.path.join(tempfile.gettempdir(), "patholens_firestore_spill.sqlite3")),
+            )
+            atexit.register(firestore_writer.flush, FIRESTORE_EXIT_FLUSH_SECONDS)
+    return firestore_writer
+
+
+register_stats("firestore-writes", lambda: get_firestore_writer().stats(), blocking=True)
@@ -0,0 +1,183 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import diskcache
+from PIL import Image
+
+from app.common.stats_registry import register_stats
+
+
+def hash_image_bytes(content: bytes) -> str:
+    """Content hash of encoded image bytes."""
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 16) -> str:
+    """
+    Difference hash (dHash) of an image. Re-captures of the same area that differ only by encoding
+    noise or a pixel of offset hash the same, unlike a byte hash.
+    """
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = gray.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"dhash{hash_size}:{bits:0{hash_size * hash_size // 4}x}"
+
+
+def prompt_version(system_instruction: str, prompt: str) -> str:
+    """Short hash of the prompt text, so editing a prompt never serves answers to the old one."""
+    return hashlib.sha256(f"{system_instruction}\x00{prompt}".encode("utf-8")).hexdigest()[:12]
+
+
+def artifact_scope(session) -> str:
+    """Scope of a session's artifacts, so a stored image is only ever reused by the session that owns it."""
+    return f"{session.app_name}/{session.user_id}/{session.id}"
+
+
+def make_inference_key(image_hash: str, prompt_key: str, version: str, max_tokens: int, temperature: float) -> str:
+    """Builds a cache key from the image identity, the prompt and every generation parameter."""
+    return f"infer:v1:{image_hash}:{prompt_key}:{version}:{max_tokens}:{temperature:g}"
+
+
+class InferenceCache:
+    """
+    Content-addressed cache of model responses: an entry-bounded in-memory LRU in front of a
+    persistent diskcache store, both with a per-entry TTL.
+
+    It also remembers which artifact URI holds the image with a given hash (and the reverse), so a
+    snapshot flow can skip re-uploading an image it has seen and the model call can find the
+    image hash again from the URI it is given. Artifacts belong to a session, so the image-to-artifact
+    map is scoped (see artifact_scope); responses are shared by every session.
+    """
+
+    def __init__(self, max_entries: int, disk_dir: Optional[str], max_disk_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self._disk = None
+        if disk_dir:
+            self._disk = diskcache.Cache(disk_dir, size_limit=max_disk_bytes, eviction_policy="least-recently-used")
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "latency_saved_seconds": 0.0}
+
+    def _get(self, key: str):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= time.time():
+                    self._memory.move_to_end(key)
+                    return value, "memory"
+                del self._memory[key]
+        if self._disk is not None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                with self._lock:
+                    self._remember(key, expires_at, value)
+                return value, "disk"
+        return None, None
+
+    def _remember(self, key: str, expires_at: float, value):
+        """Adds an entry to the memory tier and evicts LRU entries. Caller holds the lock."""
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _set(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, value)
+        if self._disk is not None:
+            self._disk.set(key, (expires_at, value), expire=self.ttl)
+
+    # --- Model responses ---
+
+    def get_response(self, key: str) -> Optional[str]:
+        value, tier = self._get(key)
+        with self._lock:
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            text, latency_seconds = value
+            self._stats[f"{tier}_hits"] += 1
+            self._stats["latency_saved_seconds"] += latency_seconds
+        return text
+
+    def put_response(self, key: str, text: str, latency_seconds: float):
+        """Stores a response along with how long the model took, to account for the latency later hits save."""
+        self._set(key, (text, latency_seconds))
+        with self._lock:
+            self._stats["stores"] += 1
+
+    # --- Image identity ---
+
+    def record_artifact(self, scope: str, image_hash: str, artifact_uri: str):
+        """Records that `artifact_uri` holds the image, so later stores of the same image in `scope` can reuse it."""
+        self._set(f"artifact:{scope}:{image_hash}", artifact_uri)
+        self.record_image(artifact_uri, image_hash)
+
+    def record_image(self, artifact_uri: str, image_hash: str):
+        """Records only which image a URI refers to, e.g. while its artifact is still being written."""
+        self._set(f"image:{artifact_uri}", image_hash)
+
+    def artifact_for_image(self, scope: str, image_hash: str) -> Optional[str]:
+        return self._get(f"artifact:{scope}:{image_hash}")[0]
+
+    def image_for_artifact(self, artifact_uri: str) -> Optional[str]:
+        return self._get(f"image:{artifact_uri}")[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            stats = {
+                **self._stats,
+                "hit_rate": (lookups - self._stats["misses"]) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "ttl_seconds": self.ttl,
+            }
+        if self._disk is not None:
+            stats["disk_entries"] = len(self._disk)
+            stats["disk_bytes"] = self._disk.volume()
+        return stats
+
+
+# How snapshot images are identified: "bytes" (exact encoded content) or "dhash" (perceptual).
+INFERENCE_CACHE_HASH = os.getenv("INFERENCE_CACHE_HASH", "bytes")
+
+
+def hash_snapshot(image: Image.Image, content: bytes) -> str:
+    """Identity of a rendered snapshot according to INFERENCE_CACHE_HASH."""
+    if INFERENCE_CACHE_HASH == "dhash":
+        return perceptual_hash(image)
+    return hash_image_bytes(content)
+
+
+inference_cache_instance = None
+_inference_cache_lock = threading.Lock()
+
+
+def get_inference_cache() -> InferenceCache:
+    """Lazy initializer for the shared inference cache, configured from environment variables."""
+    global inference_cache_instance
+    with _inference_cache_lock:
+        if inference_cache_instance is None:
+            inference_cache_instance = InferenceCache(
+                max_entries=int(os.getenv("INFERENCE_CACHE_ENTRIES", "2048")),
+                disk_dir=os.getenv("INFERENCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "patholens_inference_cache")),
+                max_disk_bytes=int(os.getenv("INFERENCE_CACHE_DISK_BYTES", str(256 * 1024 ** 2))),
+                ttl=float(os.getenv("INFERENCE_CACHE_TTL", str(7 * 24 * 3600))),
+            )
+    return inference_cache_instance
+
+
+register_stats("inference-cache", lambda: get_inference_cache().stats())
@@ -0,0 +1,37 @@
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, Tuple
+
+
+class LatencyStats:
+    """Rolling latency samples per (path, operation), summarised as count, mean and percentiles."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[Tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def record(self, path: str, operation: str, seconds: float):
+        with self._lock:
+            self._samples[(path, operation)].append(seconds)
+            self._counts[(path, operation)] += 1
+
+    @staticmethod
+    def _percentile(ordered: list, fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def snapshot(self) -> dict:
+        """Returns {path: {operation: summary}}; latencies are in milliseconds over the last `window` samples."""
+        with self._lock:
+            items = [(key, sorted(samples), self._counts[key]) for key, samples in self._samples.items()]
+        summary: Dict[str, dict] = defaultdict(dict)
+        for (path, operation), ordered, count in items:
+            summary[path][operation] = {
+                "count": count,
+                "mean_ms": 1000 * sum(ordered) / len(ordered),
+                "p50_ms": 1000 * self._percentile(ordered, 0.50),
+                "p95_ms": 1000 * self._percentile(ordered, 0.95),
+                "max_ms": 1000 * ordered[-1],
+            }
+        return dict(summary)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from app.common.medgemma_client import MedGemmaClient
+
+
+class _PendingBatch:
+    """Requests of one group waiting to be sent together."""
+
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.items: List[Tuple[dict, Future]] = []
+
+
+class MedGemmaBatcher:
+    """
+    Micro-batching front end for MedGemmaClient.
+
+    Concurrent `generate_summary` calls are collected per group (by default, per prompt key) and
+    sent as one multi-instance predict call once a group holds `max_batch_size` requests or its
+    oldest request has waited `max_wait_ms`. Each caller blocks until its own prediction is back.
+    Batches are sent on a small pool, so a slow batch does not hold up the next one.
+    """
+
+    def __init__(self, client: MedGemmaClient, max_batch_size: int, max_wait_ms: float, group_by_prompt: bool = True, max_concurrent_batches: int = 4):
+        self.client = client
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.group_by_prompt = group_by_prompt
+        self._pending: Dict[Hashable, _PendingBatch] = {}
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="medgemma-batch")
+        self._stats = {"requests": 0, "batches": 0, "full_batches": 0, "timed_out_batches": 0, "failed_batches": 0}
+        self._batch_sizes: Dict[int, int] = defaultdict(int)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="medgemma-batcher", daemon=True)
+        self._dispatcher.start()
+
+    def generate_summary(
+        self,
+        image_uri: Optional[str],
+        prompt: str,
+        system_instruction: str,
+        max_tokens: int = 512,
+        temperature: float = 0.2,
+        image_bytes: Optional[bytes] = None,
+        group_key: Optional[Hashable] = None,
+    ) -> str:
+        """Same contract as MedGemmaClient.generate_summary; the request is sent as part of a batch."""
+        instance = self.client.build_instance(image_uri, prompt, system_instruction, max_tokens, temperature, image_bytes)
+        group = group_key if self.group_by_prompt else None
+        future = Future()
+        with self._condition:
+            batch = self._pending.get(group)
+            if batch is None:
+                batch = self._pending[group] = _PendingBatch()
+            batch.items.append((instance, future))
+            self._stats["requests"] += 1
+            if len(batch.items) >= self.max_batch_size:
+                self._send(group, full=True)
+            else:
+                self._condition.notify()
+        return future.result()
+
+    def _send(self, group: Hashable, full: bool):
+        """Hands a group's pending requests to the batch pool. Caller holds the condition."""
+        batch = self._pending.pop(group)
+        self._stats["batches"] += 1
+        self._stats["full_batches" if full else "timed_out_batches"] += 1
+        self._batch_sizes[len(batch.items)] += 1
+        self._executor.submit(self._predict, batch.items)
+
+    def _dispatch_loop(self):
+        """Flushes groups whose oldest request has waited `max_wait`."""
+        with self._condition:
+            while True:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                for group, batch in list(self._pending.items()):
+                    if now - batch.created_at >= self.max_wait:
+                        self._send(group, full=False)
+                if self._pending:
+                    oldest = min(batch.created_at for batch in self._pending.values())
+                    self._condition.wait(max(0.0, oldest + self.max_wait - now))
+
+    def _predict(self, items: List[Tuple[dict, Future]]):
+        try:
+            predictions = self.client.predict_batch([instance for instance, _ in items])
+        except Exception as e:
+            print(f"Error calling MedGemma endpoint for a batch of {len(items)}: {e}")
+            with self._condition:
+                self._stats["failed_batches"] += 1
+            for _, future in items:
+                future.set_result(f"Error: Could not get a response from the model. Details: {e}")
+            return
+        for (_, future), prediction in zip(items, predictions):
+            future.set_result(prediction if prediction is not None else "")
+
+    def stats(self) -> dict:
+        with self._condition:
+            batches = self._stats["batches"]
+            return {
+                **self._stats,
+                "mean_batch_size": self._stats["requests"] / batches if batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "pending_requests": sum(len(batch.items) for batch in self._pending.values()),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "group_by_prompt": self.group_by_prompt,
+            }
+
+
+def batcher_from_env(client: MedGemmaClient) -> Optional[MedGemmaBatcher]:
+    """Builds a batcher for `client` from environment variables, or returns None if batching is disabled."""
+    if os.getenv("MEDGEMMA_BATCHING", "1") != "1":
+        return None
+    return MedGemmaBatcher(
+        client,
+        max_batch_size=int(os.getenv("MEDGEMMA_BATCH_MAX_SIZE", "8")),
+        max_wait_ms=float(os.getenv("MEDGEMMA_BATCH_MAX_WAIT_MS", "25")),
+        group_by_prompt=os.getenv("MEDGEMMA_BATCH_GROUP_BY_PROMPT", "1") == "1",
+        max_concurrent_batches=int(os.getenv("MEDGEMMA_BATCH_CONCURRENCY", "4")),
+    )
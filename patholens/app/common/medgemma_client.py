@@ -1,10 +1,33 @@
+import base64
+import json
 import os
+from typing import Iterator, List, Optional
+from PIL import Image
 from google.cloud import aiplatform
+from app.common.tile_encoding import encode_image
+
+# MedGemma's vision encoder works at 896x896; larger inline images only cost bandwidth.
+MEDGEMMA_INPUT_SIZE = int(os.getenv("MEDGEMMA_INPUT_SIZE", "896"))
+MEDGEMMA_INPUT_QUALITY = int(os.getenv("MEDGEMMA_INPUT_QUALITY", "90"))
+
+# Chunk size, in words, when an endpoint without streaming support is presented as a stream.
+STREAM_FALLBACK_CHUNK_WORDS = 4
+
+
+def prepare_model_image(image: Image.Image) -> bytes:
+    """Downscales an image to the model's input resolution and encodes it compactly for sending inline."""
+    image = image.convert("RGB")
+    if max(image.size) > MEDGEMMA_INPUT_SIZE:
+        image = image.copy()
+        image.thumbnail((MEDGEMMA_INPUT_SIZE, MEDGEMMA_INPUT_SIZE), Image.BILINEAR)
+    content, _ = encode_image(image, "jpeg", MEDGEMMA_INPUT_QUALITY)
+    return content
+
 
 class MedGemmaClient:
     """A wrapper for interacting with a deployed MedGemma endpoint on Vertex AI."""
 
-    def __init__(self, project_id: str, region: str, endpoint_id: str):
+    def __init__(self, project_id: str, region: str, endpoint_id: str, endpoint=None):
         """
         Initializes the MedGemma client.
 
@@ -12,7 +35,14 @@ class MedGemmaClient:
             project_id: The Google Cloud project ID.
             region: The region where the Vertex AI endpoint is deployed.
             endpoint_id: The ID of the Vertex AI endpoint.
+            endpoint: Optional object to use instead of the Vertex AI endpoint, e.g. a local fake.
+                It must provide `predict(instances=...)` returning an object with `.predictions`.
         """
+        if endpoint is not None:
+            self.endpoint = endpoint
+            print(f"MedGemmaClient initialized with a custom endpoint: {type(endpoint).__name__}")
+            return
+
         if not all([project_id, region, endpoint_id]):
             raise ValueError("Project ID, region, and endpoint ID must be provided.")
         
@@ -20,45 +50,110 @@ class MedGemmaClient:
         self.endpoint = aiplatform.Endpoint(endpoint_name=endpoint_id)
         print(f"MedGemmaClient initialized for endpoint: {self.endpoint.resource_name}")
 
+    @staticmethod
+    def build_instance(
+        image_uri: Optional[str],
+        prompt: str,
+        system_instruction: str,
+        max_tokens: int = 512,
+        temperature: float = 0.2,
+        image_bytes: Optional[bytes] = None,
+    ) -> dict:
+        """
+        Builds one prediction instance in the format the MedGemma endpoint expects. `image_bytes`
+        (a JPEG from prepare_model_image) is sent inline as a data URI and takes precedence over
+        `image_uri`, so the endpoint does not have to fetch the image.
+        """
+        if image_bytes is not None:
+            image_uri = "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode("ascii")
+        return {
+            "prompt": f"{system_instruction} {prompt}",
+            "multi_modal_data": {"image": image_uri},
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "raw_response": True,
+        }
+
+    def predict_batch(self, instances: List[dict]) -> List[Optional[str]]:
+        """
+        Sends several instances in a single predict call.
+
+        Returns one prediction per instance, in order (None where the endpoint returned fewer
+        predictions than instances). Errors are raised to the caller.
+        """
+        response = self.endpoint.predict(instances=instances)
+        predictions = list(response.predictions or [])
+        return predictions + [None] * (len(instances) - len(predictions))
+
     def generate_summary(
         self,
-        image_uri: str,
+        image_uri: Optional[str],
         prompt: str,
         system_instruction: str,
         max_tokens: int = 512,
         temperature: float = 0.2,
+        image_bytes: Optional[bytes] = None,
     ) -> str:
         """
         Generates a summary for a given image using the MedGemma model.
 
         Args:
-            image_uri: GCS URI of the image to analyze (e.g., "gs://bucket/image.png").
+            image_uri: GCS URI of the image to analyze (e.g., "gs://bucket/image.png"). Unused when image_bytes is given.
             prompt: The user-facing prompt for the model.
             system_instruction: The system-level instruction to guide the model's persona.
             max_tokens: The maximum number of tokens to generate.
             temperature: The sampling temperature for the generation.
+            image_bytes: Optional JPEG bytes to send inline instead of the URI.
 
         Returns:
             The generated text summary from the model.
         """
-        full_prompt = f"{system_instruction} {prompt}"
-        
-        instances = [{
-            "prompt": full_prompt,
-            "multi_modal_data": {"image": image_uri},
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "raw_response": True,
-        }]
+        instance = self.build_instance(image_uri, prompt, system_instruction, max_tokens, temperature, image_bytes)
 
         try:
-            response = self.endpoint.predict(instances=instances)
-            prediction = response.predictions[0] if response.predictions else ""
-            return prediction
+            prediction = self.predict_batch([instance])[0]
+            return prediction if prediction is not None else ""
         except Exception as e:
             print(f"Error calling MedGemma endpoint: {e}")
             return f"Error: Could not get a response from the model. Details: {e}"
 
+    def stream_summary(
+        self,
+        image_uri: Optional[str],
+        prompt: str,
+        system_instruction: str,
+        max_tokens: int = 512,
+        temperature: float = 0.2,
+        image_bytes: Optional[bytes] = None,
+    ) -> Iterator[str]:
+        """
+        Generates a summary like `generate_summary`, yielding text chunks as they are produced.
+
+        Uses the endpoint's streaming raw predict when it has one. Other endpoints (including local
+        fakes) are called with a regular predict and the completion is yielded in word-sized chunks,
+        so callers can rely on the same streaming interface everywhere. Errors, including ones after
+        some chunks were yielded, are raised to the caller, so a stream that ends normally is complete.
+        """
+        instance = self.build_instance(image_uri, prompt, system_instruction, max_tokens, temperature, image_bytes)
+        if hasattr(self.endpoint, "stream_raw_predict"):
+            yield from self._stream_raw_predict(instance)
+            return
+        prediction = self.predict_batch([instance])[0] or ""
+
+        words = prediction.split(" ")
+        for i in range(0, len(words), STREAM_FALLBACK_CHUNK_WORDS):
+            chunk = " ".join(words[i:i + STREAM_FALLBACK_CHUNK_WORDS])
+            yield chunk if i == 0 else " " + chunk
+
+    def _stream_raw_predict(self, instance: dict) -> Iterator[str]:
+        body = json.dumps({"instances": [{**instance, "stream": True}]}).encode("utf-8")
+        for response in self.endpoint.stream_raw_predict(body=body, headers={"Content-Type": "application/json"}):
+            payload = json.loads(response.data) if response.data else {}
+            for prediction in payload.get("predictions", []):
+                if isinstance(prediction, str) and prediction:
+                    yield prediction
+
+
 # Example of how this might be instantiated in main.py later
 # medgemma_client = MedGemmaClient(
 #     project_id=os.getenv("GCP_PROJECT_ID"),
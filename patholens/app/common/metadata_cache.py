@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from app.common.stats_registry import register_stats
+
+# Marker stored for keys the backend reported as missing.
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Small in-process cache with per-entry TTL, negative caching and request coalescing.
+
+    `get_or_load` calls the loader at most once per key at a time; concurrent callers wait for
+    the same result. A loader returning None marks the key as missing for `negative_ttl` seconds.
+    Loader exceptions are propagated and not cached. `ttl_for`, if given, picks the TTL of each
+    loaded value instead of `ttl`.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int, ttl_for: Optional[Callable[[object], float]] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.ttl_for = ttl_for
+        self._entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._inflight: Dict[Hashable, Future] = {}
+        self._generation: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "bulk_loaded": 0}
+
+    def _store(self, key: Hashable, value):
+        """Stores a value (or _MISSING). Caller holds the lock."""
+        if value is _MISSING:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl_for(value) if self.ttl_for is not None else self.ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: Hashable):
+        """Returns the cached value, _MISSING, or None when absent/expired. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Optional[object]]) -> Optional[object]:
+        """Returns the cached value for `key`, loading it on a miss. Returns None for missing keys."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self._stats["negative_hits"] += 1
+                return None
+            if value is not None:
+                self._stats["hits"] += 1
+                return value
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                generation = self._generation.get(key, 0)
+                self._stats["misses"] += 1
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+            # Skip caching if the key was invalidated while the load was in flight.
+            if self._generation.get(key, 0) == generation:
+                self._store(key, _MISSING if value is None else value)
+        future.set_result(value)
+        return value
+
+    def load_many(self, keys: Iterable[Hashable], loader: Callable[[List[Hashable]], Dict[Hashable, Optional[object]]]) -> int:
+        """
+        Loads the keys that are neither cached nor being loaded with one `loader` call, which maps
+        each of them to its value (None for missing). Returns the number of keys loaded.
+        """
+        with self._lock:
+            generations = {
+                key: self._generation.get(key, 0) for key in dict.fromkeys(keys)
+                if self._lookup(key) is None and key not in self._inflight
+            }
+        if not generations:
+            return 0
+        values = loader(list(generations))
+        with self._lock:
+            for key, generation in generations.items():
+                # Same rule as get_or_load: a key invalidated during the load is not cached.
+                if self._generation.get(key, 0) == generation and key not in self._inflight:
+                    value = values.get(key)
+                    self._store(key, _MISSING if value is None else value)
+            self._stats["bulk_loaded"] += len(generations)
+        return len(generations)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation[key] = self._generation.get(key, 0) + 1
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "inflight": len(self._inflight)}
+
+
+SLIDE_METADATA_TTL = float(os.getenv("SLIDE_METADATA_TTL", "60"))
+# Slides still being processed are updated by ingestion workers in other processes, whose
+# invalidations never reach this cache; their metadata is only kept briefly.
+SLIDE_METADATA_PENDING_TTL = float(os.getenv("SLIDE_METADATA_PENDING_TTL", "2"))
+
+
+def _slide_metadata_ttl(metadata: dict) -> float:
+    if metadata.get("processing_status") == "complete":
+        return SLIDE_METADATA_TTL
+    return min(SLIDE_METADATA_PENDING_TTL, SLIDE_METADATA_TTL)
+
+
+slide_metadata_cache = TTLCache(
+    ttl=SLIDE_METADATA_TTL,
+    negative_ttl=float(os.getenv("SLIDE_METADATA_NEGATIVE_TTL", "10")),
+    max_entries=int(os.getenv("SLIDE_METADATA_CACHE_SIZE", "10000")),
+    ttl_for=_slide_metadata_ttl,
+)
+register_stats("metadata-cache", slide_metadata_cache.stats)
+
+
+def invalidate_slide_metadata(slide_id: str):
+    """
+    Drops a slide's cached metadata in this process. Call after any write to its `slide_metadata`
+    document; other processes see the write once their entry expires (see SLIDE_METADATA_PENDING_TTL).
+    """
+    slide_metadata_cache.invalidate(slide_id)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Literal, Tuple
 
 class AgentRunRequest(BaseModel):
     """
@@ -25,9 +25,71 @@ class AgentRunRequest(BaseModel):
         example={"streaming_mode": "SSE"}, 
         description="Optional ADK RunConfig parameters."
     )
+    stream_model_output: bool = Field(
+        default=False,
+        description="Also stream partial MedGemma output as `model_stream` events. Streamed calls are not batched.",
+    )
 
 
 class SlideProcessingRequest(BaseModel):
     """Defines the request to process a new WSI."""
     slide_id: str = Field(..., example="TCGA-AA-3554-01A-01-TS1")
     gcs_uri: str = Field(..., example="gs://your-wsi-bucket-name/raw/TCGA-AA-3554-01A-01-TS1.svs")
+    priority: int = Field(default=0, example=0, description="Higher-priority jobs are picked up first.")
+    extract_embeddings: Optional[bool] = Field(default=None, description="Also extract patch embeddings; defaults to EMBEDDINGS_ENABLED.")
+
+
+class TileRect(BaseModel):
+    """A level-0 rectangle; every tile of the grid that intersects it is returned."""
+    x: int = Field(..., ge=0, example=0)
+    y: int = Field(..., ge=0, example=0)
+    width: int = Field(..., gt=0, example=4096)
+    height: int = Field(..., gt=0, example=2048)
+
+
+class TileBatchRequest(BaseModel):
+    """Defines a batch of tiles to fetch from one slide level in a single round trip."""
+    tiles: Optional[List[Tuple[int, int]]] = Field(
+        default=None,
+        example=[[0, 0], [1024, 0]],
+        description="Level-0 (x, y) tile origins, as used by the single-tile route."
+    )
+    rect: Optional[TileRect] = Field(
+        default=None,
+        description="Alternatively, a level-0 rectangle covering the viewport."
+    )
+    tile_size: int = Field(default=256, gt=0, le=2048, description="Tile size in pixels of the requested level.")
+    format: Optional[str] = Field(default=None, example="webp", description="Tile format; defaults to negotiation on the Accept header.")
+    quality: Optional[int] = Field(default=None, ge=1, le=100, description="Quality for lossy formats.")
+
+
+class RegionPayload(BaseModel):
+    """A region of a slide as reported by the viewer: level-0 origin, size in pixels of `level`."""
+    slide_id: str = Field(..., example="TCGA-AA-3554-01A-01-TS1")
+    x: int = Field(..., example=10240)
+    y: int = Field(..., example=8192)
+    width: int = Field(..., gt=0, example=1024)
+    height: int = Field(..., gt=0, example=768)
+    level: int = Field(..., ge=0, example=1)
+
+
+class RoiMarkedPayload(RegionPayload):
+    """A Region of Interest marked by the user, with their annotations."""
+    annotations: Optional[Dict[str, Any]] = Field(default=None, example={"label": "suspicious gland"})
+
+
+class SlideLoadedPayload(BaseModel):
+    """A slide opened in the viewer."""
+    slide_id: str = Field(..., example="TCGA-AA-3554-01A-01-TS1")
+
+
+class SimilarRegionRequest(BaseModel):
+    """A region of interest to find similar tissue for: level-0 origin, size in pixels of `level`."""
+    x: int = Field(..., ge=0, example=10240)
+    y: int = Field(..., ge=0, example=8192)
+    width: int = Field(..., gt=0, example=512)
+    height: int = Field(..., gt=0, example=512)
+    level: int = Field(default=0, ge=0, example=0)
+    k: int = Field(default=10, ge=1, le=500, description="Number of patches to return.")
+    scope: Literal["slide", "cohort"] = Field(default="slide", description="Search this slide or every ingested slide.")
+    encoder: Optional[str] = Field(default=None, example="reference", description="Embedding model; defaults to EMBEDDINGS_ENCODER.")
@@ -0,0 +1,178 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Mosaic layout: rows x columns of patches, each `MOSAIC_PATCH_SIZE` pixels at the read level.
+MOSAIC_GRID = os.getenv("MOSAIC_GRID", "3x3")
+MOSAIC_PATCH_SIZE = int(os.getenv("MOSAIC_PATCH_SIZE", "256"))
+# Downsample of the level patches are read from; 4 shows tissue architecture at a glance.
+MOSAIC_DOWNSAMPLE = float(os.getenv("MOSAIC_DOWNSAMPLE", "4"))
+MOSAIC_READ_WORKERS = int(os.getenv("MOSAIC_READ_WORKERS", "8"))
+
+# Longest side of the thumbnail the tissue mask is computed on.
+THUMBNAIL_SIZE = 1024
+# Largest level read whole for the thumbnail. Slides without a small enough level (shallow or no
+# pyramid) are sampled instead, reading at most about this many pixels.
+THUMBNAIL_MAX_READ_PIXELS = int(os.getenv("MOSAIC_THUMBNAIL_MAX_READ_PIXELS", str(4096 * 4096)))
+# Side, in thumbnail pixels, of each cell filled from one sampled read.
+THUMBNAIL_SAMPLE_CELL = 16
+# A patch must be at least this fraction tissue to be preferred.
+MIN_TISSUE_FRACTION = 0.5
+
+
+def parse_grid(grid: str) -> Tuple[int, int]:
+    rows, cols = (int(value) for value in grid.lower().split("x"))
+    if rows < 1 or cols < 1:
+        raise ValueError(f"Invalid mosaic grid '{grid}'")
+    return rows, cols
+
+
+def read_thumbnail(reader, max_size: int = THUMBNAIL_SIZE) -> Tuple[np.ndarray, float]:
+    """
+    Reads a low-resolution RGB thumbnail from the smallest pyramid level that is still at least
+    `max_size` on its longest side (or the smallest level). Returns the array and its downsample
+    relative to level 0. Levels larger than THUMBNAIL_MAX_READ_PIXELS are sampled rather than read.
+    """
+    level = reader.level_count - 1
+    for candidate in range(reader.level_count - 1, -1, -1):
+        if max(reader.level_dimensions[candidate]) >= max_size:
+            level = candidate
+            break
+    width, height = reader.level_dimensions[level]
+    scale = min(1.0, max_size / max(width, height))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if width * height > THUMBNAIL_MAX_READ_PIXELS:
+        image = _sampled_thumbnail(reader, level, size)
+    else:
+        image = reader.read_region((0, 0), level, (width, height)).convert("RGB")
+        if scale < 1.0:
+            image = image.resize(size, Image.BILINEAR)
+    downsample = reader.level_dimensions[0][0] / image.width
+    return np.asarray(image), downsample
+
+
+def _sampled_thumbnail(reader, level: int, size: Tuple[int, int]) -> Image.Image:
+    """
+    Builds a thumbnail of `size` from a level too large to read whole: each THUMBNAIL_SAMPLE_CELL
+    cell is filled from one read at the centre of the area it covers, sized so all reads together
+    stay within THUMBNAIL_MAX_READ_PIXELS.
+    """
+    width, height = reader.level_dimensions[level]
+    level_downsample = reader.level_downsamples[level]
+    cell = THUMBNAIL_SAMPLE_CELL
+    cells = [(x, y) for y in range(0, size[1], cell) for x in range(0, size[0], cell)]
+    scale_x, scale_y = width / size[0], height / size[1]
+    budget_side = max(cell, int((THUMBNAIL_MAX_READ_PIXELS / len(cells)) ** 0.5))
+    thumbnail = Image.new("RGB", size, (255, 255, 255))
+
+    def read_cell(origin):
+        x, y = origin
+        cell_width, cell_height = min(cell, size[0] - x), min(cell, size[1] - y)
+        read_width = max(1, min(budget_side, int(cell_width * scale_x)))
+        read_height = max(1, min(budget_side, int(cell_height * scale_y)))
+        left = int((x + cell_width / 2) * scale_x - read_width / 2)
+        top = int((y + cell_height / 2) * scale_y - read_height / 2)
+        location = (int(left * level_downsample), int(top * level_downsample))
+        sample = reader.read_region(location, level, (read_width, read_height)).convert("RGB")
+        return origin, sample.resize((cell_width, cell_height), Image.BILINEAR)
+
+    with ThreadPoolExecutor(max_workers=MOSAIC_READ_WORKERS, thread_name_prefix="mosaic") as executor:
+        for origin, sample in executor.map(read_cell, cells):
+            thumbnail.paste(sample, origin)
+    return thumbnail
+
+
+def tissue_mask(rgb: np.ndarray) -> np.ndarray:
+    """
+    Boolean tissue mask of an RGB thumbnail. Stained tissue is saturated and darker than the glass
+    background; very dark pixels (pen marks, slide edges) are excluded.
+    """
+    rgb = rgb.astype(np.int16)
+    high = rgb.max(axis=2)
+    low = rgb.min(axis=2)
+    saturation = (high - low) / np.maximum(high, 1)
+    return (saturation > 0.07) & (high < 235) & (high > 40)
+
+
+def candidates_from_mask(mask: np.ndarray, mask_downsample: float, patch_level0: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits the mask into patch-sized cells and returns the level-0 top-left corner of each cell
+    and its tissue fraction, using a summed-area table so every cell costs O(1).
+    """
+    cell = max(1, int(round(patch_level0 / mask_downsample)))
+    rows, cols = mask.shape[0] // cell, mask.shape[1] // cell
+    if rows == 0 or cols == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    ys = np.arange(rows + 1) * cell
+    xs = np.arange(cols + 1) * cell
+    corners = table[np.ix_(ys, xs)]
+    sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    fractions = (sums / (cell * cell)).ravel()
+    grid_y, grid_x = np.meshgrid(ys[:-1], xs[:-1], indexing="ij")
+    origins = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1) * mask_downsample
+    return origins.astype(np.int64), fractions
+
+
+def select_diverse(points: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Picks up to `k` indices spread across the slide: farthest-point sampling over the candidates
+    with enough tissue, starting from the highest-scoring one. Falls back to all candidates when
+    too few qualify.
+    """
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pool = np.flatnonzero(scores >= MIN_TISSUE_FRACTION)
+    if len(pool) < k:
+        pool = np.argsort(-scores)[:max(k, len(pool))]
+    coords = points[pool].astype(np.float64)
+    chosen = [int(np.argmax(scores[pool]))]
+    distances = np.linalg.norm(coords - coords[chosen[0]], axis=1)
+    while len(chosen) < min(k, len(pool)):
+        next_index = int(np.argmax(distances))
+        if distances[next_index] <= 0:
+            break
+        chosen.append(next_index)
+        distances = np.minimum(distances, np.linalg.norm(coords - coords[next_index], axis=1))
+    # Reading order (top to bottom, left to right) keeps the mosaic layout stable.
+    selected = pool[chosen]
+    return selected[np.lexsort((points[selected, 0], points[selected, 1]))]
+
+
+def build_mosaic(reader, trident_coords: Optional[np.ndarray] = None, grid: str = MOSAIC_GRID, patch_size: int = MOSAIC_PATCH_SIZE) -> Image.Image:
+    """
+    Builds a global-summary mosaic of tissue-rich, well-spread patches of a slide.
+
+    Candidates come from Trident's tissue patch coordinates when available, otherwise from a tissue
+    mask of a low-resolution thumbnail. The chosen patches are read concurrently and written into a
+    preallocated array; unused grid cells stay white.
+    """
+    rows, cols = parse_grid(grid)
+    level = reader.get_best_level_for_downsample(MOSAIC_DOWNSAMPLE)
+    level_downsample = reader.level_downsamples[level]
+    patch_level0 = patch_size * level_downsample
+
+    if trident_coords is not None and len(trident_coords):
+        points = np.asarray(trident_coords, dtype=np.int64)
+        scores = np.ones(len(points))
+    else:
+        thumbnail, thumbnail_downsample = read_thumbnail(reader)
+        points, scores = candidates_from_mask(tissue_mask(thumbnail), thumbnail_downsample, patch_level0)
+    selected = points[select_diverse(points, scores, rows * cols)]
+
+    mosaic = np.full((rows * patch_size, cols * patch_size, 3), 255, dtype=np.uint8)
+
+    def read_patch(cell_and_origin):
+        cell, (x, y) = cell_and_origin
+        patch = reader.read_region((int(x), int(y)), level, (patch_size, patch_size)).convert("RGB")
+        row, col = divmod(cell, cols)
+        mosaic[row * patch_size:(row + 1) * patch_size, col * patch_size:(col + 1) * patch_size] = np.asarray(patch)
+
+    if len(selected):
+        with ThreadPoolExecutor(max_workers=min(MOSAIC_READ_WORKERS, len(selected)), thread_name_prefix="mosaic") as executor:
+            list(executor.map(read_patch, enumerate(selected)))
+    return Image.fromarray(mosaic)
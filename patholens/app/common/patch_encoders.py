@@ -0,0 +1,97 @@
+import os
+import threading
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+# Encoder used for ingestion and for queries that have to encode a region themselves.
+EMBEDDINGS_ENCODER = os.getenv("EMBEDDINGS_ENCODER", "reference")
+
+
+class PatchEncoder:
+    """
+    Turns RGB patches into feature vectors. Subclasses set `name`, `input_size` (patches are resized
+    to this square size) and `dim`, and implement `encode`, which receives a uint8 array of shape
+    (batch, input_size, input_size, 3) and returns a float32 array of shape (batch, dim).
+    """
+
+    name = ""
+    input_size = 224
+    dim = 0
+
+    def encode(self, patches: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def encode_images(self, images: List[Image.Image]) -> np.ndarray:
+        size = (self.input_size, self.input_size)
+        batch = np.stack([np.asarray(image.convert("RGB").resize(size, Image.BILINEAR)) for image in images])
+        return self.encode(batch)
+
+
+class ReferenceEncoder(PatchEncoder):
+    """
+    Tiny deterministic encoder needing only NumPy: per-channel colour histograms plus a coarse
+    grayscale layout. Useful for tests and for trying the search without a model.
+    """
+
+    name = "reference"
+    input_size = 32
+    dim = 3 * 16 + 8 * 8
+
+    def encode(self, patches: np.ndarray) -> np.ndarray:
+        batch = patches.shape[0]
+        bins = (patches >> 4).astype(np.int64)  # 16 bins per channel
+        offsets = np.arange(3) * 16
+        flat = (bins + offsets).reshape(batch, -1)
+        histograms = np.zeros((batch, 48), dtype=np.float32)
+        np.add.at(histograms, (np.repeat(np.arange(batch), flat.shape[1]), flat.ravel()), 1)
+        histograms /= patches.shape[1] * patches.shape[2]
+        gray = patches.astype(np.float32).mean(axis=3)
+        layout = gray.reshape(batch, 8, self.input_size // 8, 8, self.input_size // 8).mean(axis=(2, 4)) / 255.0
+        return np.concatenate([histograms, layout.reshape(batch, -1)], axis=1)
+
+
+class PathFoundationEncoder(PatchEncoder):
+    """Google's Path Foundation model (384-d embeddings of 224 px patches at 20x), run on CPU with TensorFlow."""
+
+    name = "path-foundation"
+    input_size = 224
+    dim = 384
+
+    def __init__(self):
+        # Imported here so the API and workers only need TensorFlow when this encoder is selected.
+        from huggingface_hub import from_pretrained_keras
+        import tensorflow as tf
+
+        self._tf = tf
+        self._infer = from_pretrained_keras("google/path-foundation").signatures["serving_default"]
+
+    def encode(self, patches: np.ndarray) -> np.ndarray:
+        inputs = self._tf.constant(patches.astype(np.float32) / 255.0)
+        return self._infer(inputs)["output_0"].numpy().astype(np.float32)
+
+
+ENCODERS: Dict[str, Callable[[], PatchEncoder]] = {
+    ReferenceEncoder.name: ReferenceEncoder,
+    PathFoundationEncoder.name: PathFoundationEncoder,
+}
+
+_encoders: Dict[str, PatchEncoder] = {}
+_encoders_lock = threading.Lock()
+
+
+def register_encoder(name: str, factory: Callable[[], PatchEncoder]):
+    """Makes an encoder selectable by name (e.g. through EMBEDDINGS_ENCODER)."""
+    ENCODERS[name] = factory
+
+
+def get_encoder(name: str = EMBEDDINGS_ENCODER) -> PatchEncoder:
+    """Returns the shared instance of an encoder, creating (and loading its model) on first use."""
+    with _encoders_lock:
+        encoder = _encoders.get(name)
+        if encoder is None:
+            if name not in ENCODERS:
+                raise ValueError(f"Unknown patch encoder '{name}'. Available encoders: {list(ENCODERS)}")
+            encoder = _encoders[name] = ENCODERS[name]()
+    return encoder
@@ -0,0 +1,160 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+from google.cloud import storage
+
+
+class GcsRangeSource:
+    """Serves byte ranges of a GCS object with ranged GET requests."""
+
+    def __init__(self, slide_gcs_uri: str, client: storage.Client):
+        bucket_name, blob_name = slide_gcs_uri.replace("gs://", "").split("/", 1)
+        self.blob = client.bucket(bucket_name).get_blob(blob_name)
+        if self.blob is None:
+            raise FileNotFoundError(f"Slide not found in GCS: {slide_gcs_uri}")
+        self.size = self.blob.size
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """Returns bytes [start, end). GCS range ends are inclusive."""
+        return self.blob.download_as_bytes(start=start, end=end - 1, raw_download=True)
+
+
+class LocalRangeSource:
+    """Serves byte ranges of a local file. Stands in for the object store in local runs and tests."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def read_range(self, start: int, end: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object backed by ranged reads against a source.
+
+    Reads are widened to whole blocks, runs of missing blocks are fetched with a single request
+    (small gaps of already cached blocks are re-fetched rather than splitting the request), and
+    fetched blocks are kept in a small LRU cache. `read_at` does not touch the file position and
+    is safe to call from several threads.
+    """
+
+    def __init__(self, source, block_size: int = 256 * 1024, max_cached_blocks: int = 64, coalesce_gap_blocks: int = 2):
+        super().__init__()
+        self.source = source
+        self.size = source.size
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.coalesce_gap_blocks = coalesce_gap_blocks
+        self._pos = 0
+        self._blocks: "OrderedDict[int, bytes]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {"range_requests": 0, "bytes_fetched": 0, "block_hits": 0, "block_misses": 0}
+
+    # --- io.RawIOBase interface ---
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if self._pos < 0:
+            raise ValueError("Negative seek position")
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        data = self.read_at(self._pos, len(buffer))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        data = self.read_at(self._pos, self.size - self._pos)
+        self._pos += len(data)
+        return data
+
+    # --- Ranged access ---
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """Returns up to `length` bytes starting at `offset`."""
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        self.prefetch([(offset, end - offset)])
+        first, last = offset // self.block_size, (end - 1) // self.block_size
+        with self._lock:
+            chunks = []
+            for index in range(first, last + 1):
+                block = self._blocks.get(index)
+                if block is None:
+                    # Evicted between prefetch and assembly under heavy contention; fetch it directly.
+                    block = self._fetch_run(index, index)[0]
+                else:
+                    self._blocks.move_to_end(index)
+                chunks.append(block)
+        data = b"".join(chunks)
+        start = offset - first * self.block_size
+        return data[start:start + (end - offset)]
+
+    def prefetch(self, ranges: Iterable[Tuple[int, int]]):
+        """Makes sure the blocks covering all (offset, length) ranges are cached, using as few requests as possible."""
+        needed = set()
+        for offset, length in ranges:
+            end = min(offset + length, self.size)
+            if offset < end:
+                needed.update(range(offset // self.block_size, (end - 1) // self.block_size + 1))
+
+        with self._lock:
+            missing = sorted(index for index in needed if index not in self._blocks)
+            self._stats["block_hits"] += len(needed) - len(missing)
+            self._stats["block_misses"] += len(missing)
+        for first, last in self._coalesce(missing):
+            blocks = self._fetch_run(first, last)
+            with self._lock:
+                for index, block in zip(range(first, last + 1), blocks):
+                    self._blocks[index] = block
+                    self._blocks.move_to_end(index)
+                while len(self._blocks) > max(self.max_cached_blocks, len(needed)):
+                    self._blocks.popitem(last=False)
+
+    def _coalesce(self, missing: List[int]) -> List[Tuple[int, int]]:
+        """Groups sorted block indices into inclusive runs, bridging gaps of up to coalesce_gap_blocks."""
+        runs = []
+        for index in missing:
+            if runs and index - runs[-1][1] <= self.coalesce_gap_blocks + 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        return [(first, last) for first, last in runs]
+
+    def _fetch_run(self, first: int, last: int) -> List[bytes]:
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size)
+        data = self.source.read_range(start, end)
+        with self._lock:
+            self._stats["range_requests"] += 1
+            self._stats["bytes_fetched"] += len(data)
+        return [data[i:i + self.block_size] for i in range(0, len(data), self.block_size)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "cached_blocks": len(self._blocks), "object_size": self.size}
@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from google.cloud import storage
+
+from app.common.trident_outputs import TRIDENT_CACHE_DIR
+
+EMBEDDINGS_CACHE_DIR = os.getenv("EMBEDDINGS_CACHE_DIR", os.path.join(TRIDENT_CACHE_DIR, "embeddings"))
+# "exact" always scans every vector; "ivfpq" searches the compressed cohort index when it is ready;
+# "auto" uses the index once the cohort has at least SIMILARITY_IVF_MIN_VECTORS patches.
+SIMILARITY_INDEX = os.getenv("SIMILARITY_INDEX", "auto")
+SIMILARITY_IVF_MIN_VECTORS = int(os.getenv("SIMILARITY_IVF_MIN_VECTORS", "200000"))
+SIMILARITY_IVF_PROBE = int(os.getenv("SIMILARITY_IVF_PROBE", "16"))
+SIMILARITY_PQ_SUBVECTORS = int(os.getenv("SIMILARITY_PQ_SUBVECTORS", "16"))
+# Candidates from the compressed index that are re-scored exactly before the top k is returned.
+SIMILARITY_RERANK = int(os.getenv("SIMILARITY_RERANK", "256"))
+# Seconds a slide found without embeddings is remembered as such; it may be re-ingested with them.
+EMBEDDINGS_MISSING_TTL = float(os.getenv("EMBEDDINGS_MISSING_TTL", "60"))
+# Slides whose embeddings are downloaded at once when a cohort query finds them uncached.
+EMBEDDINGS_DOWNLOAD_WORKERS = int(os.getenv("EMBEDDINGS_DOWNLOAD_WORKERS", "8"))
+
+# Rows scored per matrix product, which bounds the float32 copy of a memory-mapped slide.
+_SCAN_ROWS = 65536
+
+_storage_client = None
+
+
+def _get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+class SlideEmbeddings:
+    """A slide's patch embeddings (memory-mapped float16 rows) and the level-0 origin of each patch."""
+
+    def __init__(self, slide_id: str, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.slide_id = slide_id
+        self.encoder = meta["encoder"]
+        self.patch_size = meta["patch_size_level0"]
+        self.vectors = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.coords = np.load(os.path.join(directory, "coords.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def overlapping(self, x: float, y: float, width: float, height: float) -> np.ndarray:
+        """Row indices of the patches overlapping a level-0 rectangle."""
+        px, py = self.coords[:, 0], self.coords[:, 1]
+        return np.flatnonzero((px < x + width) & (px + self.patch_size > x) & (py < y + height) & (py + self.patch_size > y))
+
+
+# (expiry or None, embeddings) per (Trident output path, encoder); slides without embeddings expire.
+_slide_embeddings: "OrderedDict[Tuple[str, str], Tuple[Optional[float], Optional[SlideEmbeddings]]]" = OrderedDict()
+# Loads in progress, so concurrent requests for a slide share one download.
+_slide_embeddings_loading: Dict[Tuple[str, str], Future] = {}
+_slide_embeddings_lock = threading.Lock()
+
+
+def _download_slide_embeddings(slide_id: str, trident_output_path: str, encoder: str) -> Optional[SlideEmbeddings]:
+    """Downloads a slide's embeddings unless they are on local disk. Returns None if the slide has none."""
+    bucket_name, prefix = trident_output_path.replace("gs://", "").split("/", 1)
+    local_dir = os.path.join(EMBEDDINGS_CACHE_DIR, bucket_name, prefix, encoder)
+    if not os.path.exists(os.path.join(local_dir, "meta.json")):
+        bucket = _get_storage_client().bucket(bucket_name)
+        blobs = {os.path.basename(blob.name): blob for blob in bucket.list_blobs(prefix=f"{prefix.rstrip('/')}/embeddings/{encoder}/")}
+        if "meta.json" not in blobs:
+            return None
+        os.makedirs(local_dir, exist_ok=True)
+        # meta.json is written last, so its presence marks a complete download. Part files are
+        # unique, so processes sharing the cache directory never write the same one.
+        for name in ("embeddings.npy", "coords.npy", "meta.json"):
+            part = os.path.join(local_dir, f"{name}.{uuid.uuid4().hex}.part")
+            blobs[name].download_to_filename(part)
+            os.replace(part, os.path.join(local_dir, name))
+    return SlideEmbeddings(slide_id, local_dir)
+
+
+def load_slide_embeddings(slide_id: str, trident_output_path: Optional[str], encoder: str) -> Optional[SlideEmbeddings]:
+    """
+    Returns a slide's embeddings for `encoder`, downloading them from its Trident output on first
+    use, or None if ingestion did not extract them. Embeddings are memoized; a slide without them
+    is rechecked after EMBEDDINGS_MISSING_TTL, and a failed download on the next call.
+    """
+    if not trident_output_path:
+        return None
+    key = (trident_output_path, encoder)
+    with _slide_embeddings_lock:
+        entry = _slide_embeddings.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+            _slide_embeddings.move_to_end(key)
+            return entry[1]
+        future = _slide_embeddings_loading.get(key)
+        leader = future is None
+        if leader:
+            future = _slide_embeddings_loading[key] = Future()
+    if not leader:
+        return future.result()
+
+    cached = True
+    try:
+        embeddings = _download_slide_embeddings(slide_id, trident_output_path, encoder)
+    except Exception as e:
+        print(f"Could not load {encoder} embeddings for {slide_id}: {e}")
+        embeddings, cached = None, False
+    with _slide_embeddings_lock:
+        del _slide_embeddings_loading[key]
+        if cached:
+            _slide_embeddings[key] = (None if embeddings is not None else time.monotonic() + EMBEDDINGS_MISSING_TTL, embeddings)
+            _slide_embeddings.move_to_end(key)
+            while len(_slide_embeddings) > 256:
+                _slide_embeddings.popitem(last=False)
+    future.set_result(embeddings)
+    return embeddings
+
+
+def load_cohort_embeddings(slides: List[dict], encoder: str) -> List[SlideEmbeddings]:
+    """Embeddings of every catalog slide that has them, downloading uncached ones in parallel."""
+    if not slides:
+        return []
+    with ThreadPoolExecutor(max_workers=min(EMBEDDINGS_DOWNLOAD_WORKERS, len(slides)), thread_name_prefix="embeddings") as executor:
+        loaded = executor.map(lambda slide: load_slide_embeddings(slide["slide_id"], slide["trident_output_path"], encoder), slides)
+        return [embeddings for embeddings in loaded if embeddings is not None]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def query_vector(vectors: np.ndarray) -> np.ndarray:
+    """Unit query vector for a region: the mean direction of its patches' embeddings."""
+    return _normalize(_normalize(vectors).mean(axis=0))
+
+
+def _merge_top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[keep], ids[keep]
+    order = np.argsort(-scores, kind="stable")
+    return scores[order], ids[order]
+
+
+def cosine_top_k(vectors: np.ndarray, query: np.ndarray, k: int, exclude: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-k cosine similarity of a unit `query` against `vectors`, scanned in blocks so a
+    memory-mapped float16 matrix is never copied whole. Returns (scores, row indices), best first.
+    """
+    best_scores = np.empty(0, dtype=np.float32)
+    best_ids = np.empty(0, dtype=np.int64)
+    for start in range(0, len(vectors), _SCAN_ROWS):
+        block = _normalize(vectors[start:start + _SCAN_ROWS])
+        scores = block @ query
+        if exclude is not None and len(exclude):
+            local = exclude[(exclude >= start) & (exclude < start + len(block))] - start
+            scores[local] = -np.inf
+        ids = np.arange(start, start + len(block))
+        best_scores, best_ids = _merge_top_k(np.concatenate([best_scores, scores]), np.concatenate([best_ids, ids]), k)
+    finite = np.isfinite(best_scores)
+    return best_scores[finite], best_ids[finite]
+
+
+def _kmeans(data: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means with Euclidean distance; returns the centroids."""
+    rng = np.random.default_rng(seed)
+    clusters = min(clusters, len(data))
+    centroids = data[rng.choice(len(data), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=clusters)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Empty clusters are reseeded from random points.
+        if not filled.all():
+            centroids[~filled] = data[rng.choice(len(data), int((~filled).sum()))]
+    return centroids
+
+
+def _nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid for each row, computed in blocks."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), 16384):
+        block = data[start:start + 16384]
+        assignment[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignment
+
+
+class IVFPQIndex:
+    """
+    Inverted-file index with product-quantized residuals over a cohort's unit embeddings, for
+    approximate inner-product search when an exact scan is too slow.
+
+    Vectors are assigned to the nearest of `nlist` coarse centroids, and the residual from that
+    centroid is split into `m` subvectors, each stored as one byte (its nearest of 256 codewords).
+    A query scores only the lists whose centroids are closest, using per-subspace lookup tables:
+    q·x ≈ q·centroid + Σ q_j·codeword_j. The best candidates are then re-scored exactly.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.slide_ids: List[str] = meta["slide_ids"]
+        self.fingerprint = meta["fingerprint"]
+        self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        self.codebooks = np.load(os.path.join(directory, "codebooks.npy"))
+        self.codes = np.load(os.path.join(directory, "codes.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.refs = np.load(os.path.join(directory, "refs.npy"), mmap_mode="r")
+
+    @staticmethod
+    def build(slides: List[SlideEmbeddings], fingerprint: str, directory: str, sample_size: int = 100000, seed: int = 0):
+        """Trains the coarse centroids and codebooks on a sample of the cohort and encodes every vector."""
+        rng = np.random.default_rng(seed)
+        total = sum(len(slide) for slide in slides)
+        dim = slides[0].vectors.shape[1]
+        m = max(d for d in range(1, SIMILARITY_PQ_SUBVECTORS + 1) if dim % d == 0)
+        nlist = int(min(4096, max(1, 4 * np.sqrt(total))))
+
+        # Training sample drawn proportionally from every slide.
+        sample = np.concatenate([
+            _normalize(slide.vectors[np.sort(rng.choice(len(slide), min(len(slide), max(1, len(slide) * sample_size // total)), replace=False))])
+            for slide in slides if len(slide)
+        ])
+        centroids = _kmeans(sample, nlist, seed=seed)
+        residuals = sample - centroids[_nearest(sample, centroids)]
+        sub = dim // m
+        codebooks = np.stack([_kmeans(residuals[:, j * sub:(j + 1) * sub], 256, seed=seed + j) for j in range(m)])
+
+        lists = np.empty(total, dtype=np.int32)
+        codes = np.empty((total, m), dtype=np.uint8)
+        refs = np.empty((total, 2), dtype=np.int32)  # (slide index, row)
+        position = 0
+        for slide_index, slide in enumerate(slides):
+            for start in range(0, len(slide), _SCAN_ROWS):
+                block = _normalize(slide.vectors[start:start + _SCAN_ROWS])
+                end = position + len(block)
+                assignment = _nearest(block, centroids)
+                block_residuals = block - centroids[assignment]
+                lists[position:end] = assignment
+                for j in range(m):
+                    codes[position:end, j] = _nearest(block_residuals[:, j * sub:(j + 1) * sub], codebooks[j])
+                refs[position:end, 0] = slide_index
+                refs[position:end, 1] = np.arange(start, start + len(block))
+                position = end
+
+        order = np.argsort(lists, kind="stable")
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(directory, "codebooks.npy"), codebooks.astype(np.float32))
+        np.save(os.path.join(directory, "codes.npy"), codes[order])
+        np.save(os.path.join(directory, "refs.npy"), refs[order])
+        np.save(os.path.join(directory, "offsets.npy"), np.searchsorted(lists[order], np.arange(len(centroids) + 1)).astype(np.int64))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"fingerprint": fingerprint, "slide_ids": [slide.slide_id for slide in slides], "vectors": total, "nlist": len(centroids), "m": m}, f)
+
+    def candidates(self, query: np.ndarray, count: int, nprobe: int = SIMILARITY_IVF_PROBE) -> np.ndarray:
+        """(slide index, row) of the `count` best approximate matches, best first."""
+        coarse = self.centroids @ query
+        probe = np.argsort(-coarse)[:nprobe]
+        m, _, sub = self.codebooks.shape
+        lookup = np.einsum("jcs,js->jc", self.codebooks, query.reshape(m, sub))
+        scores, refs = [], []
+        for list_id in probe:
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            codes = np.asarray(self.codes[start:end])
+            scores.append(coarse[list_id] + lookup[np.arange(m), codes].sum(axis=1))
+            refs.append(np.arange(start, end))
+        if not scores:
+            return np.empty((0, 2), dtype=np.int32)
+        _, positions = _merge_top_k(np.concatenate(scores), np.concatenate(refs), count)
+        return np.asarray(self.refs[np.sort(positions)])
+
+
+def cohort_fingerprint(slides: List[SlideEmbeddings]) -> str:
+    """Identifies a cohort's contents, so its index is rebuilt when slides are added or re-ingested."""
+    digest = hashlib.sha1()
+    for slide in sorted(slides, key=lambda slide: slide.slide_id):
+        digest.update(f"{slide.slide_id}:{slide.encoder}:{len(slide)};".encode())
+    return digest.hexdigest()
+
+
+class CohortIndexManager:
+    """Keeps the cohort's IVF-PQ index on disk and builds a new one in the background when the cohort changes."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._index: Optional[IVFPQIndex] = None
+        self._building: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _build(self, slides: List[SlideEmbeddings], fingerprint: str):
+        directory = os.path.join(self.directory, fingerprint)
+        try:
+            if not os.path.exists(os.path.join(directory, "meta.json")):
+                staging = f"{directory}.tmp-{uuid.uuid4().hex}"
+                IVFPQIndex.build(slides, fingerprint, staging)
+                try:
+                    os.rename(staging, directory)
+                except OSError:
+                    shutil.rmtree(staging, ignore_errors=True)
+            index = IVFPQIndex(directory)
+            with self._lock:
+                self._index = index
+            print(f"Cohort similarity index {fingerprint[:12]} ready ({sum(len(slide) for slide in slides)} vectors)")
+        except Exception as e:
+            print(f"Could not build cohort similarity index: {e}")
+        finally:
+            with self._lock:
+                self._building = None
+
+    def get(self, slides: List[SlideEmbeddings]) -> Optional[IVFPQIndex]:
+        """Returns the index for exactly this cohort, or None (starting a background build) if it is not ready."""
+        fingerprint = cohort_fingerprint(slides)
+        with self._lock:
+            if self._index is not None and self._index.fingerprint == fingerprint:
+                return self._index
+            if self._building is None:
+                self._building = fingerprint
+                threading.Thread(target=self._build, args=(slides, fingerprint), name="cohort-index", daemon=True).start()
+        return None
+
+
+cohort_index = CohortIndexManager(os.path.join(EMBEDDINGS_CACHE_DIR, "cohort_index"))
+
+
+def search(slides: List[SlideEmbeddings], query: np.ndarray, k: int, exclude: Optional[Tuple[str, np.ndarray]] = None) -> Tuple[List[Tuple[str, int, float]], str]:
+    """
+    Top-k most similar patches to a unit `query` across `slides`. `exclude` is (slide_id, rows) of
+    patches to leave out, such as the query region itself. Returns ([(slide_id, row, score)], method).
+    """
+    total = sum(len(slide) for slide in slides)
+    use_index = SIMILARITY_INDEX == "ivfpq" or (SIMILARITY_INDEX == "auto" and total >= SIMILARITY_IVF_MIN_VECTORS)
+    index = cohort_index.get(slides) if use_index and len(slides) > 1 else None
+
+    if index is not None:
+        by_id = {slide.slide_id: slide for slide in slides}
+        refs = index.candidates(query, max(k, SIMILARITY_RERANK) + (len(exclude[1]) if exclude else 0))
+        scores, owners, rows = [], [], []
+        for slide_index in np.unique(refs[:, 0]):
+            slide = by_id[index.slide_ids[slide_index]]
+            slide_rows = refs[refs[:, 0] == slide_index, 1]
+            if exclude is not None and slide.slide_id == exclude[0]:
+                slide_rows = np.setdiff1d(slide_rows, exclude[1])
+            scores.append(_normalize(slide.vectors[np.sort(slide_rows)]) @ query)
+            owners.extend([slide.slide_id] * len(slide_rows))
+            rows.append(np.sort(slide_rows))
+        if not scores:
+            return [], "ivfpq"
+        owners = np.array(owners)
+        best, positions = _merge_top_k(np.concatenate(scores), np.arange(len(owners)), k)
+        all_rows = np.concatenate(rows)
+        return [(str(owners[p]), int(all_rows[p]), float(score)) for p, score in zip(positions, best)], "ivfpq"
+
+    scores, owners, rows = [], [], []
+    for slide in slides:
+        slide_exclude = exclude[1] if exclude is not None and slide.slide_id == exclude[0] else None
+        slide_scores, slide_rows = cosine_top_k(slide.vectors, query, k, slide_exclude)
+        scores.append(slide_scores)
+        rows.append(slide_rows)
+        owners.extend([slide.slide_id] * len(slide_rows))
+    if not owners:
+        return [], "exact"
+    best, positions = _merge_top_k(np.concatenate(scores), np.arange(len(owners)), k)
+    all_rows = np.concatenate(rows)
+    return [(owners[p], int(all_rows[p]), float(score)) for p, score in zip(positions, best)], "exact"
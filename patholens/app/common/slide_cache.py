@@ -0,0 +1,227 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import openslide
+from google.cloud import storage
+
+from app.common.stats_registry import register_stats
+
+
+class _PooledHandle:
+    """An open OpenSlide handle plus the bookkeeping needed to close it safely."""
+
+    def __init__(self, slide: openslide.OpenSlide):
+        self.slide = slide
+        self.refcount = 0
+        self.evicted = False
+
+
+class SlideCache:
+    """
+    Process-wide WSI access layer.
+
+    Slides are downloaded once from GCS into a size-bounded local directory (LRU eviction),
+    and open OpenSlide handles are pooled per slide URI. OpenSlide handles are safe to share
+    between threads, so callers only hold a reference while they read.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_open_handles: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_open_handles = max_open_handles
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # local path -> size in bytes
+        self._handles: "OrderedDict[str, _PooledHandle]" = OrderedDict()  # slide URI -> handle
+        self._download_locks: Dict[str, threading.Lock] = {}
+        self._storage_client = None
+        self._stats = {
+            "disk_hits": 0,
+            "disk_misses": 0,
+            "handle_hits": 0,
+            "handle_misses": 0,
+            "disk_evictions": 0,
+            "handle_evictions": 0,
+            "bytes_downloaded": 0,
+        }
+        self._load_existing_files()
+
+    def _load_existing_files(self):
+        """Re-indexes slides left on disk by a previous process, oldest access first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".part") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._files[path] = size
+        self._evict_files()
+
+    def _get_storage_client(self) -> storage.Client:
+        if self._storage_client is None:
+            try:
+                self._storage_client = storage.Client()
+            except Exception as e:
+                raise ConnectionError(f"GCS client is not available: {e}")
+        return self._storage_client
+
+    def local_path(self, slide_gcs_uri: str) -> str:
+        """Returns the cache path for a slide. The extension is kept so OpenSlide can detect the format."""
+        digest = hashlib.sha1(slide_gcs_uri.encode("utf-8")).hexdigest()
+        _, ext = os.path.splitext(slide_gcs_uri)
+        return os.path.join(self.cache_dir, f"{digest}{ext.lower()}")
+
+    def is_cached(self, slide_gcs_uri: str) -> bool:
+        """Returns True if the slide is already on local disk."""
+        with self._lock:
+            return self.local_path(slide_gcs_uri) in self._files
+
+    def ensure_local(self, slide_gcs_uri: str) -> str:
+        """Downloads the slide into the cache if needed and returns its local path."""
+        path = self.local_path(slide_gcs_uri)
+        with self._lock:
+            if path in self._files:
+                self._files.move_to_end(path)
+                self._stats["disk_hits"] += 1
+                return path
+            download_lock = self._download_locks.setdefault(path, threading.Lock())
+
+        # Only one thread downloads a given slide; the others wait and then hit the cache.
+        with download_lock:
+            with self._lock:
+                if path in self._files:
+                    self._files.move_to_end(path)
+                    self._stats["disk_hits"] += 1
+                    return path
+                self._stats["disk_misses"] += 1
+
+            bucket_name, blob_name = slide_gcs_uri.replace("gs://", "").split("/", 1)
+            blob = self._get_storage_client().bucket(bucket_name).blob(blob_name)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+            os.close(fd)
+            try:
+                blob.download_to_filename(tmp_path)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            size = os.path.getsize(path)
+
+            with self._lock:
+                self._files[path] = size
+                self._stats["bytes_downloaded"] += size
+                self._download_locks.pop(path, None)
+                self._evict_files(keep=path)
+        return path
+
+    def _evict_files(self, keep: Optional[str] = None):
+        """Drops least recently used slides until the cache fits in max_bytes. Caller holds the lock."""
+        in_use = {self.local_path(uri) for uri, handle in self._handles.items() if handle.refcount > 0}
+        total = sum(self._files.values())
+        for path in list(self._files):
+            if total <= self.max_bytes:
+                break
+            if path == keep or path in in_use:
+                continue
+            for uri in [uri for uri in self._handles if self.local_path(uri) == path]:
+                self._evict_handle(uri)
+            total -= self._files.pop(path)
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Could not remove cached slide {path}: {e}")
+            self._stats["disk_evictions"] += 1
+
+    def _evict_handle(self, slide_gcs_uri: str):
+        """Removes a handle from the pool, closing it now or when its last user releases it."""
+        handle = self._handles.pop(slide_gcs_uri)
+        handle.evicted = True
+        self._stats["handle_evictions"] += 1
+        if handle.refcount == 0:
+            handle.slide.close()
+
+    def _acquire(self, slide_gcs_uri: str) -> _PooledHandle:
+        with self._lock:
+            handle = self._handles.get(slide_gcs_uri)
+            if handle is not None:
+                self._handles.move_to_end(slide_gcs_uri)
+                path = self.local_path(slide_gcs_uri)
+                if path in self._files:
+                    self._files.move_to_end(path)
+                handle.refcount += 1
+                self._stats["handle_hits"] += 1
+                return handle
+
+        path = self.ensure_local(slide_gcs_uri)
+        slide = openslide.OpenSlide(path)
+
+        with self._lock:
+            handle = self._handles.get(slide_gcs_uri)
+            if handle is not None:
+                # Another thread opened the same slide concurrently; keep the pooled one.
+                slide.close()
+                self._stats["handle_hits"] += 1
+            else:
+                handle = _PooledHandle(slide)
+                self._handles[slide_gcs_uri] = handle
+                self._stats["handle_misses"] += 1
+                while len(self._handles) > self.max_open_handles:
+                    self._evict_handle(next(iter(self._handles)))
+            handle.refcount += 1
+            return handle
+
+    def _release(self, handle: _PooledHandle):
+        with self._lock:
+            handle.refcount -= 1
+            if handle.evicted and handle.refcount == 0:
+                handle.slide.close()
+
+    @contextmanager
+    def open_slide(self, slide_gcs_uri: str):
+        """Yields a pooled OpenSlide handle for a GCS slide URI."""
+        handle = self._acquire(slide_gcs_uri)
+        try:
+            yield handle.slide
+        finally:
+            self._release(handle)
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and current cache occupancy."""
+        with self._lock:
+            return {
+                **self._stats,
+                "cached_slides": len(self._files),
+                "cached_bytes": sum(self._files.values()),
+                "max_bytes": self.max_bytes,
+                "open_handles": len(self._handles),
+                "max_open_handles": self.max_open_handles,
+            }
+
+
+slide_cache_instance = None
+_slide_cache_lock = threading.Lock()
+
+
+def get_slide_cache() -> SlideCache:
+    """Lazy initializer for the shared slide cache, configured from environment variables."""
+    global slide_cache_instance
+    with _slide_cache_lock:
+        if slide_cache_instance is None:
+            slide_cache_instance = SlideCache(
+                cache_dir=os.getenv("WSI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "patholens_wsi_cache")),
+                max_bytes=int(os.getenv("WSI_CACHE_MAX_BYTES", str(20 * 1024 ** 3))),
+                max_open_handles=int(os.getenv("WSI_MAX_OPEN_SLIDES", "16")),
+            )
+    return slide_cache_instance
+
+
+register_stats("slide-cache", lambda: get_slide_cache().stats())
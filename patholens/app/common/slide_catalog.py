@@ -0,0 +1,199 @@
+import base64
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from google.cloud import firestore
+
+from app.common.firestore_store import get_firestore_client
+from app.common.stats_registry import register_stats
+
+# Catalog fields a client can ask for, and the slide_metadata field each one is read from. Only these
+# are fetched (server-side projection), never the full documents.
+CATALOG_FIELDS = {
+    "filename": "original_filename",
+    "processing_status": "processing_status",
+    "status_details": "status_details",
+    "last_updated": "last_updated",
+    "trident_output_path": "trident_output_path",
+}
+SORT_FIELDS = ("slide_id", "filename", "last_updated")
+DEFAULT_LIST_FIELDS = ("slide_id", "filename")
+
+# The snapshot is brought up to date (with a query for documents updated since the last refresh) when a
+# request finds it older than this.
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "5"))
+# Full reloads pick up deleted documents and documents without `last_updated`.
+CATALOG_FULL_REFRESH_SECONDS = float(os.getenv("CATALOG_FULL_REFRESH_SECONDS", "3600"))
+
+
+def _entry(doc_id: str, data: dict) -> dict:
+    entry = {"slide_id": doc_id}
+    for name, source in CATALOG_FIELDS.items():
+        value = data.get(source)
+        if name == "last_updated" and value is not None:
+            value = value.isoformat()
+        entry[name] = value
+    if entry["filename"] is None:
+        entry["filename"] = "N/A"
+    return entry
+
+
+def encode_cursor(entry: dict, sort: str) -> str:
+    """Opaque cursor pointing just past `entry` in the `sort` order."""
+    field = sort.lstrip("-")
+    return base64.urlsafe_b64encode(json.dumps([entry.get(field) or "", entry["slide_id"]]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        value, slide_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(value), str(slide_id)
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+
+class SlideCatalog:
+    """
+    In-process snapshot of the slide catalog: a few projected fields of every slide_metadata document.
+
+    The first request loads the whole collection; later requests older than `refresh_seconds` only
+    read documents whose `last_updated` moved past the newest one seen, and every
+    `full_refresh_seconds` the snapshot is rebuilt. Pages are served from memory in keyset order, and
+    each snapshot has a content digest used for ETags, so an unchanged catalog costs a 304.
+    """
+
+    def __init__(self, refresh_seconds: float = CATALOG_REFRESH_SECONDS, full_refresh_seconds: float = CATALOG_FULL_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self._entries: Dict[str, dict] = {}
+        self._watermark = None
+        self._refreshed_at = 0.0
+        self._full_refreshed_at = 0.0
+        self._digest = ""
+        # Sort keys per sort field, rebuilt lazily after the snapshot changes.
+        self._orders: Dict[str, List[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {"full_refreshes": 0, "incremental_refreshes": 0, "documents_read": 0, "requests": 0}
+
+    def _query(self, since=None):
+        query = get_firestore_client().collection("slide_metadata")
+        if since is not None:
+            # >= so documents sharing the watermark's timestamp are not missed; re-reading them is harmless.
+            query = query.where(filter=firestore.FieldFilter("last_updated", ">=", since))
+        return query.select(list(CATALOG_FIELDS.values())).stream()
+
+    def refresh(self, force_full: bool = False):
+        """Brings the snapshot up to date. Only one thread refreshes; the others wait for it."""
+        with self._refresh_lock:
+            now = time.monotonic()
+            if not force_full and now - self._refreshed_at < self.refresh_seconds:
+                return
+            full = force_full or self._watermark is None or now - self._full_refreshed_at >= self.full_refresh_seconds
+            entries = {} if full else dict(self._entries)
+            watermark = None if full else self._watermark
+            read = 0
+            changed = full
+            for doc in self._query(None if full else self._watermark):
+                data = doc.to_dict() or {}
+                entry = _entry(doc.id, data)
+                if entries.get(doc.id) != entry:
+                    entries[doc.id] = entry
+                    changed = True
+                updated = data.get("last_updated")
+                if updated is not None and (watermark is None or updated > watermark):
+                    watermark = updated
+                read += 1
+
+            digest = self._digest
+            if changed:
+                digest = hashlib.sha1(json.dumps(sorted(entries.items()), sort_keys=True, default=str).encode()).hexdigest()
+            with self._lock:
+                if digest != self._digest:
+                    self._entries = entries
+                    self._orders = {}
+                    self._digest = digest
+                self._watermark = watermark
+                self._refreshed_at = now
+                if full:
+                    self._full_refreshed_at = now
+                self._stats["full_refreshes" if full else "incremental_refreshes"] += 1
+                self._stats["documents_read"] += read
+
+    def _order(self, field: str) -> List[Tuple[str, str]]:
+        """Ascending (value, slide_id) keys for a sort field. Caller holds the lock."""
+        order = self._orders.get(field)
+        if order is None:
+            order = sorted((entry.get(field) or "", slide_id) for slide_id, entry in self._entries.items())
+            self._orders[field] = order
+        return order
+
+    def page(
+        self,
+        status: Optional[str] = "complete",
+        search: Optional[str] = None,
+        sort: str = "slide_id",
+        fields=DEFAULT_LIST_FIELDS,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[dict], Optional[str], str]:
+        """
+        Returns (items, next cursor or None, snapshot digest) for one page of slides matching
+        `status` (None for any) and a case-insensitive `search` on slide ID and filename.
+        """
+        self.refresh()
+        field = sort.lstrip("-")
+        descending = sort.startswith("-")
+        needle = search.lower() if search else None
+        with self._lock:
+            self._stats["requests"] += 1
+            order = self._order(field)
+            if descending:
+                end = bisect.bisect_left(order, decode_cursor(cursor)) if cursor else len(order)
+                keys = (order[i] for i in range(end - 1, -1, -1))
+            else:
+                start = bisect.bisect_right(order, decode_cursor(cursor)) if cursor else 0
+                keys = (order[i] for i in range(start, len(order)))
+            items = []
+            last = None
+            has_more = False
+            for _, slide_id in keys:
+                entry = self._entries[slide_id]
+                if status is not None and entry["processing_status"] != status:
+                    continue
+                if needle and needle not in slide_id.lower() and needle not in entry["filename"].lower():
+                    continue
+                if len(items) == limit:
+                    has_more = True
+                    break
+                items.append({name: entry[name] for name in fields})
+                last = entry
+            digest = self._digest
+        return items, encode_cursor(last, sort) if has_more else None, digest
+
+    def slides(self, status: Optional[str] = "complete") -> List[dict]:
+        """Every catalog entry with `status` (None for any), in slide ID order."""
+        self.refresh()
+        with self._lock:
+            return [
+                dict(self._entries[slide_id]) for _, slide_id in self._order("slide_id")
+                if status is None or self._entries[slide_id]["processing_status"] == status
+            ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "slides": len(self._entries),
+                "digest": self._digest,
+                "snapshot_age_seconds": round(time.monotonic() - self._refreshed_at, 3) if self._refreshed_at else None,
+            }
+
+
+slide_catalog = SlideCatalog()
+register_stats("slide-catalog", slide_catalog.stats)
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+from app.common.stats_registry import register_stats
+
+
+class SlideIOOverloaded(Exception):
+    """Raised when a slide I/O pool's queue is full. Callers should retry after `retry_after` seconds."""
+
+    def __init__(self, pool_name: str, retry_after: int):
+        super().__init__(f"Slide I/O pool '{pool_name}' is overloaded; retry after {retry_after}s.")
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+_worker_state = threading.local()
+
+
+class BoundedSlidePool:
+    """
+    Thread pool with a limit on concurrent tasks per slide and on the number of queued tasks.
+
+    Tasks beyond a slide's limit wait in a per-slide queue without occupying a worker thread, so one
+    slow slide cannot starve the others. When the total number of pending tasks reaches
+    `max_workers + max_queue`, new submissions are rejected with SlideIOOverloaded.
+    """
+
+    def __init__(self, name: str, max_workers: int, per_slide_limit: int, max_queue: int, retry_after: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.per_slide_limit = per_slide_limit
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"slide-io-{name}")
+        self._lock = threading.Lock()
+        self._active: Dict[Hashable, int] = defaultdict(int)
+        self._waiting: Dict[Hashable, Deque] = defaultdict(deque)
+        self._pending = 0
+        self._stats = {"submitted": 0, "completed": 0, "rejected": 0, "deferred": 0}
+
+    def submit(self, slide_key: Optional[Hashable], fn: Callable, *args, **kwargs) -> Future:
+        """Schedules `fn`. A `slide_key` of None is not subject to the per-slide limit."""
+        future = Future()
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._stats["rejected"] += 1
+                raise SlideIOOverloaded(self.name, self.retry_after)
+            self._pending += 1
+            self._stats["submitted"] += 1
+            task = (future, fn, args, kwargs)
+            if slide_key is not None and self._active[slide_key] >= self.per_slide_limit:
+                self._waiting[slide_key].append(task)
+                self._stats["deferred"] += 1
+                return future
+            self._active[slide_key] += 1
+        self._executor.submit(self._run, slide_key, task)
+        return future
+
+    def _run(self, slide_key: Optional[Hashable], task):
+        future, fn, args, kwargs = task
+        _worker_state.pool = self
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            _worker_state.pool = None
+            self._task_done(slide_key)
+
+    def _task_done(self, slide_key: Optional[Hashable]):
+        with self._lock:
+            self._pending -= 1
+            self._stats["completed"] += 1
+            waiting = self._waiting.get(slide_key)
+            next_task = waiting.popleft() if waiting else None
+            if waiting is not None and not waiting:
+                del self._waiting[slide_key]
+            if next_task is None:
+                self._active[slide_key] -= 1
+                if self._active[slide_key] == 0:
+                    del self._active[slide_key]
+        if next_task is not None:
+            # The slide keeps its slot and hands it to the next waiting task.
+            self._executor.submit(self._run, slide_key, next_task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "pending": self._pending,
+                "active_slides": len(self._active),
+                "max_workers": self.max_workers,
+                "per_slide_limit": self.per_slide_limit,
+                "max_queue": self.max_queue,
+            }
+
+
+class SlideIOExecutor:
+    """
+    Execution layer for blocking slide I/O. Network fetches (GCS, Firestore) and decode/encode work
+    run on separate bounded pools, so a burst of CPU work cannot hold up fetches or vice versa.
+    """
+
+    POOLS = ("fetch", "decode")
+
+    def __init__(self, fetch_pool: BoundedSlidePool, decode_pool: BoundedSlidePool):
+        self._pools = {"fetch": fetch_pool, "decode": decode_pool}
+
+    def submit(self, kind: str, slide_key: Optional[Hashable], fn: Callable, *args, **kwargs) -> Future:
+        return self._pools[kind].submit(slide_key, fn, *args, **kwargs)
+
+    async def run(self, kind: str, slide_key: Optional[Hashable], fn: Callable, *args, **kwargs):
+        """Runs `fn` on the given pool and awaits its result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(kind, slide_key, fn, *args, **kwargs))
+
+    def call(self, kind: str, slide_key: Optional[Hashable], fn: Callable, *args, **kwargs):
+        """
+        Runs `fn` on the given pool and blocks for its result. Calls made from a worker of the same
+        pool run inline, so nested calls cannot deadlock the pool.
+        """
+        if getattr(_worker_state, "pool", None) is self._pools[kind]:
+            return fn(*args, **kwargs)
+        return self.submit(kind, slide_key, fn, *args, **kwargs).result()
+
+    def stats(self) -> dict:
+        return {kind: pool.stats() for kind, pool in self._pools.items()}
+
+
+slide_io_instance = None
+_slide_io_lock = threading.Lock()
+
+
+def get_slide_io() -> SlideIOExecutor:
+    """Lazy initializer for the shared slide I/O executor, configured from environment variables."""
+    global slide_io_instance
+    with _slide_io_lock:
+        if slide_io_instance is None:
+            per_slide_limit = int(os.getenv("SLIDE_IO_PER_SLIDE_LIMIT", "4"))
+            max_queue = int(os.getenv("SLIDE_IO_MAX_QUEUE", "256"))
+            retry_after = int(os.getenv("SLIDE_IO_RETRY_AFTER", "1"))
+            slide_io_instance = SlideIOExecutor(
+                fetch_pool=BoundedSlidePool(
+                    "fetch", int(os.getenv("SLIDE_IO_FETCH_WORKERS", "32")), per_slide_limit, max_queue, retry_after,
+                ),
+                decode_pool=BoundedSlidePool(
+                    "decode", int(os.getenv("SLIDE_IO_DECODE_WORKERS", str(min(8, (os.cpu_count() or 1) + 2)))),
+                    per_slide_limit, max_queue, retry_after,
+                ),
+            )
+    return slide_io_instance
+
+
+register_stats("slide-io", lambda: get_slide_io().stats())
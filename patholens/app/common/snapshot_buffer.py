@@ -0,0 +1,58 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from app.common.stats_registry import register_stats
+
+
+class SnapshotBuffer:
+    """
+    Byte-bounded LRU of model-ready snapshot images (see prepare_model_image), keyed by the URI the
+    agents pass around. It lets invoke_medgemma send a just-captured image inline instead of having
+    the endpoint download it from storage.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._images: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0}
+
+    def put(self, uri: str, image_bytes: bytes):
+        if len(image_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._images.pop(uri, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._images[uri] = image_bytes
+            self._bytes += len(image_bytes)
+            self._stats["stored"] += 1
+            while self._bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def get(self, uri: str) -> Optional[bytes]:
+        with self._lock:
+            image_bytes = self._images.get(uri)
+            if image_bytes is None:
+                self._stats["misses"] += 1
+                return None
+            self._images.move_to_end(uri)
+            self._stats["hits"] += 1
+            return image_bytes
+
+    def contains(self, uri: str) -> bool:
+        """Whether the buffer holds `uri`, without counting a lookup or refreshing its recency."""
+        with self._lock:
+            return uri in self._images
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._images), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+snapshot_buffer = SnapshotBuffer(max_bytes=int(os.getenv("SNAPSHOT_BUFFER_BYTES", str(64 * 1024 ** 2))))
+register_stats("snapshot-buffer", snapshot_buffer.stats)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import numpy as np
+
+from app.common.trident_outputs import TRIDENT_CACHE_DIR, load_patches
+
+TISSUE_INDEX_ENABLED = os.getenv("TISSUE_INDEX_ENABLED", "1") == "1"
+TISSUE_INDEX_DIR = os.getenv("TISSUE_INDEX_DIR", os.path.join(TRIDENT_CACHE_DIR, "index"))
+
+# Bumped when the on-disk layout changes, so stale indexes are rebuilt.
+INDEX_VERSION = 1
+
+
+class TissueIndex:
+    """
+    Grid-bucketed index of a slide's Trident tissue patches, stored as memory-mapped arrays.
+
+    The level-0 plane is divided into cells the size of a patch. `occupancy.npy` is the
+    summed-area table of the cells any patch overlaps, so "is there tissue in this rectangle?" is
+    four lookups. `coords.npy` holds the patches sorted by the cell of their top-left corner and
+    `offsets.npy` the start of each cell's run, so a rectangle query only visits nearby patches.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.patch_size = meta["patch_size"]
+        self.rows = meta["rows"]
+        self.cols = meta["cols"]
+        self.coords = np.load(os.path.join(directory, "coords.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.occupancy = np.load(os.path.join(directory, "occupancy.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    @staticmethod
+    def build(coords: np.ndarray, patch_size: int, directory: str):
+        """Writes the index files for level-0 patch `coords` into `directory`."""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        cell = int(patch_size)
+        extent = coords.max(axis=0) + cell if len(coords) else np.array([cell, cell])
+        cols, rows = int(-(-extent[0] // cell)), int(-(-extent[1] // cell))
+
+        # A patch overlaps at most two cells per axis because cells are patch-sized.
+        grid = np.zeros((rows, cols), dtype=np.uint8)
+        first = coords // cell
+        last = (coords + cell - 1) // cell
+        for row in (first[:, 1], last[:, 1]):
+            for col in (first[:, 0], last[:, 0]):
+                grid[np.clip(row, 0, rows - 1), np.clip(col, 0, cols - 1)] = 1
+        occupancy = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+        occupancy[1:, 1:] = grid.cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+
+        buckets = first[:, 1] * cols + first[:, 0]
+        order = np.argsort(buckets, kind="stable")
+        offsets = np.searchsorted(buckets[order], np.arange(rows * cols + 1)).astype(np.int64)
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "coords.npy"), coords[order].astype(np.int32))
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+        np.save(os.path.join(directory, "occupancy.npy"), occupancy)
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"version": INDEX_VERSION, "patch_size": cell, "rows": rows, "cols": cols, "patches": len(coords)}, f)
+
+    def _cells(self, x: float, y: float, width: float, height: float):
+        """Cell range [c0, c1) x [r0, r1) covering a level-0 rectangle, clipped to the grid."""
+        c0 = max(0, int(x // self.patch_size))
+        r0 = max(0, int(y // self.patch_size))
+        c1 = min(self.cols, int(-(-(x + width) // self.patch_size)))
+        r1 = min(self.rows, int(-(-(y + height) // self.patch_size)))
+        return c0, r0, c1, r1
+
+    def has_tissue(self, x: float, y: float, width: float, height: float) -> bool:
+        """True if any patch may overlap the level-0 rectangle. Answers at cell granularity, never missing tissue."""
+        c0, r0, c1, r1 = self._cells(x, y, width, height)
+        if c0 >= c1 or r0 >= r1:
+            return False
+        sat = self.occupancy
+        return int(sat[r1, c1]) - int(sat[r0, c1]) - int(sat[r1, c0]) + int(sat[r0, c0]) > 0
+
+    def query(self, x: float, y: float, width: float, height: float, limit: Optional[int] = None) -> np.ndarray:
+        """Level-0 origins of the patches overlapping a level-0 rectangle, in row-major order."""
+        c0, r0, c1, r1 = self._cells(x, y, width, height)
+        if c0 >= c1 or r0 >= r1:
+            return np.empty((0, 2), dtype=np.int32)
+        # Patches starting one cell up or left can still reach into the rectangle.
+        c0, r0 = max(0, c0 - 1), max(0, r0 - 1)
+        runs = [
+            self.coords[self.offsets[row * self.cols + c0]:self.offsets[row * self.cols + c1]]
+            for row in range(r0, r1)
+        ]
+        candidates = np.concatenate(runs) if runs else np.empty((0, 2), dtype=np.int32)
+        px, py = candidates[:, 0], candidates[:, 1]
+        hits = candidates[(px < x + width) & (px + self.patch_size > x) & (py < y + height) & (py + self.patch_size > y)]
+        return hits[:limit] if limit is not None else hits
+
+
+class TissueIndexRegistry:
+    """
+    Loads per-slide tissue indexes lazily, keyed by Trident output path. Indexes are built once
+    from Trident's coordinates and kept on disk; loaded ones stay memory-mapped in an LRU.
+    """
+
+    def __init__(self, directory: str, max_indexes: int = 256):
+        self.directory = directory
+        self.max_indexes = max_indexes
+        self._indexes: "OrderedDict[str, Optional[TissueIndex]]" = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tissue-index")
+        self._stats = {"loaded": 0, "built": 0, "unavailable": 0}
+
+    def _index_dir(self, trident_output_path: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(trident_output_path.encode()).hexdigest())
+
+    def _open(self, trident_output_path: str) -> Optional[TissueIndex]:
+        directory = self._index_dir(trident_output_path)
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                if json.load(f).get("version") == INDEX_VERSION:
+                    self._stats["loaded"] += 1
+                    return TissueIndex(directory)
+        except (OSError, ValueError):
+            pass
+
+        patches = load_patches(trident_output_path)
+        if patches is None:
+            self._stats["unavailable"] += 1
+            return None
+        # Built beside the final location and renamed into place, so readers never see a partial index.
+        staging = f"{directory}.tmp-{uuid.uuid4().hex}"
+        TissueIndex.build(patches[0], patches[1], staging)
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            # Another process installed the index first.
+            shutil.rmtree(staging, ignore_errors=True)
+        self._stats["built"] += 1
+        return TissueIndex(directory)
+
+    def _load(self, trident_output_path: str) -> Optional[TissueIndex]:
+        try:
+            index = self._open(trident_output_path)
+        except Exception as e:
+            print(f"Could not build tissue index for {trident_output_path}: {e}")
+            index = None
+        with self._lock:
+            self._indexes[trident_output_path] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+            self._loading.pop(trident_output_path, None)
+        return index
+
+    def _future(self, trident_output_path: str):
+        """Returns (index, None) if loaded, else (None, future of the load). Concurrent loads are collapsed."""
+        with self._lock:
+            if trident_output_path in self._indexes:
+                self._indexes.move_to_end(trident_output_path)
+                return self._indexes[trident_output_path], None
+            future = self._loading.get(trident_output_path)
+            if future is None:
+                future = self._executor.submit(self._load, trident_output_path)
+                self._loading[trident_output_path] = future
+            return None, future
+
+    def get(self, trident_output_path: Optional[str]) -> Optional[TissueIndex]:
+        """Returns the slide's index, loading or building it first if needed (blocking)."""
+        if not trident_output_path:
+            return None
+        index, future = self._future(trident_output_path)
+        return index if future is None else future.result()
+
+    def get_nowait(self, trident_output_path: Optional[str]) -> Optional[TissueIndex]:
+        """Returns the index if it is loaded; otherwise starts loading it in the background and returns None."""
+        if not trident_output_path:
+            return None
+        index, _ = self._future(trident_output_path)
+        return index
+
+    def stats(self) -> dict:
+        with self._lock:
+            resident = sum(1 for index in self._indexes.values() if index is not None)
+            return {**self._stats, "resident": resident, "loading": len(self._loading)}
+
+
+tissue_index_registry_instance = None
+_tissue_index_lock = threading.Lock()
+
+
+def get_tissue_index_registry() -> TissueIndexRegistry:
+    """Lazy initializer for the shared tissue index registry."""
+    global tissue_index_registry_instance
+    with _tissue_index_lock:
+        if tissue_index_registry_instance is None:
+            tissue_index_registry_instance = TissueIndexRegistry(TISSUE_INDEX_DIR)
+    return tissue_index_registry_instance
@@ -0,0 +1,29 @@
+import threading
+from typing import Callable, Dict, List, NamedTuple
+
+
+class StatsProvider(NamedTuple):
+    collect: Callable[[], dict]
+    # Providers that read a database or file are run off the event loop.
+    blocking: bool
+
+
+_providers: Dict[str, StatsProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def register_stats(name: str, collect: Callable[[], dict], blocking: bool = False):
+    """Registers a component's stats callable, served at `GET /stats/{name}`. Re-registering a name replaces it."""
+    with _providers_lock:
+        _providers[name] = StatsProvider(collect, blocking)
+
+
+def get_stats_provider(name: str):
+    """The provider registered under `name`, or None."""
+    with _providers_lock:
+        return _providers.get(name)
+
+
+def stats_names() -> List[str]:
+    with _providers_lock:
+        return sorted(_providers)
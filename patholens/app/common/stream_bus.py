@@ -0,0 +1,49 @@
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+
+class StreamBus:
+    """
+    Per-session fan-out of incremental messages (e.g. partial model output) to connected clients.
+
+    Subscribers are asyncio queues owned by an event loop. `publish` is thread-safe, so tools
+    running on worker threads can push messages that the websocket or SSE handlers then forward.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = defaultdict(list)
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        """Returns a queue receiving every message published for the session. Call from the event loop."""
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers[session_id].append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = [entry for entry in self._subscribers.get(session_id, []) if entry[1] is not queue]
+            if subscribers:
+                self._subscribers[session_id] = subscribers
+            else:
+                self._subscribers.pop(session_id, None)
+
+    def has_subscribers(self, session_id: str) -> bool:
+        with self._lock:
+            return bool(self._subscribers.get(session_id))
+
+    def publish(self, session_id: str, message: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(session_id, []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            except RuntimeError:
+                # The subscriber's loop is closed; it will unsubscribe on its way out.
+                pass
+
+
+stream_bus = StreamBus()
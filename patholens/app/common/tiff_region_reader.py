@@ -0,0 +1,265 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+import numpy as np
+import tifffile
+from PIL import Image
+from google.cloud import storage
+
+from app.common.range_reader import GcsRangeSource, RangeReader
+from app.common.stats_registry import register_stats
+
+# Formats that tifffile can read directly; everything else goes through OpenSlide.
+STREAMABLE_EXTENSIONS = (".svs", ".tif", ".tiff")
+
+
+class UnsupportedSlideError(Exception):
+    """Raised when a slide cannot be served by the streaming reader (e.g. untiled or non-pyramidal)."""
+
+
+class TiffRegionReader:
+    """
+    Reads regions of a tiled, pyramidal TIFF/SVS from a seekable file object.
+
+    Only the TIFF directory and the tiles overlapping a requested region are read, so with a
+    RangeReader underneath, the cost of a read depends on the region size and not the slide size.
+    Mirrors the parts of the OpenSlide API used by the service (`level_count`, `level_dimensions`,
+    `level_downsamples`, `properties`, `read_region`).
+    """
+
+    def __init__(self, fh: RangeReader):
+        self._fh = fh
+        self._tif = tifffile.TiffFile(fh)
+        series = self._tif.series[0]
+        self._pages = [level.keyframe for level in series.levels]
+        for page in self._pages:
+            if not page.is_tiled:
+                raise UnsupportedSlideError("Slide levels are not tiled.")
+            if page.planarconfig != tifffile.PLANARCONFIG.CONTIG or page.imagedepth != 1:
+                raise UnsupportedSlideError("Only contiguous 2D tiled images are supported.")
+
+        self.level_count = len(self._pages)
+        self.level_dimensions = tuple((page.imagewidth, page.imagelength) for page in self._pages)
+        base_width = self.level_dimensions[0][0]
+        self.level_downsamples = tuple(base_width / width for width, _ in self.level_dimensions)
+        self.tile_sizes = tuple((page.tilewidth, page.tilelength) for page in self._pages)
+        # Tile offsets can be loaded lazily by tifffile; materialize them now so reads never touch
+        # the shared file position from several threads.
+        self._offsets = [np.asarray(page.dataoffsets) for page in self._pages]
+        self._bytecounts = [np.asarray(page.databytecounts) for page in self._pages]
+        self._jpegtables = [page.jpegtables for page in self._pages]
+        self.properties = self._parse_properties()
+
+    def _parse_properties(self) -> dict:
+        """Extracts the OpenSlide-style properties we rely on from the Aperio description, if present."""
+        properties = {}
+        description = self._pages[0].description or ""
+        match = re.search(r"MPP\s*=\s*([0-9.]+)", description)
+        if match:
+            properties["openslide.mpp-x"] = match.group(1)
+            properties["openslide.mpp-y"] = match.group(1)
+        return properties
+
+    def get_best_level_for_downsample(self, downsample: float) -> int:
+        for level in range(self.level_count - 1, -1, -1):
+            if self.level_downsamples[level] <= downsample:
+                return level
+        return 0
+
+    def _region_tiles(self, location, level: int, size):
+        """Returns the region in level coordinates and the indices of the tiles overlapping it."""
+        page = self._pages[level]
+        downsample = self.level_downsamples[level]
+        left, top = int(location[0] / downsample), int(location[1] / downsample)
+        width, height = size
+        image_width, image_height = self.level_dimensions[level]
+        tile_width, tile_height = page.tilewidth, page.tilelength
+        tiles_across = (image_width + tile_width - 1) // tile_width
+
+        first_col, last_col = max(left, 0) // tile_width, min(left + width, image_width) - 1
+        first_row, last_row = max(top, 0) // tile_height, min(top + height, image_height) - 1
+        if last_col < 0 or last_row < 0:
+            return (left, top, width, height), []
+        indices = [
+            row * tiles_across + col
+            for row in range(first_row, last_row // tile_height + 1)
+            for col in range(first_col, last_col // tile_width + 1)
+        ]
+        return (left, top, width, height), indices
+
+    def prefetch_region(self, location, level: int, size):
+        """
+        Fetches the compressed tiles a region read needs, coalescing nearby ones into shared range
+        requests. This is the network half of read_region and can be scheduled separately.
+        """
+        _, indices = self._region_tiles(location, level, size)
+        offsets, bytecounts = self._offsets[level], self._bytecounts[level]
+        self._fh.prefetch(
+            (int(offsets[index]), int(bytecounts[index]))
+            for index in indices if bytecounts[index]
+        )
+
+    def read_region(self, location, level: int, size) -> Image.Image:
+        """
+        Reads an RGB region. `location` is in level-0 coordinates and `size` in pixels of `level`,
+        as with OpenSlide. Areas outside the image are filled with white.
+        """
+        (left, top, width, height), indices = self._region_tiles(location, level, size)
+        region = np.full((height, width, 3), 255, dtype=np.uint8)
+        if not indices:
+            return Image.fromarray(region, "RGB")
+        self.prefetch_region(location, level, size)
+
+        page = self._pages[level]
+        image_width, image_height = self.level_dimensions[level]
+        tile_width, tile_height = page.tilewidth, page.tilelength
+        tiles_across = (image_width + tile_width - 1) // tile_width
+        for index in indices:
+            row, col = divmod(index, tiles_across)
+            tile = self._decode_tile(level, index)
+            tile_left, tile_top = col * tile_width, row * tile_height
+            # Intersection of the tile and the requested region, in level coordinates.
+            x0, y0 = max(left, tile_left), max(top, tile_top)
+            x1 = min(left + width, tile_left + tile_width, image_width)
+            y1 = min(top + height, tile_top + tile_height, image_height)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            region[y0 - top:y1 - top, x0 - left:x1 - left] = tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+        return Image.fromarray(region, "RGB")
+
+    def _decode_tile(self, level: int, index: int) -> np.ndarray:
+        """Decodes one tile into an (tile_height, tile_width, 3) uint8 array."""
+        page = self._pages[level]
+        bytecount = int(self._bytecounts[level][index])
+        if not bytecount:
+            return np.full((page.tilelength, page.tilewidth, 3), 255, dtype=np.uint8)
+        data = self._fh.read_at(int(self._offsets[level][index]), bytecount)
+        segment, _, _ = page.decode(data, index, jpegtables=self._jpegtables[level])
+        # Segments are decoded as (depth, length, width, samples); drop the depth axis only.
+        tile = np.asarray(segment)[0]
+        if tile.shape[-1] == 1:
+            tile = np.repeat(tile, 3, axis=-1)
+        return tile[..., :3].astype(np.uint8, copy=False)
+
+    def close(self):
+        self._tif.close()
+
+
+class StreamingSlidePool:
+    """Keeps a bounded LRU of open streaming readers, keyed by slide URI."""
+
+    def __init__(self, max_open: int, block_size: int, max_cached_blocks: int):
+        self.max_open = max_open
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self._readers: "OrderedDict[str, TiffRegionReader]" = OrderedDict()
+        # Slides that must be read with OpenSlide, most recently seen last; bounded like the readers.
+        self._unsupported: "OrderedDict[str, None]" = OrderedDict()
+        self.max_unsupported = max(1024, max_open)
+        # Opens in progress, so concurrent requests for a cold slide wait for one open.
+        self._opening: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._storage_client = None
+
+    def _get_storage_client(self) -> storage.Client:
+        if self._storage_client is None:
+            try:
+                self._storage_client = storage.Client()
+            except Exception as e:
+                raise ConnectionError(f"GCS client is not available: {e}")
+        return self._storage_client
+
+    def get_reader(self, slide_gcs_uri: str) -> Optional[TiffRegionReader]:
+        """Returns a streaming reader for the slide, or None if the slide must be read with OpenSlide."""
+        if not slide_gcs_uri.lower().endswith(STREAMABLE_EXTENSIONS):
+            return None
+        with self._lock:
+            if slide_gcs_uri in self._unsupported:
+                self._unsupported.move_to_end(slide_gcs_uri)
+                return None
+            reader = self._readers.get(slide_gcs_uri)
+            if reader is not None:
+                self._readers.move_to_end(slide_gcs_uri)
+                return reader
+            future = self._opening.get(slide_gcs_uri)
+            opener = future is None
+            if opener:
+                future = self._opening[slide_gcs_uri] = Future()
+        if not opener:
+            return future.result()
+
+        # Opening reads the TIFF directory over the network, so it runs outside the pool lock.
+        try:
+            reader = self._open(slide_gcs_uri)
+        except BaseException as e:
+            with self._lock:
+                del self._opening[slide_gcs_uri]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._opening[slide_gcs_uri]
+            if reader is None:
+                self._unsupported[slide_gcs_uri] = None
+                while len(self._unsupported) > self.max_unsupported:
+                    self._unsupported.popitem(last=False)
+            else:
+                self._readers[slide_gcs_uri] = reader
+                while len(self._readers) > self.max_open:
+                    _, evicted = self._readers.popitem(last=False)
+                    evicted.close()
+        future.set_result(reader)
+        return reader
+
+    def _open(self, slide_gcs_uri: str) -> Optional[TiffRegionReader]:
+        """Opens a streaming reader, or returns None if the slide is not supported."""
+        source = GcsRangeSource(slide_gcs_uri, self._get_storage_client())
+        fh = RangeReader(source, block_size=self.block_size, max_cached_blocks=self.max_cached_blocks)
+        try:
+            return TiffRegionReader(fh)
+        except (UnsupportedSlideError, tifffile.TiffFileError) as e:
+            print(f"Streaming reader unavailable for {slide_gcs_uri}, falling back to OpenSlide: {e}")
+            return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            per_slide = {uri: reader._fh.stats() for uri, reader in self._readers.items()}
+        return {
+            "open_readers": len(per_slide),
+            "range_requests": sum(s["range_requests"] for s in per_slide.values()),
+            "bytes_fetched": sum(s["bytes_fetched"] for s in per_slide.values()),
+            "block_hits": sum(s["block_hits"] for s in per_slide.values()),
+            "block_misses": sum(s["block_misses"] for s in per_slide.values()),
+        }
+
+
+streaming_pool_instance = None
+_streaming_pool_lock = threading.Lock()
+
+
+def get_streaming_pool() -> Optional[StreamingSlidePool]:
+    """Lazy initializer for the streaming reader pool. Returns None when streaming is disabled."""
+    global streaming_pool_instance
+    if os.getenv("WSI_STREAMING", "1") == "0":
+        return None
+    with _streaming_pool_lock:
+        if streaming_pool_instance is None:
+            streaming_pool_instance = StreamingSlidePool(
+                max_open=int(os.getenv("WSI_MAX_STREAMING_SLIDES", "32")),
+                block_size=int(os.getenv("WSI_RANGE_BLOCK_SIZE", str(256 * 1024))),
+                max_cached_blocks=int(os.getenv("WSI_RANGE_CACHE_BLOCKS", "64")),
+            )
+    return streaming_pool_instance
+
+
+def _streaming_reader_stats() -> dict:
+    streaming_pool = get_streaming_pool()
+    if streaming_pool is None:
+        return {"enabled": False}
+    return {"enabled": True, **streaming_pool.stats()}
+
+
+register_stats("streaming-reader", _streaming_reader_stats)
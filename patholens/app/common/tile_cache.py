@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+import diskcache
+from PIL import Image
+
+from app.common.slide_io import SlideIOOverloaded, get_slide_io
+from app.common.tile_encoding import encode_image
+from app.common.stats_registry import register_stats
+
+
+class CachedTile(NamedTuple):
+    """Encoded tile bytes plus what is needed to serve them over HTTP."""
+    content: bytes
+    media_type: str
+    etag: str
+
+
+def make_tile_key(slide_id: str, level: int, x: int, y: int, width: int, height: int, fmt: str, quality: Optional[int] = None) -> str:
+    """Builds a cache key. Encoding parameters are part of the key so variants never collide."""
+    return f"tile:v1:{slide_id}:{level}:{x}:{y}:{width}x{height}:{fmt}:{quality if quality is not None else '-'}"
+
+
+def make_dzi_tile_key(slide_id: str, level: int, col: int, row: int, overlap: int, fmt: str, quality: Optional[int] = None) -> str:
+    """Builds a cache key for a Deep Zoom tile. The tile size is the slide's native one, so only the overlap varies."""
+    return f"dzi:v1:{slide_id}:{level}:{col}_{row}:{overlap}:{fmt}:{quality if quality is not None else '-'}"
+
+
+def compute_etag(content: bytes) -> str:
+    """Strong ETag derived from the encoded bytes."""
+    return '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+
+# Colour of tiles served for regions without tissue, as "R,G,B".
+TILE_BACKGROUND_COLOR = tuple(int(value) for value in os.getenv("TILE_BACKGROUND_COLOR", "255,255,255").split(","))
+
+# Result given to waiters when the caller producing a tile was cancelled; they retry the lookup.
+_ABANDONED = object()
+
+_background_tiles: Dict[Tuple[str, Optional[int], int, int], CachedTile] = {}
+
+
+def background_tile(fmt: str, quality: Optional[int], width: int, height: int) -> CachedTile:
+    """Returns the shared encoded background tile for a format and size, encoding it on first use."""
+    key = (fmt, quality, width, height)
+    tile = _background_tiles.get(key)
+    if tile is None:
+        content, media_type = encode_image(Image.new("RGB", (width, height), TILE_BACKGROUND_COLOR), fmt, quality)
+        tile = _background_tiles.setdefault(key, CachedTile(content, media_type, compute_etag(content)))
+    return tile
+
+
+class TileCache:
+    """
+    Two-tier cache of encoded tiles: a byte-bounded in-memory LRU in front of a persistent
+    diskcache store. Concurrent misses for the same key are collapsed into a single producer call.
+    Async callers only touch the memory tier on the event loop; disk reads and writes run on the
+    slide I/O fetch pool.
+    """
+
+    def __init__(self, max_memory_bytes: int, disk_dir: Optional[str], max_disk_bytes: int):
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: "OrderedDict[str, CachedTile]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = None
+        if disk_dir:
+            self._disk = diskcache.Cache(disk_dir, size_limit=max_disk_bytes, eviction_policy="least-recently-used")
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "abandoned": 0}
+
+    def _remember(self, key: str, tile: CachedTile):
+        """Adds a tile to the memory tier and evicts LRU entries. Caller holds the lock."""
+        if len(tile.content) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous.content)
+        self._memory[key] = tile
+        self._memory_bytes += len(tile.content)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.content)
+
+    def _get_memory(self, key: str) -> Optional[CachedTile]:
+        with self._lock:
+            tile = self._memory.get(key)
+            if tile is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+            return tile
+
+    def _get_disk(self, key: str) -> Optional[CachedTile]:
+        """Reads the disk tier (blocking) and promotes a hit to memory."""
+        if self._disk is None:
+            return None
+        value = self._disk.get(key)
+        if value is None:
+            return None
+        tile = CachedTile(*value)
+        with self._lock:
+            self._remember(key, tile)
+            self._stats["disk_hits"] += 1
+        return tile
+
+    def _put_disk(self, key: str, tile: CachedTile):
+        try:
+            self._disk.set(key, tuple(tile))
+        except Exception as e:
+            print(f"Could not write tile {key} to the disk cache: {e}")
+
+    def get(self, key: str) -> Optional[CachedTile]:
+        """Blocking lookup in both tiers; async callers use get_async."""
+        return self._get_memory(key) or self._get_disk(key)
+
+    async def get_async(self, key: str) -> Optional[CachedTile]:
+        tile = self._get_memory(key)
+        if tile is None and self._disk is not None:
+            tile = await get_slide_io().run("fetch", None, self._get_disk, key)
+        return tile
+
+    def put(self, key: str, content: bytes, media_type: str, write_behind: bool = False) -> CachedTile:
+        """
+        Stores a tile in both tiers. With `write_behind`, the disk write is handed to the fetch pool
+        instead of made by the caller; it is skipped if the pool is overloaded.
+        """
+        tile = CachedTile(content, media_type, compute_etag(content))
+        with self._lock:
+            self._remember(key, tile)
+        if self._disk is not None:
+            if not write_behind:
+                self._put_disk(key, tile)
+            else:
+                try:
+                    get_slide_io().submit("fetch", None, self._put_disk, key, tile)
+                except SlideIOOverloaded:
+                    pass
+        return tile
+
+    def _join_or_lead(self, key: str) -> Tuple[Future, bool]:
+        """Returns the in-flight future for a key and whether the caller must produce it."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                self._stats["misses"] += 1
+                return future, True
+            self._stats["coalesced"] += 1
+            return future, False
+
+    def _finish(
+        self, key: str, future: Future, content: Optional[bytes] = None, media_type: Optional[str] = None,
+        error: Optional[BaseException] = None, write_behind: bool = False,
+    ) -> Optional[CachedTile]:
+        tile = None
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                tile = self.put(key, content, media_type, write_behind)
+                future.set_result(tile)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return tile
+
+    def _abandon(self, key: str, future: Future):
+        """
+        Releases a key whose leader was cancelled. Waiters are not failed with the leader's
+        cancellation; they see _ABANDONED and retry, so one of them produces the tile instead.
+        """
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._stats["abandoned"] += 1
+        future.set_result(_ABANDONED)
+
+    def get_or_create(self, key: str, producer: Callable[[], Tuple[bytes, str]]) -> CachedTile:
+        """
+        Returns the cached tile for `key`, calling `producer` (which returns content and media type)
+        on a miss. Only one caller runs the producer for a key; the others wait for its result.
+        """
+        while True:
+            tile = self.get(key)
+            if tile is not None:
+                return tile
+
+            future, leader = self._join_or_lead(key)
+            if not leader:
+                tile = future.result()
+                if tile is _ABANDONED:
+                    continue
+                return tile
+            try:
+                content, media_type = producer()
+            except Exception as e:
+                self._finish(key, future, error=e)
+                raise
+            except BaseException:
+                self._abandon(key, future)
+                raise
+            return self._finish(key, future, content, media_type)
+
+    async def get_or_create_async(self, key: str, producer: Callable[[], Awaitable[Tuple[bytes, str]]]) -> CachedTile:
+        """
+        Async variant of get_or_create. Misses are coalesced with sync and async callers alike; a
+        cancelled leader (e.g. a superseded prefetch) hands the key over instead of failing waiters.
+        """
+        while True:
+            tile = await self.get_async(key)
+            if tile is not None:
+                return tile
+
+            future, leader = self._join_or_lead(key)
+            if not leader:
+                # Shielded: a cancelled waiter must not cancel the future the others share.
+                tile = await asyncio.shield(asyncio.wrap_future(future))
+                if tile is _ABANDONED:
+                    continue
+                return tile
+            try:
+                content, media_type = await producer()
+            except Exception as e:
+                self._finish(key, future, error=e)
+                raise
+            except BaseException:
+                self._abandon(key, future)
+                raise
+            return self._finish(key, future, content, media_type, write_behind=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                **self._stats,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+            }
+        if self._disk is not None:
+            stats["disk_entries"] = len(self._disk)
+            stats["disk_bytes"] = self._disk.volume()
+        return stats
+
+
+tile_cache_instance = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache() -> TileCache:
+    """Lazy initializer for the shared tile cache, configured from environment variables."""
+    global tile_cache_instance
+    with _tile_cache_lock:
+        if tile_cache_instance is None:
+            tile_cache_instance = TileCache(
+                max_memory_bytes=int(os.getenv("TILE_CACHE_MEMORY_BYTES", str(256 * 1024 ** 2))),
+                disk_dir=os.getenv("TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "patholens_tile_cache")),
+                max_disk_bytes=int(os.getenv("TILE_CACHE_DISK_BYTES", str(4 * 1024 ** 3))),
+            )
+    return tile_cache_instance
+
+
+register_stats("tile-cache", lambda: get_tile_cache().stats(), blocking=True)
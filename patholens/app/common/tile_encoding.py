@@ -0,0 +1,156 @@
+import io
+import os
+import threading
+import time
+from typing import Hashable, Optional, Tuple
+
+from PIL import Image
+
+from app.common.slide_io import get_slide_io
+from app.common.stats_registry import register_stats
+
+# Canonical format name -> (Pillow format, media type)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# Lossy formats and their default quality when a request does not specify one.
+DEFAULT_QUALITY = {
+    "jpeg": int(os.getenv("JPEG_QUALITY", "85")),
+    "webp": int(os.getenv("WEBP_QUALITY", "80")),
+}
+
+# Preference order when the Accept header ranks several formats equally.
+FORMAT_PREFERENCE = ("webp", "jpeg", "png")
+
+
+def normalize_format(fmt: str) -> str:
+    """Maps a file extension or format name to a supported canonical format name."""
+    fmt = FORMAT_ALIASES.get(fmt.lower(), fmt.lower())
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format '{fmt}'. Supported formats: {list(IMAGE_FORMATS)}")
+    return fmt
+
+
+def media_type_for(fmt: str) -> str:
+    return IMAGE_FORMATS[normalize_format(fmt)][1]
+
+
+def resolve_quality(fmt: str, quality: Optional[int] = None) -> Optional[int]:
+    """Returns the quality to encode with: the requested one for lossy formats, clamped, else the default."""
+    if fmt not in DEFAULT_QUALITY:
+        return None
+    if quality is None:
+        return DEFAULT_QUALITY[fmt]
+    return max(1, min(100, quality))
+
+
+def _parse_accept(accept: str) -> dict:
+    """Parses an Accept header into {media range: q}."""
+    ranges = {}
+    for item in accept.split(","):
+        parts = [part.strip() for part in item.split(";")]
+        if not parts[0]:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        ranges[parts[0].lower()] = q
+    return ranges
+
+
+def negotiate_format(accept: Optional[str], requested: Optional[str], default: str) -> str:
+    """
+    Picks the response format. An explicit `requested` format (query parameter) wins; otherwise the
+    Accept header is used, preferring formats the client names explicitly over wildcard matches, and
+    the route default when the client accepts anything.
+    """
+    if requested:
+        return normalize_format(requested)
+    default = normalize_format(default)
+    if not accept:
+        return default
+
+    ranges = _parse_accept(accept)
+    best, best_rank = None, None
+    for fmt in (default,) + FORMAT_PREFERENCE:
+        media_type = IMAGE_FORMATS[fmt][1]
+        if media_type in ranges:
+            q, explicit = ranges[media_type], True
+        else:
+            q, explicit = max(ranges.get("image/*", 0.0), ranges.get("*/*", 0.0)), False
+        rank = (q, explicit)
+        if q > 0 and (best_rank is None or rank > best_rank):
+            best, best_rank = fmt, rank
+    if best is None:
+        raise ValueError(f"None of the supported formats {list(IMAGE_FORMATS)} is acceptable.")
+    return best
+
+
+class EncodingStats:
+    """Per-format counters of encoded size and encode time, for choosing defaults from real traffic."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._formats = {}
+
+    def record(self, fmt: str, quality: Optional[int], size: int, seconds: float):
+        key = fmt if quality is None else f"{fmt}@q{quality}"
+        with self._lock:
+            entry = self._formats.setdefault(key, {"count": 0, "total_bytes": 0, "total_encode_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_bytes"] += size
+            entry["total_encode_seconds"] += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                key: {
+                    **entry,
+                    "mean_bytes": entry["total_bytes"] / entry["count"],
+                    "mean_encode_ms": 1000 * entry["total_encode_seconds"] / entry["count"],
+                }
+                for key, entry in self._formats.items()
+            }
+
+
+encoding_stats = EncodingStats()
+register_stats("encoding", encoding_stats.snapshot)
+
+
+def encode_image(image: Image.Image, fmt: str, quality: Optional[int] = None) -> Tuple[bytes, str]:
+    """Encodes an image and returns the bytes and their media type."""
+    fmt = normalize_format(fmt)
+    quality = resolve_quality(fmt, quality)
+    pil_format, media_type = IMAGE_FORMATS[fmt]
+    options = {}
+    if fmt == "jpeg":
+        options["quality"] = quality
+        options["optimize"] = False
+        image = image.convert("RGB")
+    elif fmt == "webp":
+        options["quality"] = quality
+        options["method"] = int(os.getenv("WEBP_METHOD", "2"))
+
+    start = time.perf_counter()
+    with io.BytesIO() as output:
+        image.save(output, format=pil_format, **options)
+        content = output.getvalue()
+    encoding_stats.record(fmt, quality, len(content), time.perf_counter() - start)
+    return content, media_type
+
+
+async def encode_image_async(image: Image.Image, fmt: str, quality: Optional[int] = None, slide_key: Optional[Hashable] = None) -> Tuple[bytes, str]:
+    """
+    Encodes an image on the slide I/O decode/encode pool so the event loop is never blocked.
+    Pillow releases the GIL while encoding, so the pool gives real parallelism.
+    """
+    return await get_slide_io().run("decode", slide_key, encode_image, image, fmt, quality)
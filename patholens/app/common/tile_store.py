@@ -0,0 +1,69 @@
+import os
+import threading
+from typing import Optional
+
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+
+
+class TileStore:
+    """
+    Persistent store for pre-rendered Deep Zoom tiles, laid out as `{slide_id}/{level}/{col}_{row}.{fmt}`
+    under a GCS prefix (`gs://bucket/prefix`) or a local directory.
+    """
+
+    def __init__(self, location: str, client: Optional[storage.Client] = None):
+        self.location = location.rstrip("/")
+        self._bucket = None
+        self._prefix = ""
+        if self.location.startswith("gs://"):
+            bucket_name, _, self._prefix = self.location.replace("gs://", "").partition("/")
+            self._bucket = (client or storage.Client()).bucket(bucket_name)
+
+    def _relative_path(self, slide_id: str, level: int, col: int, row: int, fmt: str) -> str:
+        return f"{slide_id}/{level}/{col}_{row}.{fmt}"
+
+    def get(self, slide_id: str, level: int, col: int, row: int, fmt: str) -> Optional[bytes]:
+        """Returns the stored tile bytes, or None if the tile was not pre-rendered."""
+        relative_path = self._relative_path(slide_id, level, col, row, fmt)
+        if self._bucket is not None:
+            try:
+                return self._bucket.blob(f"{self._prefix}/{relative_path}".lstrip("/")).download_as_bytes()
+            except NotFound:
+                return None
+        try:
+            with open(os.path.join(self.location, relative_path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, slide_id: str, level: int, col: int, row: int, fmt: str, content: bytes):
+        relative_path = self._relative_path(slide_id, level, col, row, fmt)
+        if self._bucket is not None:
+            self._bucket.blob(f"{self._prefix}/{relative_path}".lstrip("/")).upload_from_string(content)
+            return
+        path = os.path.join(self.location, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+
+tile_store_instance = None
+_tile_store_lock = threading.Lock()
+
+
+def get_tile_store() -> Optional[TileStore]:
+    """
+    Lazy initializer for the Deep Zoom tile store. Uses DZI_TILE_STORE, falling back to a prefix in
+    WSI_BUCKET. Returns None if neither is configured.
+    """
+    global tile_store_instance
+    with _tile_store_lock:
+        if tile_store_instance is None:
+            location = os.getenv("DZI_TILE_STORE")
+            if not location and os.getenv("WSI_BUCKET"):
+                location = f"gs://{os.getenv('WSI_BUCKET')}/processed/dzi"
+            if not location:
+                return None
+            tile_store_instance = TileStore(location)
+    return tile_store_instance
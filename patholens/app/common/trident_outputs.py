@@ -0,0 +1,81 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+from google.cloud import storage
+
+try:
+    import h5py
+except ImportError:  # Trident outputs are optional; callers fall back to their own tissue detection.
+    h5py = None
+
+TRIDENT_CACHE_DIR = os.getenv("TRIDENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "patholens_trident"))
+# Level-0 patch size assumed when the coordinate file does not record it (256 px at 20x on a 20x scan).
+DEFAULT_PATCH_SIZE_LEVEL0 = 256
+
+_coords_cache: "OrderedDict[str, Optional[Tuple[np.ndarray, int]]]" = OrderedDict()
+_coords_lock = threading.Lock()
+_storage_client = None
+
+
+def _get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+def _download_patch_file(trident_output_path: str) -> Optional[str]:
+    """Downloads Trident's patch coordinate file (`.../patches/*.h5`) and returns its local path."""
+    bucket_name, prefix = trident_output_path.replace("gs://", "").split("/", 1)
+    bucket = _get_storage_client().bucket(bucket_name)
+    for blob in bucket.list_blobs(prefix=prefix.rstrip("/") + "/"):
+        if "/patches/" in blob.name and blob.name.endswith(".h5"):
+            local_path = os.path.join(TRIDENT_CACHE_DIR, bucket_name, blob.name)
+            if not os.path.exists(local_path):
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                blob.download_to_filename(local_path + ".part")
+                os.replace(local_path + ".part", local_path)
+            return local_path
+    return None
+
+
+def load_patches(trident_output_path: Optional[str]) -> Optional[Tuple[np.ndarray, int]]:
+    """
+    Returns the level-0 (x, y) coordinates of the tissue patches Trident extracted for a slide and
+    their level-0 size, or None when the slide has no Trident output or h5py is not installed.
+    Results are memoized.
+    """
+    if not trident_output_path or h5py is None:
+        return None
+    with _coords_lock:
+        if trident_output_path in _coords_cache:
+            _coords_cache.move_to_end(trident_output_path)
+            return _coords_cache[trident_output_path]
+
+    patches = None
+    try:
+        local_path = _download_patch_file(trident_output_path)
+        if local_path is not None:
+            with h5py.File(local_path, "r") as f:
+                dataset = f["coords"]
+                coords = np.asarray(dataset[:], dtype=np.int64)
+                patch_size = int(dataset.attrs.get("patch_size_level0", DEFAULT_PATCH_SIZE_LEVEL0))
+            patches = (coords, patch_size)
+    except Exception as e:
+        print(f"Could not load Trident patch coordinates from {trident_output_path}: {e}")
+
+    with _coords_lock:
+        _coords_cache[trident_output_path] = patches
+        while len(_coords_cache) > 64:
+            _coords_cache.popitem(last=False)
+    return patches
+
+
+def load_patch_coords(trident_output_path: Optional[str]) -> Optional[np.ndarray]:
+    """Returns only the level-0 (x, y) patch coordinates from `load_patches`."""
+    patches = load_patches(trident_output_path)
+    return patches[0] if patches is not None else None
@@ -0,0 +1,168 @@
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.common.stats_registry import register_stats
+
+# Quiet period after the last viewport_update before its analysis starts.
+VIEWPORT_DEBOUNCE_SECONDS = float(os.getenv("VIEWPORT_DEBOUNCE_SECONDS", "0.3"))
+
+# Event types where only the most recent one matters. Anything else is queued and never dropped.
+COALESCED_EVENT_TYPES = ("viewport_update",)
+
+# Counters shared by all session schedulers. Only touched from the event loop thread.
+scheduler_stats = {
+    "events_received": 0,
+    "events_queued": 0,
+    "viewport_updates_coalesced": 0,
+    "runs_started": 0,
+    "runs_completed": 0,
+    "runs_cancelled": 0,
+    "runs_failed": 0,
+    "active_sessions": 0,
+}
+register_stats("ui-events", lambda: dict(scheduler_stats))
+
+# Workers of closed schedulers still finishing their queued events, referenced so they are not
+# garbage collected before completing.
+_draining_workers = set()
+
+
+class SessionEventScheduler:
+    """
+    Runs the UI events of one websocket session in the background, one at a time.
+
+    `submit` never blocks, so the reader loop keeps receiving messages while an analysis runs.
+    Queued events (e.g. `roi_marked`) run in arrival order and are never dropped or cancelled.
+    Viewport updates are debounced and coalesced: only the latest pending one is kept, it runs
+    once no newer update has arrived for `debounce_seconds`, and a newer update cancels a
+    viewport analysis that is still in flight. Closing the scheduler cancels viewport work only.
+    """
+
+    def __init__(self, session_id: str, handle_event: Callable[[str, str], Awaitable], debounce_seconds: float = VIEWPORT_DEBOUNCE_SECONDS):
+        self.session_id = session_id
+        self.handle_event = handle_event
+        self.debounce_seconds = debounce_seconds
+        self._queue: Deque[Tuple[str, str]] = deque()
+        self._latest_viewport: Optional[Tuple[str, str]] = None
+        self._viewport_at = 0.0
+        self._current: Optional[asyncio.Task] = None
+        self._current_coalesced = False
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._worker = asyncio.ensure_future(self._run_events())
+        scheduler_stats["active_sessions"] += 1
+
+    def submit(self, raw_message: str, event_type: Optional[str], user_id: str):
+        """Schedules a UI event. Returns immediately."""
+        if self._closed:
+            return
+        scheduler_stats["events_received"] += 1
+        if event_type in COALESCED_EVENT_TYPES:
+            if self._latest_viewport is not None:
+                scheduler_stats["viewport_updates_coalesced"] += 1
+            self._latest_viewport = (raw_message, user_id)
+            self._viewport_at = asyncio.get_running_loop().time()
+            # The analysis in flight is for a viewport the user has already left.
+            if self._current is not None and self._current_coalesced and not self._current.done():
+                self._current.cancel()
+        else:
+            self._queue.append((raw_message, user_id))
+            scheduler_stats["events_queued"] += 1
+        self._wakeup.set()
+
+    async def _wait_for_wakeup(self, timeout: Optional[float]):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_events(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._queue:
+                raw_message, user_id = self._queue.popleft()
+                await self._run_one(raw_message, user_id, coalesced=False)
+                continue
+            if self._closed:
+                return
+            if self._latest_viewport is not None:
+                remaining = self._viewport_at + self.debounce_seconds - loop.time()
+                if remaining > 0:
+                    await self._wait_for_wakeup(remaining)
+                    continue
+                raw_message, user_id = self._latest_viewport
+                self._latest_viewport = None
+                await self._run_one(raw_message, user_id, coalesced=True)
+                continue
+            await self._wait_for_wakeup(None)
+
+    async def _run_one(self, raw_message: str, user_id: str, coalesced: bool):
+        # The handler runs as its own task so it can be cancelled without cancelling this loop.
+        task = asyncio.ensure_future(self.handle_event(raw_message, user_id))
+        self._current, self._current_coalesced = task, coalesced
+        scheduler_stats["runs_started"] += 1
+        try:
+            await asyncio.wait([task])
+        finally:
+            self._current = None
+        if task.cancelled():
+            scheduler_stats["runs_cancelled"] += 1
+        elif task.exception() is not None:
+            scheduler_stats["runs_failed"] += 1
+            print(f"Error handling UI event for session {self.session_id}: {task.exception()}")
+        else:
+            scheduler_stats["runs_completed"] += 1
+
+    def close(self):
+        """
+        Stops accepting events. Viewport work, pending or in flight, is dropped since nobody is
+        looking anymore; queued events (e.g. `roi_marked`) still run to completion in the background.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._latest_viewport = None
+        if self._current is not None and self._current_coalesced:
+            self._current.cancel()
+        self._wakeup.set()
+        if not self._worker.done():
+            _draining_workers.add(self._worker)
+            self._worker.add_done_callback(_draining_workers.discard)
+        scheduler_stats["active_sessions"] -= 1
+
+
+class SessionSchedulers:
+    """
+    One scheduler per session, shared by all of its websocket connections (one per tab), so events
+    from every tab are ordered and coalesced together. Only touched from the event loop thread.
+    """
+
+    def __init__(self):
+        # session_id -> [scheduler, number of connections using it]
+        self._schedulers: Dict[str, List] = {}
+
+    def acquire(self, session_id: str, handle_event: Callable[[str, str], Awaitable]) -> SessionEventScheduler:
+        """Returns the session's scheduler, creating it with `handle_event` for its first connection."""
+        entry = self._schedulers.get(session_id)
+        if entry is None:
+            entry = self._schedulers[session_id] = [SessionEventScheduler(session_id, handle_event), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, session_id: str) -> bool:
+        """Drops one connection's reference. Returns True if it was the last one and the scheduler was closed."""
+        entry = self._schedulers.get(session_id)
+        if entry is None:
+            return False
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        del self._schedulers[session_id]
+        entry[0].close()
+        return True
+
+
+session_schedulers = SessionSchedulers()
@@ -4,21 +4,21 @@ from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
 from google.adk.artifacts import GcsArtifactService, InMemoryArtifactService
 from google.adk.memory import InMemoryMemoryService
 
 # Import the root agent we defined
 from app.agents.core_agents import root_agent
+from app.services.session_store import session_service_from_env
 
 # Load environment variables from a .env file
 load_dotenv()
 
 # --- ADK Runner and Services Configuration ---
 
-# For development, we use in-memory services.
-# For production, you would switch to persistent services like FirestoreSessionService.
-session_service = InMemorySessionService()
+# Sessions are persisted in SQLite and compacted so long sessions keep a bounded context
+# (SESSION_STORE=memory restores the in-memory service). Memory stays in-memory for development.
+session_service = session_service_from_env()
 memory_service = InMemoryMemoryService()
 
 # Artifacts (e.g., generated images, files) can be stored in GCS.
@@ -66,6 +66,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Slide I/O pools reject work when their queues are full; tell clients to back off instead of piling up.
+from fastapi.responses import JSONResponse
+from app.common.slide_io import SlideIOOverloaded
+
+
+@app.exception_handler(SlideIOOverloaded)
+async def slide_io_overloaded_handler(request, exc: SlideIOOverloaded):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
 @app.get("/", tags=["Health Check"])
 async def root():
     """Root endpoint for health check."""
@@ -74,8 +84,38 @@ async def root():
 # The agent interaction endpoint will be added in the next task.
 
 # Include the slide tiling router
-from . import slide_router
+from . import slide_router, stats_router
 app.include_router(slide_router.router)
+app.include_router(stats_router.router)
+
+# Ingestion jobs run in separate worker processes fed by the durable job queue. Set INGEST_WORKERS=0
+# when the workers run elsewhere (python -m app.trident_processing.worker).
+from app.trident_processing.worker import start_worker_pool, stop_worker_pool
+
+
+@app.on_event("startup")
+async def start_ingestion_workers():
+    app.state.ingest_workers = start_worker_pool(int(os.getenv("INGEST_WORKERS", "1")))
+
+
+@app.on_event("shutdown")
+async def stop_ingestion_workers():
+    stop_worker_pool(getattr(app.state, "ingest_workers", []))
+
+
+# Firestore note and status writes are committed in batches by a write-behind queue. Starting it here
+# replays writes that a previous run queued but did not commit; shutdown waits briefly for the rest.
+from app.common.firestore_store import FIRESTORE_EXIT_FLUSH_SECONDS, get_firestore_writer
+
+
+@app.on_event("startup")
+async def start_firestore_writer():
+    get_firestore_writer()
+
+
+@app.on_event("shutdown")
+async def flush_firestore_writer():
+    get_firestore_writer().flush(FIRESTORE_EXIT_FLUSH_SECONDS)
 
 # --- Agent Interaction Endpoint ---
 
@@ -83,40 +123,67 @@ from fastapi import Request
 from fastapi.responses import StreamingResponse
 from google.adk import types
 from google.adk.agents import RunConfig
+import asyncio
 import json
+from app.common.stream_bus import stream_bus
 
 # Import the Pydantic model for the request body
 from app.common.models import AgentRunRequest
 
 
+# Marks the end of the agent run in the queue merged by event_stream_generator.
+_RUN_FINISHED = object()
+
+
 async def event_stream_generator(request_data: AgentRunRequest, adk_runner: Runner):
     """
     Asynchronous generator that runs the agent and yields events as JSON strings.
+    Partial model output published for the session is interleaved with the agent's events.
     """
     run_config = RunConfig(**request_data.run_config) if request_data.run_config else RunConfig()
     
     # Create the initial message content for the ADK
     new_message = types.Content(parts=[types.Part.from_text(request_data.message)])
 
+    # Agent events and partial model output arrive on the same queue, in the order they happen. Only
+    # clients that ask for partial output subscribe, since streamed model calls bypass the batcher.
+    if request_data.stream_model_output:
+        queue = stream_bus.subscribe(request_data.session_id)
+    else:
+        queue = asyncio.Queue()
+
+    async def run_agent_events():
+        try:
+            # Asynchronously iterate through the events from the runner
+            async for event in adk_runner.run_async(
+                user_id=request_data.user_id,
+                session_id=request_data.session_id,
+                new_message=new_message,
+                run_config=run_config
+            ):
+                queue.put_nowait(event.to_dict())
+        except Exception as e:
+            # Handle exceptions during agent execution
+            queue.put_nowait({
+                "author": "system_error",
+                "content": {"parts": [{"text": f"An error occurred: {str(e)}"}]},
+                "type": "ERROR"
+            })
+        finally:
+            queue.put_nowait(_RUN_FINISHED)
+
+    run_task = asyncio.ensure_future(run_agent_events())
     try:
-        # Asynchronously iterate through the events from the runner
-        async for event in adk_runner.run_async(
-            user_id=request_data.user_id,
-            session_id=request_data.session_id,
-            new_message=new_message,
-            run_config=run_config
-        ):
+        while True:
+            message = await queue.get()
+            if message is _RUN_FINISHED:
+                break
             # Yield each event as a server-sent event (SSE) formatted string
-            yield f"data: {json.dumps(event.to_dict())}\n\n"
-            
-    except Exception as e:
-        # Handle exceptions during agent execution
-        error_event = {
-            "author": "system_error",
-            "content": {"parts": [{"text": f"An error occurred: {str(e)}"}]},
-            "type": "ERROR"
-        }
-        yield f"data: {json.dumps(error_event)}\n\n"
+            yield f"data: {json.dumps(message)}\n\n"
+    finally:
+        if request_data.stream_model_output:
+            stream_bus.unsubscribe(request_data.session_id, queue)
+        run_task.cancel()
 
 
 @app.post("/agent/run", tags=["AI Agents"])
@@ -136,14 +203,80 @@ async def run_agent(agent_request: AgentRunRequest, request: Request):
 # --- WebSocket Endpoint for UI Telemetry ---
 from fastapi import WebSocket, WebSocketDisconnect
 from .websocket_manager import websocket_manager
+from .event_scheduler import session_schedulers
+from app.agents.fast_path import UIEventDispatcher, ui_event_latency
+import time
+
+
+async def run_ui_event(session_id: str, raw_message: str, user_id: str):
+    """
+    Runs one UI event and forwards the resulting events to the client. Known structured events go
+    through the deterministic fast path; anything else is routed by the LLM agents.
+    """
+    try:
+        json_data = json.loads(raw_message)
+        event_type = json_data.get("type") if isinstance(json_data, dict) else None
+    except json.JSONDecodeError:
+        json_data, event_type = None, None
+
+    adk_runner = app.state.runner
+    start = time.perf_counter()
+    if UIEventDispatcher.handles(event_type):
+        path = "fast_path"
+        events = UIEventDispatcher(adk_runner).dispatch(event_type, json_data.get("payload", {}), user_id, session_id)
+    else:
+        path = "llm_path"
+        # Create a content object specifically for the UITelemetryCoordinatorAgent
+        # This agent expects a JSON string as its input text
+        ui_event_content = types.Content(parts=[types.Part.from_text(raw_message)])
+
+        # Run the ADK with this specific content. The RootAgent will delegate
+        # to the UITelemetryCoordinatorAgent, which will then process the event.
+        events = adk_runner.run_async(
+            user_id=user_id,
+            session_id=session_id,
+            new_message=ui_event_content,
+            run_config=RunConfig() # Use default run config
+        )
+
+    async for event in events:
+        # Any direct feedback from the agent execution can be sent back
+        await websocket_manager.send_json(event.to_dict(), session_id)
+    ui_event_latency.record(path, event_type or "message", time.perf_counter() - start)
+
+
+async def forward_model_stream(queue: asyncio.Queue, connection):
+    """Sends partial model output published for the session to one of its websockets."""
+    while True:
+        message = await queue.get()
+        try:
+            await websocket_manager.send_json_to(message, connection)
+        except Exception as e:
+            print(f"Error forwarding model stream for session {connection.session_id}: {e}")
+
 
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     """
     Handles the WebSocket connection for a given session.
-    Listens for messages from the UI and forwards them to the ADK Runner.
+    Listens for messages from the UI and hands them to a per-session scheduler, which runs them
+    through the ADK Runner in the background so this loop never waits on an analysis.
+    A session may have several connections (one per tab); they share the session's scheduler and
+    agent events go to all of them. Connect
+    with `?encoding=msgpack` to receive binary msgpack frames instead of JSON text; messages from
+    the client are always JSON text. Connect with `?stream=1` to also receive partial model output.
     """
-    await websocket_manager.connect(websocket, session_id)
+    connection = await websocket_manager.connect(websocket, session_id, websocket.query_params.get("encoding", "json"))
+    scheduler = session_schedulers.acquire(
+        session_id,
+        lambda raw_message, user_id: run_ui_event(session_id, raw_message, user_id),
+    )
+    # Partial model output for this session is forwarded as it is generated, if the client asked for it.
+    # Streamed model calls bypass the batcher, so connections that did not ask stay off the stream bus.
+    stream_queue = stream_forwarder = None
+    if websocket.query_params.get("stream") == "1":
+        stream_queue = stream_bus.subscribe(session_id)
+        stream_forwarder = asyncio.ensure_future(forward_model_stream(stream_queue, connection))
     try:
         while True:
             # Wait for a message from the UI
@@ -152,33 +285,31 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             # Here, we assume the user_id is also part of the ws message
             # A robust implementation would handle auth to get the user_id
             # For now, we'll extract it from the payload or use a default.
-            import json
             try:
                 json_data = json.loads(data)
                 user_id = json_data.get("user_id", "ws_user")
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, AttributeError):
+                json_data = {}
                 user_id = "ws_user" # fallback
+            if not isinstance(json_data, dict):
+                json_data = {}
+            event_type = json_data.get("type")
 
-            # Create a content object specifically for the UITelemetryCoordinatorAgent
-            # This agent expects a JSON string as its input text
-            ui_event_content = types.Content(parts=[types.Part.from_text(data)])
-
-            # Get the runner from the app state
-            adk_runner = websocket.app.state.runner
+            # Viewport telemetry also drives tile prefetching; this only schedules work and returns at once.
+            if event_type == "viewport_update":
+                slide_router.tile_prefetcher.observe(session_id, json_data.get("payload", {}))
 
-            # Run the ADK with this specific content. The RootAgent will delegate
-            # to the UITelemetryCoordinatorAgent, which will then process the event.
-            async for event in adk_runner.run_async(
-                user_id=user_id,
-                session_id=session_id,
-                new_message=ui_event_content,
-                run_config=RunConfig() # Use default run config
-            ):
-                # Any direct feedback from the agent execution can be sent back
-                await websocket_manager.send_json(event.to_dict(), session_id)
+            scheduler.submit(data, event_type, user_id)
 
     except WebSocketDisconnect:
-        websocket_manager.disconnect(session_id)
+        pass
     except Exception as e:
         print(f"Error in WebSocket for session {session_id}: {e}")
-        websocket_manager.disconnect(session_id)
+    finally:
+        if stream_queue is not None:
+            stream_bus.unsubscribe(session_id, stream_queue)
+            stream_forwarder.cancel()
+        websocket_manager.disconnect(connection)
+        # The session's scheduler and prefetch state outlive a tab; they go with the last connection.
+        if session_schedulers.release(session_id):
+            slide_router.tile_prefetcher.forget_session(session_id)
@@ -0,0 +1,366 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from google.adk.events import Event
+from google.adk.sessions import InMemorySessionService
+from google.adk import types
+from google.adk.sessions.base_session_service import BaseSessionService, GetSessionConfig, ListSessionsResponse
+from google.adk.sessions.session import Session
+from google.adk.sessions.state import State
+
+try:
+    from google.adk.sessions.base_session_service import ListEventsResponse
+except ImportError:  # google-adk releases without list_events on the session service
+    ListEventsResponse = None
+
+# Rough prompt-size estimate used for budgets and reporting.
+CHARS_PER_TOKEN = 4
+# Author of the synthetic event that carries the summary of compacted events.
+SUMMARY_AUTHOR = "SessionSummary"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    compacted_events INTEGER NOT NULL DEFAULT 0,
+    compactions INTEGER NOT NULL DEFAULT 0,
+    last_update_time REAL NOT NULL,
+    PRIMARY KEY (app_name, user_id, id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    invocation_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    tokens INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (app_name, user_id, session_id, seq);
+CREATE TABLE IF NOT EXISTS app_states (app_name TEXT PRIMARY KEY, state TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS user_states (app_name TEXT NOT NULL, user_id TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (app_name, user_id));
+"""
+
+
+def _event_tokens(event: Event) -> int:
+    if event.content is None:
+        return 0
+    return len(event.content.model_dump_json(exclude_none=True)) // CHARS_PER_TOKEN
+
+
+def _summary_line(event: Event, max_chars: int = 240) -> Optional[str]:
+    """One line describing an event for the running summary, or None if it carries nothing worth keeping."""
+    if event.content is None or not event.content.parts:
+        return None
+    pieces = []
+    for part in event.content.parts:
+        if part.text:
+            pieces.append(" ".join(part.text.split()))
+        elif part.function_call is not None:
+            pieces.append(f"called {part.function_call.name}")
+        elif part.function_response is not None:
+            pieces.append(f"{part.function_response.name} returned")
+    text = "; ".join(piece for piece in pieces if piece)
+    if not text:
+        return None
+    if len(text) > max_chars:
+        text = text[:max_chars - 1] + "…"
+    return f"[{event.author}] {text}"
+
+
+def _split_state_delta(delta: dict):
+    """Splits a state delta into (app, user, session) parts by key prefix; temp: keys are dropped."""
+    app_delta, user_delta, session_delta = {}, {}, {}
+    for key, value in delta.items():
+        if key.startswith(State.APP_PREFIX):
+            app_delta[key[len(State.APP_PREFIX):]] = value
+        elif key.startswith(State.USER_PREFIX):
+            user_delta[key[len(State.USER_PREFIX):]] = value
+        elif not key.startswith(State.TEMP_PREFIX):
+            session_delta[key] = value
+    return app_delta, user_delta, session_delta
+
+
+class SqliteSessionService(BaseSessionService):
+    """
+    ADK session service persisted in a SQLite file that keeps each session's context bounded.
+
+    Once a session holds more than `max_events` events or `token_budget` estimated prompt tokens,
+    the oldest completed invocations are folded into a running text summary (itself capped at
+    `summary_tokens`) and deleted. Sessions are returned as the summary, as one synthetic event,
+    followed by the recent events, so every LLM call sees a context of roughly constant size.
+    """
+
+    def __init__(self, db_path: str, max_events: int = 60, token_budget: int = 12000, summary_tokens: int = 1500):
+        self.db_path = db_path
+        self.max_events = max_events
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Opens an autocommit connection for one operation; multi-statement updates use explicit transactions."""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # --- State ---
+
+    @staticmethod
+    def _load_json(conn, query: str, params: tuple) -> dict:
+        row = conn.execute(query, params).fetchone()
+        return json.loads(row[0]) if row is not None else {}
+
+    def _merged_state(self, conn, app_name: str, user_id: str, session_state: dict) -> dict:
+        state = dict(session_state)
+        app_state = self._load_json(conn, "SELECT state FROM app_states WHERE app_name = ?", (app_name,))
+        user_state = self._load_json(conn, "SELECT state FROM user_states WHERE app_name = ? AND user_id = ?", (app_name, user_id))
+        state.update({State.APP_PREFIX + key: value for key, value in app_state.items()})
+        state.update({State.USER_PREFIX + key: value for key, value in user_state.items()})
+        return state
+
+    # --- BaseSessionService ---
+
+    def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None, session_id: Optional[str] = None) -> Session:
+        session_id = session_id.strip() if session_id and session_id.strip() else str(uuid.uuid4())
+        app_delta, user_delta, session_state = _split_state_delta(state or {})
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (app_name, user_id, id, state, last_update_time) VALUES (?, ?, ?, ?, ?)",
+                    (app_name, user_id, session_id, json.dumps(session_state), now),
+                )
+                self._apply_shared_deltas(conn, app_name, user_id, app_delta, user_delta)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            merged = self._merged_state(conn, app_name, user_id, session_state)
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=merged, last_update_time=now)
+
+    def get_session(self, *, app_name: str, user_id: str, session_id: str, config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?", (app_name, user_id, session_id)
+            ).fetchone()
+            if row is None:
+                return None
+            query = "SELECT event FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?"
+            params = [app_name, user_id, session_id]
+            if config is not None and config.after_timestamp:
+                query += " AND timestamp >= ?"
+                params.append(config.after_timestamp)
+            query += " ORDER BY seq"
+            events = [Event.model_validate_json(event_row["event"]) for event_row in conn.execute(query, params)]
+            state = self._merged_state(conn, app_name, user_id, json.loads(row["state"]))
+
+        if config is not None and config.num_recent_events:
+            events = events[-config.num_recent_events:]
+        elif row["summary"]:
+            first_timestamp = events[0].timestamp if events else row["last_update_time"]
+            events.insert(0, Event(
+                invocation_id="session-summary",
+                author=SUMMARY_AUTHOR,
+                content=types.Content(role="user", parts=[types.Part.from_text(text=
+                    f"Summary of the {row['compacted_events']} earlier events of this session:\n{row['summary']}"
+                )]),
+                timestamp=first_timestamp - 1e-3,
+            ))
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=state, events=events, last_update_time=row["last_update_time"])
+
+    def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, last_update_time FROM sessions WHERE app_name = ? AND user_id = ? ORDER BY last_update_time DESC",
+                (app_name, user_id),
+            ).fetchall()
+        return ListSessionsResponse(sessions=[
+            Session(app_name=app_name, user_id=user_id, id=row["id"], state={}, last_update_time=row["last_update_time"])
+            for row in rows
+        ])
+
+    def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?", (app_name, user_id, session_id))
+            conn.execute("DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?", (app_name, user_id, session_id))
+            conn.execute("COMMIT")
+
+    def list_events(self, *, app_name: str, user_id: str, session_id: str):
+        """Events of a session, for google-adk releases whose session service declares list_events."""
+        session = self.get_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        events = session.events if session is not None else []
+        return ListEventsResponse(events=events) if ListEventsResponse is not None else events
+
+    def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
+        super().append_event(session, event)
+        app_delta, user_delta, session_delta = _split_state_delta(
+            event.actions.state_delta if event.actions and event.actions.state_delta else {}
+        )
+        serialized = event.model_dump_json(exclude_none=True)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if session_delta:
+                    state = self._load_json(
+                        conn, "SELECT state FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?",
+                        (session.app_name, session.user_id, session.id),
+                    )
+                    state.update(session_delta)
+                    conn.execute(
+                        "UPDATE sessions SET state = ? WHERE app_name = ? AND user_id = ? AND id = ?",
+                        (json.dumps(state), session.app_name, session.user_id, session.id),
+                    )
+                self._apply_shared_deltas(conn, session.app_name, session.user_id, app_delta, user_delta)
+                conn.execute(
+                    "INSERT INTO events (app_name, user_id, session_id, invocation_id, event, bytes, tokens, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session.app_name, session.user_id, session.id, event.invocation_id, serialized,
+                     len(serialized), _event_tokens(event), event.timestamp),
+                )
+                conn.execute(
+                    "UPDATE sessions SET last_update_time = ? WHERE app_name = ? AND user_id = ? AND id = ?",
+                    (event.timestamp, session.app_name, session.user_id, session.id),
+                )
+                self._compact_if_needed(conn, session.app_name, session.user_id, session.id, event.invocation_id)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        session.last_update_time = event.timestamp
+        return event
+
+    # --- Compaction ---
+
+    @staticmethod
+    def _apply_shared_deltas(conn, app_name: str, user_id: str, app_delta: dict, user_delta: dict):
+        if app_delta:
+            state = SqliteSessionService._load_json(conn, "SELECT state FROM app_states WHERE app_name = ?", (app_name,))
+            state.update(app_delta)
+            conn.execute("INSERT OR REPLACE INTO app_states (app_name, state) VALUES (?, ?)", (app_name, json.dumps(state)))
+        if user_delta:
+            state = SqliteSessionService._load_json(conn, "SELECT state FROM user_states WHERE app_name = ? AND user_id = ?", (app_name, user_id))
+            state.update(user_delta)
+            conn.execute("INSERT OR REPLACE INTO user_states (app_name, user_id, state) VALUES (?, ?, ?)", (app_name, user_id, json.dumps(state)))
+
+    def _compact_if_needed(self, conn, app_name: str, user_id: str, session_id: str, current_invocation: str):
+        """
+        Folds the oldest events into the summary once the session exceeds its event or token budget,
+        keeping the newest half of each budget. Only whole, finished invocations are folded, so a
+        function call is never separated from its response. Caller holds the transaction.
+        """
+        count, tokens = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?",
+            (app_name, user_id, session_id),
+        ).fetchone()
+        if count <= self.max_events and tokens <= self.token_budget:
+            return
+
+        rows = conn.execute(
+            "SELECT seq, invocation_id, event, tokens FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? ORDER BY seq",
+            (app_name, user_id, session_id),
+        ).fetchall()
+        keep_events, keep_tokens = self.max_events // 2, self.token_budget // 2
+        kept, kept_tokens, cut = 0, 0, len(rows)
+        while cut > 0 and kept < keep_events and kept_tokens + rows[cut - 1]["tokens"] <= keep_tokens:
+            cut -= 1
+            kept += 1
+            kept_tokens += rows[cut]["tokens"]
+        # Move the cut back to an invocation boundary, and never into the invocation in progress.
+        while cut > 0 and cut < len(rows) and rows[cut - 1]["invocation_id"] == rows[cut]["invocation_id"]:
+            cut -= 1
+        while cut > 0 and rows[cut - 1]["invocation_id"] == current_invocation:
+            cut -= 1
+        if cut == 0:
+            return
+
+        folded = rows[:cut]
+        lines = [line for line in (_summary_line(Event.model_validate_json(row["event"])) for row in folded) if line]
+        summary = conn.execute(
+            "SELECT summary FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?", (app_name, user_id, session_id)
+        ).fetchone()["summary"]
+        summary = "\n".join(([summary] if summary else []) + lines)
+        max_chars = self.summary_tokens * CHARS_PER_TOKEN
+        if len(summary) > max_chars:
+            # The most recent history is the most relevant; the oldest lines are dropped first.
+            summary = "…" + summary[-max_chars:].split("\n", 1)[-1]
+        conn.execute(
+            "DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? AND seq <= ?",
+            (app_name, user_id, session_id, folded[-1]["seq"]),
+        )
+        conn.execute(
+            "UPDATE sessions SET summary = ?, compacted_events = compacted_events + ?, compactions = compactions + 1"
+            " WHERE app_name = ? AND user_id = ? AND id = ?",
+            (summary, len(folded), app_name, user_id, session_id),
+        )
+
+    # --- Reporting ---
+
+    def stats(self, limit: int = 50) -> dict:
+        """Per-session event counts, stored bytes and estimated prompt tokens, largest sessions first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT s.app_name, s.user_id, s.id, s.compacted_events, s.compactions, LENGTH(s.summary) AS summary_chars,"
+                " LENGTH(s.state) AS state_bytes, s.last_update_time,"
+                " COUNT(e.seq) AS events, COALESCE(SUM(e.bytes), 0) AS event_bytes, COALESCE(SUM(e.tokens), 0) AS event_tokens"
+                " FROM sessions s LEFT JOIN events e ON e.app_name = s.app_name AND e.user_id = s.user_id AND e.session_id = s.id"
+                " GROUP BY s.app_name, s.user_id, s.id ORDER BY event_bytes DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+            totals = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM events").fetchone()
+            session_count = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {
+            "sessions": session_count,
+            "events": totals[0],
+            "event_bytes": totals[1],
+            "max_events": self.max_events,
+            "token_budget": self.token_budget,
+            "largest_sessions": [
+                {
+                    "app_name": row["app_name"],
+                    "user_id": row["user_id"],
+                    "session_id": row["id"],
+                    "events": row["events"],
+                    "compacted_events": row["compacted_events"],
+                    "compactions": row["compactions"],
+                    "bytes": row["event_bytes"] + row["state_bytes"] + row["summary_chars"],
+                    "prompt_tokens": row["event_tokens"] + row["summary_chars"] // CHARS_PER_TOKEN,
+                    "last_update_time": row["last_update_time"],
+                }
+                for row in rows
+            ],
+        }
+
+
+def session_service_from_env() -> BaseSessionService:
+    """Builds the session service selected by SESSION_STORE: `sqlite` (default) or `memory`."""
+    if os.getenv("SESSION_STORE", "sqlite") == "memory":
+        return InMemorySessionService()
+    return SqliteSessionService(
+        db_path=os.getenv("SESSION_DB", os.path.join(tempfile.gettempdir(), "patholens_sessions.sqlite3")),
+        max_events=int(os.getenv("SESSION_MAX_EVENTS", "60")),
+        token_budget=int(os.getenv("SESSION_TOKEN_BUDGET", "12000")),
+        summary_tokens=int(os.getenv("SESSION_SUMMARY_TOKENS", "1500")),
+    )
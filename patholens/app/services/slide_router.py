@@ -1,85 +1,632 @@
-import io
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
 import os
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import Response
-from app.agents.tools.wsi_tools import load_wsi_tile
-from app.common.models import SlideProcessingRequest
-from app.trident_processing.processor import process_wsi_with_trident
-from app.agents.tools.storage_tools import get_slide_metadata
-from google.cloud import firestore, storage
-import openslide
+import struct
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from fastapi import APIRouter, HTTPException, Depends, Header, Query
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from app.agents.tools.wsi_tools import load_wsi_tile_async, open_wsi_reader
+from app.common.metadata_cache import invalidate_slide_metadata
+from app.common.models import SimilarRegionRequest, SlideProcessingRequest, TileBatchRequest
+from app.common.patch_encoders import EMBEDDINGS_ENCODER, ENCODERS, get_encoder
+from app.common.similarity import load_cohort_embeddings, load_slide_embeddings, query_vector, search
+from app.common.trident_outputs import DEFAULT_PATCH_SIZE_LEVEL0
+from app.trident_processing.job_queue import get_job_queue
+from app.agents.tools.storage_tools import get_slide_metadata, get_slide_metadata_async, prefetch_slide_metadata
+from app.common.slide_cache import get_slide_cache
+from app.common.slide_io import SlideIOOverloaded, get_slide_io
+from app.common.tile_cache import CachedTile, background_tile, get_tile_cache, make_dzi_tile_key, make_tile_key
+from app.common.spatial_index import TISSUE_INDEX_ENABLED, get_tissue_index_registry
+from app.common.background import BACKGROUND_DETECTION, background_bitmap, is_background
+from app.common.slide_catalog import CATALOG_FIELDS, DEFAULT_LIST_FIELDS, SORT_FIELDS, slide_catalog
+from app.common.stats_registry import register_stats
+from app.common.deepzoom import DeepZoomGeometry, geometry_for_reader, render_tile
+from app.common.tile_encoding import encode_image_async, media_type_for, negotiate_format, normalize_format, resolve_quality
+from app.common.tile_store import get_tile_store
+from .tile_prefetcher import TilePrefetcher
 
 router = APIRouter()
 
+# Tiles of a slide never change once ingested, so they can be cached aggressively and revalidated by ETag.
+TILE_CACHE_CONTROL = os.getenv("TILE_CACHE_CONTROL", "public, max-age=86400")
+
+# Route default for the legacy tile endpoint when the client accepts any image format.
+TILE_DEFAULT_FORMAT = os.getenv("TILE_DEFAULT_FORMAT", "png")
+# The legacy tile endpoint serves fixed-size tiles on a grid of level-0 origins.
+TILE_SIZE = 256
+
+TILE_BATCH_MAX_TILES = int(os.getenv("TILE_BATCH_MAX_TILES", "256"))
+TILE_BATCH_MEDIA_TYPE = "application/x-patholens-tile-batch"
+
+# Normalized here so pre-rendered tiles, cache keys and descriptors all use the same format name.
+DZI_FORMAT = normalize_format(os.getenv("DZI_FORMAT", "jpeg"))
+DZI_JPEG_QUALITY = int(os.getenv("DZI_JPEG_QUALITY", "85"))
+DZI_OVERLAP = int(os.getenv("DZI_OVERLAP", "0"))
+# Slides per /slides page when the client does not ask for a size, and the largest page allowed.
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "1000"))
+CATALOG_MAX_PAGE_SIZE = int(os.getenv("CATALOG_MAX_PAGE_SIZE", "5000"))
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Checks an If-None-Match header value against an ETag."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def _tile_response(tile: CachedTile, if_none_match: Optional[str], vary_accept: bool = False) -> Response:
+    """Builds a tile response with validators, answering 304 when the client copy is current."""
+    headers = {"ETag": tile.etag, "Cache-Control": TILE_CACHE_CONTROL}
+    if vary_accept:
+        headers["Vary"] = "Accept"
+    if _etag_matches(if_none_match, tile.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile.content, media_type=tile.media_type, headers=headers)
+
+
+def _read_slide_properties(gcs_uri: str) -> dict:
+    with get_slide_cache().open_slide(gcs_uri) as slide:
+        return {
+            "level_count": slide.level_count,
+            "level_dimensions": slide.level_dimensions,
+            "mpp": (float(slide.properties.get('openslide.mpp-x', 0)), float(slide.properties.get('openslide.mpp-y', 0))),
+        }
+
+
 @router.get("/slides", tags=["WSI Listing"])
-async def list_available_slides():
-    """Lists all slides with 'complete' processing status from Firestore."""
+async def list_available_slides(
+    status: Optional[str] = Query("complete", description="Processing status to list; `any` lists every slide."),
+    q: Optional[str] = Query(None, description="Case-insensitive match on slide ID or filename."),
+    sort: str = Query("slide_id", description="Sort field, prefixed with `-` for descending order."),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return (default: slide_id,filename)."),
+    limit: int = Query(CATALOG_PAGE_SIZE, ge=1, le=CATALOG_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="The X-Next-Cursor value of the previous page."),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Lists slides (by default those with 'complete' processing status) from the in-memory catalog,
+    one page at a time. The cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    if sort.lstrip("-") not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by '{sort}'. Sortable fields: {list(SORT_FIELDS)}")
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip())) if fields else DEFAULT_LIST_FIELDS
+    unknown = [field for field in selected if field != "slide_id" and field not in CATALOG_FIELDS]
+    if unknown or not selected:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}. Available fields: {['slide_id', *CATALOG_FIELDS]}")
     try:
-        db = firestore.Client()
-        slides_ref = db.collection("slide_metadata").where(filter=firestore.FieldFilter("processing_status", "==", "complete")).stream()
-        slides = []
-        for doc in slides_ref:
-            slide_data = doc.to_dict()
-            slides.append({
-                "slide_id": doc.id,
-                "filename": slide_data.get("original_filename", "N/A")
-            })
-        return slides
+        items, next_cursor, digest = await get_slide_io().run(
+            "fetch", None, slide_catalog.page, None if status == "any" else status, q, sort, selected, limit, cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SlideIOOverloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not list slides: {e}")
 
+    # The ETag covers the catalog snapshot and the query, so revalidating an unchanged page is a 304.
+    query_key = json.dumps([status, q, sort, selected, limit, cursor])
+    etag = '"' + hashlib.sha1(f"{digest}:{query_key}".encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    # The viewer opens slides from this page next; load their metadata in one batched read once the response is sent.
+    prefetch = BackgroundTask(_prefetch_page_metadata, [item["slide_id"] for item in items if "slide_id" in item])
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers, background=prefetch)
+    return Response(content=json.dumps(items), media_type="application/json", headers=headers, background=prefetch)
+
+
+async def _prefetch_page_metadata(slide_ids: list):
+    if not slide_ids:
+        return
+    try:
+        await get_slide_io().run("fetch", None, prefetch_slide_metadata, slide_ids)
+    except Exception as e:
+        print(f"Could not prefetch metadata for {len(slide_ids)} slides: {e}")
+
 
 @router.get("/slides/{slide_id}/metadata", tags=["WSI Listing"])
 async def get_slide_properties(slide_id: str):
     """Retrieves detailed WSI properties required by a viewer."""
     try:
-        metadata = get_slide_metadata(slide_id)
+        metadata = await get_slide_metadata_async(slide_id)
         gcs_uri = metadata.get('gcs_original_path')
         if not gcs_uri:
             raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
 
-        storage_client = storage.Client()
-        bucket_name, blob_name = gcs_uri.replace("gs://", "").split("/", 1)
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        
-        with io.BytesIO(blob.download_as_bytes()) as slide_bytes:
-            slide = openslide.OpenSlide(slide_bytes)
-            properties = {
-                "level_count": slide.level_count,
-                "level_dimensions": slide.level_dimensions,
-                "mpp": (float(slide.properties.get('openslide.mpp-x', 0)), float(slide.properties.get('openslide.mpp-y', 0))),
-            }
-            return properties
+        slide_io = get_slide_io()
+        # Opening the slide may download it, so it runs on the fetch pool.
+        return await slide_io.run("fetch", gcs_uri, _read_slide_properties, gcs_uri)
+    except (HTTPException, SlideIOOverloaded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not retrieve slide properties: {e}")
 
 
-@router.get("/tiles/{slide_id}/{level}/{x}_{y}.png", tags=["WSI Tiling"])
-async def get_wsi_tile_endpoint(slide_id: str, level: int, x: int, y: int):
-    """Serves a single tile from a Whole-Slide Image stored in GCS."""
+@router.get("/slides/{slide_id}/tissue", tags=["WSI Listing"])
+async def get_slide_tissue(
+    slide_id: str,
+    bbox: str = Query(..., description="Viewport as x,y,width,height in pixels of `level`."),
+    level: int = Query(0, ge=0),
+    limit: int = Query(5000, ge=1, le=100000),
+):
+    """Returns the Trident tissue patches overlapping a viewport, in the coordinates of `level`."""
     try:
-        metadata = get_slide_metadata(slide_id)
+        x, y, width, height = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be x,y,width,height")
+    if width <= 0 or height <= 0:
+        raise HTTPException(status_code=400, detail="bbox width and height must be positive")
+
+    try:
+        index = await _slide_tissue_index(slide_id, wait=True)
+        if index is None:
+            raise HTTPException(status_code=404, detail=f"No Trident tissue patches available for slide {slide_id}.")
+        downsamples = await get_slide_level_downsamples(slide_id)
+        if level >= len(downsamples):
+            raise HTTPException(status_code=400, detail=f"Slide {slide_id} has {len(downsamples)} levels.")
+        downsample = downsamples[level]
+        patches = index.query(x * downsample, y * downsample, width * downsample, height * downsample, limit + 1)
+        return {
+            "slide_id": slide_id,
+            "level": level,
+            "bbox": [x, y, width, height],
+            "patch_size": index.patch_size / downsample,
+            "count": min(len(patches), limit),
+            "truncated": len(patches) > limit,
+            "patches": (patches[:limit] / downsample).round(2).tolist(),
+        }
+    except (HTTPException, SlideIOOverloaded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not query tissue patches: {e}")
+
+
+# An ROI without stored patches is embedded from at most this many patch-sized reads per side.
+ROI_MAX_PATCHES_PER_SIDE = 8
+
+
+def _encode_roi(slide_gcs_uri: str, encoder_name: str, patch_size: int, x: int, y: int, width: float, height: float) -> np.ndarray:
+    """Embeds a level-0 region directly, as a grid of patch-sized reads centred on it."""
+    encoder = get_encoder(encoder_name)
+    step = max(patch_size, math.ceil(max(width, height) / ROI_MAX_PATCHES_PER_SIDE))
+    cols, rows = max(1, math.ceil(width / step)), max(1, math.ceil(height / step))
+    origin_x, origin_y = x + (width - cols * step) / 2, y + (height - rows * step) / 2
+    with open_wsi_reader(slide_gcs_uri) as slide:
+        target = step / encoder.input_size
+        level = max(i for i, downsample in enumerate(slide.level_downsamples) if downsample <= max(target, 1.0))
+        size = max(1, int(round(step / slide.level_downsamples[level])))
+        images = [
+            slide.read_region((max(0, int(origin_x + col * step)), max(0, int(origin_y + row * step))), level, (size, size)).convert("RGB")
+            for row in range(rows) for col in range(cols)
+        ]
+    return query_vector(encoder.encode_images(images))
+
+
+def _load_cohort_embeddings(encoder_name: str) -> list:
+    # The catalog snapshot already carries each slide's Trident output path.
+    return load_cohort_embeddings(slide_catalog.slides("complete"), encoder_name)
+
+
+@router.post("/slides/{slide_id}/similar", tags=["WSI Analysis"])
+async def find_similar_regions(slide_id: str, request: SimilarRegionRequest):
+    """
+    Returns the patches most similar to a region of interest, from this slide or the whole cohort,
+    by cosine similarity of patch embeddings extracted at ingestion. The query is the mean of the
+    embeddings of the ROI's patches; an ROI without stored patches is embedded on the fly.
+    """
+    encoder_name = request.encoder or EMBEDDINGS_ENCODER
+    if encoder_name not in ENCODERS:
+        raise HTTPException(status_code=400, detail=f"Unknown encoder '{encoder_name}'. Available encoders: {list(ENCODERS)}")
+    try:
+        metadata = await get_slide_metadata_async(slide_id)
+        slide_gcs_uri = metadata.get('gcs_original_path')
+        if not slide_gcs_uri:
+            raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
+        slide_io = get_slide_io()
+        embeddings = await slide_io.run("fetch", slide_id, load_slide_embeddings, slide_id, metadata.get("trident_output_path"), encoder_name)
+        if embeddings is None and request.scope == "slide":
+            raise HTTPException(status_code=404, detail=f"Slide {slide_id} has no {encoder_name} embeddings; ingest it with extract_embeddings.")
+
+        downsample = 1.0
+        if request.level:
+            downsamples = await get_slide_level_downsamples(slide_id)
+            if request.level >= len(downsamples):
+                raise HTTPException(status_code=400, detail=f"Slide {slide_id} has {len(downsamples)} levels.")
+            downsample = downsamples[request.level]
+        width, height = request.width * downsample, request.height * downsample
+
+        rows = embeddings.overlapping(request.x, request.y, width, height) if embeddings is not None else np.empty(0, dtype=np.int64)
+        if len(rows):
+            query = query_vector(embeddings.vectors[np.sort(rows)])
+        else:
+            patch_size = embeddings.patch_size if embeddings is not None else DEFAULT_PATCH_SIZE_LEVEL0
+            query = await slide_io.run("decode", slide_gcs_uri, _encode_roi, slide_gcs_uri, encoder_name, patch_size, request.x, request.y, width, height)
+
+        slides = [embeddings] if request.scope == "slide" else await slide_io.run("fetch", None, _load_cohort_embeddings, encoder_name)
+        exclude = (slide_id, rows) if len(rows) else None
+        matches, method = await slide_io.run("decode", None, search, slides, query, request.k, exclude)
+    except (HTTPException, SlideIOOverloaded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not search similar regions: {e}")
+
+    by_id = {slide.slide_id: slide for slide in slides}
+    return {
+        "slide_id": slide_id,
+        "encoder": encoder_name,
+        "scope": request.scope,
+        "method": method,
+        "query": {"source": "patches" if len(rows) else "encoded", "patches": int(len(rows))},
+        "results": [
+            {
+                "slide_id": match_slide_id,
+                "x": int(by_id[match_slide_id].coords[row, 0]),
+                "y": int(by_id[match_slide_id].coords[row, 1]),
+                "size": by_id[match_slide_id].patch_size,
+                "score": round(score, 4),
+            }
+            for match_slide_id, row, score in matches
+        ],
+    }
+
+
+# Tiles answered from the tissue index without touching the WSI.
+tissue_tile_stats = {"background_tiles": 0, "tissue_tiles": 0, "unindexed_tiles": 0}
+register_stats("tissue-index", lambda: {**get_tissue_index_registry().stats(), **tissue_tile_stats})
+
+
+async def _slide_tissue_index(slide_id: str, wait: bool = False):
+    """Returns the slide's Trident tissue index, or None if it has none (or, unless `wait`, it is still loading)."""
+    metadata = await get_slide_metadata_async(slide_id)
+    trident_output_path = metadata.get("trident_output_path")
+    registry = get_tissue_index_registry()
+    if not wait:
+        return registry.get_nowait(trident_output_path)
+    return await get_slide_io().run("fetch", trident_output_path, registry.get, trident_output_path)
+
+
+async def _known_background(slide_id: str, level: int, x: int, y: int, tile_size: int, downsample: float) -> bool:
+    """True if the tissue index or an earlier classification shows the tile holds no tissue."""
+    if TISSUE_INDEX_ENABLED:
+        index = await _slide_tissue_index(slide_id)
+        if index is not None:
+            extent = tile_size * downsample
+            if not index.has_tissue(x, y, extent, extent):
+                tissue_tile_stats["background_tiles"] += 1
+                return True
+            tissue_tile_stats["tissue_tiles"] += 1
+        else:
+            tissue_tile_stats["unindexed_tiles"] += 1
+    return BACKGROUND_DETECTION and background_bitmap.is_known_background(slide_id, level, x, y, tile_size, downsample)
+
+
+async def _encode_region(image, slide_id: str, slide_gcs_uri: str, level: int, x: int, y: int, tile_size: int, downsample: float, level_dimensions: tuple, fmt: str, quality: Optional[int]):
+    """Encodes a decoded region, or returns the shared background tile if the region is classified as background."""
+    if BACKGROUND_DETECTION:
+        background = await get_slide_io().run("decode", slide_gcs_uri, is_background, image)
+        background_bitmap.record(slide_id, level, x, y, tile_size, downsample, level_dimensions, background)
+        if background:
+            tile = background_tile(fmt, quality, tile_size, tile_size)
+            return tile.content, tile.media_type
+    return await encode_image_async(image, fmt, quality, slide_key=slide_gcs_uri)
+
+
+async def get_cached_wsi_tile(slide_id: str, level: int, x: int, y: int, fmt: str, quality: Optional[int], tile_size: int = TILE_SIZE) -> CachedTile:
+    """
+    Returns an encoded tile from the tile cache, reading and encoding it on a miss. Tiles known to
+    hold no tissue, from the tissue index or an earlier classification, are answered with the
+    shared background tile without reading the WSI.
+    """
+    downsamples, dimensions = (), ()
+    if TISSUE_INDEX_ENABLED or BACKGROUND_DETECTION:
+        downsamples, dimensions = await get_slide_level_geometry(slide_id)
+    if 0 <= level < len(downsamples) and await _known_background(slide_id, level, x, y, tile_size, downsamples[level]):
+        return background_tile(fmt, quality, tile_size, tile_size)
+
+    async def render_tile():
+        metadata = await get_slide_metadata_async(slide_id)
         slide_gcs_uri = metadata.get('gcs_original_path')
         if not slide_gcs_uri:
             raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
-        
-        image = load_wsi_tile(slide_gcs_uri, x, y, 256, 256, level) # Assume 256x256 tiles
-        
-        with io.BytesIO() as output:
-            image.save(output, format="PNG")
-            return Response(content=output.getvalue(), media_type="image/png")
+
+        image = await load_wsi_tile_async(slide_gcs_uri, x, y, tile_size, tile_size, level)
+        if not 0 <= level < len(downsamples):
+            return await encode_image_async(image, fmt, quality, slide_key=slide_gcs_uri)
+        return await _encode_region(image, slide_id, slide_gcs_uri, level, x, y, tile_size, downsamples[level], dimensions[level], fmt, quality)
+
+    key = make_tile_key(slide_id, level, x, y, tile_size, tile_size, fmt, quality)
+    return await get_tile_cache().get_or_create_async(key, render_tile)
+
+
+def _read_level_geometry(slide_gcs_uri: str) -> tuple:
+    with open_wsi_reader(slide_gcs_uri) as slide:
+        return tuple(slide.level_downsamples), tuple(slide.level_dimensions)
+
+
+_level_geometry: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+async def get_slide_level_geometry(slide_id: str) -> tuple:
+    """Returns (level downsamples, level dimensions) of a slide, memoized per slide."""
+    geometry = _level_geometry.get(slide_id)
+    if geometry is not None:
+        return geometry
+    metadata = await get_slide_metadata_async(slide_id)
+    slide_gcs_uri = metadata.get('gcs_original_path')
+    if not slide_gcs_uri:
+        raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
+    geometry = await get_slide_io().run("fetch", slide_gcs_uri, _read_level_geometry, slide_gcs_uri)
+    _level_geometry[slide_id] = geometry
+    while len(_level_geometry) > 256:
+        _level_geometry.popitem(last=False)
+    return geometry
+
+
+async def get_slide_level_downsamples(slide_id: str) -> tuple:
+    downsamples, _ = await get_slide_level_geometry(slide_id)
+    return downsamples
+
+
+# Warms the tile cache around each session's viewport; fed by viewport telemetry from the websocket.
+tile_prefetcher = TilePrefetcher(
+    render_tile=get_cached_wsi_tile,
+    get_level_downsamples=get_slide_level_downsamples,
+    tile_size=TILE_SIZE,
+    default_format=TILE_DEFAULT_FORMAT,
+)
+register_stats("prefetch", tile_prefetcher.stats)
+
+
+@router.get("/tiles/{slide_id}/{level}/{x}_{y}.png", tags=["WSI Tiling"])
+async def get_wsi_tile_endpoint(
+    slide_id: str,
+    level: int,
+    x: int,
+    y: int,
+    format: Optional[str] = Query(None, description="Tile format (png, jpeg or webp). Overrides the Accept header."),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Quality for lossy formats."),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    x_session_id: Optional[str] = Header(None),
+):
+    """
+    Serves a single tile from a Whole-Slide Image stored in GCS, through the encoded tile cache.
+    The encoding is chosen from the `format` query parameter, then the Accept header, then the route default.
+    Viewers that send their websocket session in `X-Session-Id` get tiles prefetched in the same encoding.
+    """
+    try:
+        fmt = negotiate_format(accept, format, TILE_DEFAULT_FORMAT)
+    except ValueError as e:
+        raise HTTPException(status_code=406 if format is None else 400, detail=str(e))
+    quality = resolve_quality(fmt, quality)
+
+    try:
+        key = make_tile_key(slide_id, level, x, y, TILE_SIZE, TILE_SIZE, fmt, quality)
+        tile_prefetcher.note_request(key, slide_id, fmt, quality, x_session_id)
+        tile = await get_cached_wsi_tile(slide_id, level, x, y, fmt, quality)
+        return _tile_response(tile, if_none_match, vary_accept=format is None)
+    except (HTTPException, SlideIOOverloaded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not retrieve WSI tile: {e}")
 
 
+def _read_tile(reader, x: int, y: int, tile_size: int, level: int):
+    return reader.read_region((x, y), level, (tile_size, tile_size)).convert("RGB")
+
+
+def _batch_frame(header: dict, content: bytes = b"") -> bytes:
+    """Encodes one batch frame: a 4-byte big-endian header length, the JSON header, then the payload."""
+    header = {**header, "length": len(content)}
+    header_bytes = json.dumps(header).encode("utf-8")
+    return struct.pack(">I", len(header_bytes)) + header_bytes + content
+
+
+def _batch_tile_origins(batch: TileBatchRequest, downsample: float) -> list:
+    """Expands the request into level-0 tile origins on the route's tile grid."""
+    if batch.tiles is not None:
+        return list(dict.fromkeys((int(x), int(y)) for x, y in batch.tiles))
+    step = batch.tile_size * downsample
+    first_col, first_row = int(batch.rect.x // step), int(batch.rect.y // step)
+    last_col = int((batch.rect.x + batch.rect.width - 1) // step)
+    last_row = int((batch.rect.y + batch.rect.height - 1) // step)
+    return [
+        (int(round(col * step)), int(round(row * step)))
+        for row in range(first_row, last_row + 1)
+        for col in range(first_col, last_col + 1)
+    ]
+
+
+@router.post("/tiles/{slide_id}/{level}/batch", tags=["WSI Tiling"])
+async def get_wsi_tile_batch(slide_id: str, level: int, batch: TileBatchRequest, accept: Optional[str] = Header(None)):
+    """
+    Serves many tiles of one slide level in a single response, e.g. a whole viewport.
+
+    The body is a stream of frames in completion order. Each frame is a 4-byte big-endian header
+    length, a JSON header (`x`, `y`, `status`, `media_type`, `etag`, `length`) and `length` bytes of
+    encoded tile. The metadata lookup and slide handle are shared by all tiles of the batch, and
+    tiles are read in parallel through the slide I/O pools and the encoded tile cache.
+    """
+    if (batch.tiles is None) == (batch.rect is None):
+        raise HTTPException(status_code=400, detail="Provide exactly one of 'tiles' or 'rect'.")
+    try:
+        fmt = negotiate_format(None if batch.format else accept, batch.format, TILE_DEFAULT_FORMAT)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    quality = resolve_quality(fmt, batch.quality)
+
+    metadata = await get_slide_metadata_async(slide_id)
+    slide_gcs_uri = metadata.get('gcs_original_path')
+    if not slide_gcs_uri:
+        raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
+
+    slide_io = get_slide_io()
+    handle_stack = contextlib.ExitStack()
+    try:
+        reader = await slide_io.run("fetch", slide_gcs_uri, handle_stack.enter_context, open_wsi_reader(slide_gcs_uri))
+        if not 0 <= level < reader.level_count:
+            raise HTTPException(status_code=404, detail=f"Invalid level {level} for slide {slide_id}.")
+        origins = _batch_tile_origins(batch, reader.level_downsamples[level])
+        if len(origins) > TILE_BATCH_MAX_TILES:
+            raise HTTPException(status_code=413, detail=f"Batch of {len(origins)} tiles exceeds the limit of {TILE_BATCH_MAX_TILES}.")
+    except BaseException:
+        handle_stack.close()
+        raise
+    downsample, level_dimensions = reader.level_downsamples[level], reader.level_dimensions[level]
+
+    async def fetch_tile(x: int, y: int):
+        async def render():
+            image = await slide_io.run("decode", slide_gcs_uri, _read_tile, reader, x, y, batch.tile_size, level)
+            return await _encode_region(image, slide_id, slide_gcs_uri, level, x, y, batch.tile_size, downsample, level_dimensions, fmt, quality)
+
+        try:
+            if await _known_background(slide_id, level, x, y, batch.tile_size, downsample):
+                tile = background_tile(fmt, quality, batch.tile_size, batch.tile_size)
+                return _batch_frame({"x": x, "y": y, "status": 200, "media_type": tile.media_type, "etag": tile.etag}, tile.content)
+            key = make_tile_key(slide_id, level, x, y, batch.tile_size, batch.tile_size, fmt, quality)
+            tile = await get_tile_cache().get_or_create_async(key, render)
+            return _batch_frame({"x": x, "y": y, "status": 200, "media_type": tile.media_type, "etag": tile.etag}, tile.content)
+        except SlideIOOverloaded as e:
+            return _batch_frame({"x": x, "y": y, "status": 503, "error": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            return _batch_frame({"x": x, "y": y, "status": 500, "error": str(e)})
+
+    async def stream_frames():
+        tasks = [asyncio.ensure_future(fetch_tile(x, y)) for x, y in origins]
+        try:
+            for next_frame in asyncio.as_completed(tasks):
+                yield await next_frame
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            handle_stack.close()
+
+    return StreamingResponse(
+        stream_frames(),
+        media_type=TILE_BATCH_MEDIA_TYPE,
+        headers={"X-Tile-Count": str(len(origins)), "Cache-Control": "no-store"},
+        # Also release the handle if the stream is never iterated (e.g. the client went away).
+        background=BackgroundTask(handle_stack.close),
+    )
+
+
+def _get_dzi_source(slide_id: str):
+    """
+    Returns (geometry, slide GCS URI, highest pre-rendered level) for a slide. The geometry recorded at
+    ingestion is used when present, so the descriptor and pre-rendered tiles never require opening the WSI.
+    """
+    metadata = get_slide_metadata(slide_id)
+    slide_gcs_uri = metadata.get('gcs_original_path')
+    if not slide_gcs_uri:
+        raise HTTPException(status_code=404, detail=f"GCS path for slide {slide_id} not found in metadata.")
+    dzi_metadata = metadata.get("dzi")
+    if dzi_metadata:
+        return DeepZoomGeometry.from_dict(dzi_metadata), slide_gcs_uri, dzi_metadata.get("prerendered_max_level", -1)
+    with open_wsi_reader(slide_gcs_uri) as slide:
+        return geometry_for_reader(slide, DZI_OVERLAP), slide_gcs_uri, -1
+
+
+def _render_dzi_tile(slide_gcs_uri: str, geometry: DeepZoomGeometry, level: int, col: int, row: int):
+    with open_wsi_reader(slide_gcs_uri) as slide:
+        return render_tile(slide, geometry, level, col, row)
+
+
+@router.get("/dzi/{slide_id}.dzi", tags=["Deep Zoom"])
+async def get_dzi_descriptor(slide_id: str):
+    """Serves the Deep Zoom (DZI) descriptor for a slide."""
+    try:
+        geometry, _, _ = await get_slide_io().run("fetch", slide_id, _get_dzi_source, slide_id)
+        return Response(content=geometry.descriptor(DZI_FORMAT), media_type="application/xml")
+    except (HTTPException, SlideIOOverloaded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not build Deep Zoom descriptor: {e}")
+
+
+@router.get("/dzi/{slide_id}_files/{level}/{col}_{row}.{fmt}", tags=["Deep Zoom"])
+async def get_dzi_tile(
+    slide_id: str,
+    level: int,
+    col: int,
+    row: int,
+    fmt: str,
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Quality for lossy formats."),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Serves a Deep Zoom tile aligned to the slide's native tile grid, preferring pre-rendered tiles."""
+    try:
+        fmt = normalize_format(fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if quality is None and fmt == "jpeg":
+        quality = DZI_JPEG_QUALITY
+    quality = resolve_quality(fmt, quality)
+
+    async def render_dzi_tile():
+        slide_io = get_slide_io()
+        geometry, slide_gcs_uri, prerendered_max_level = await slide_io.run("fetch", slide_id, _get_dzi_source, slide_id)
+        if level <= prerendered_max_level and quality == resolve_quality(fmt, DZI_JPEG_QUALITY if fmt == "jpeg" else None):
+            tile_store = get_tile_store()
+            if tile_store is not None:
+                content = await slide_io.run("fetch", slide_id, tile_store.get, slide_id, level, col, row, fmt)
+                if content is not None:
+                    return content, media_type_for(fmt)
+        try:
+            geometry.tile_bounds(level, col, row)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        image = await slide_io.run("decode", slide_gcs_uri, _render_dzi_tile, slide_gcs_uri, geometry, level, col, row)
+        return await encode_image_async(image, fmt, quality, slide_key=slide_gcs_uri)
+
+    try:
+        key = make_dzi_tile_key(slide_id, level, col, row, DZI_OVERLAP, fmt, quality)
+        tile = await get_tile_cache().get_or_create_async(key, render_dzi_tile)
+        return _tile_response(tile, if_none_match)
+    except (HTTPException, SlideIOOverloaded):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not retrieve Deep Zoom tile: {e}")
+
+
 @router.post("/process", status_code=202, tags=["WSI Processing"])
-async def trigger_slide_processing(request: SlideProcessingRequest, background_tasks: BackgroundTasks):
-    """Accepts a WSI for processing and triggers the Trident pipeline as a background task."""
+async def trigger_slide_processing(request: SlideProcessingRequest):
+    """Accepts a WSI for processing and queues a Trident ingestion job for the worker pool."""
     output_gcs_base_path = f"gs://{os.getenv('WSI_BUCKET')}/processed/trident_output"
-    background_tasks.add_task(
-        process_wsi_with_trident,
-        request.slide_id,
-        request.gcs_uri,
-        output_gcs_base_path
-    )
-    return {"message": "Slide processing initiated.", "slide_id": request.slide_id}
+    payload = {
+        "slide_id": request.slide_id,
+        "gcs_uri": request.gcs_uri,
+        "output_gcs_base_path": output_gcs_base_path,
+        "extract_embeddings": request.extract_embeddings,
+    }
+    job = await asyncio.to_thread(get_job_queue().enqueue, request.slide_id, payload, request.priority)
+    # The worker's status updates invalidate its own process only; drop this process's entry so the
+    # next read sees them (entries of slides being processed expire quickly after that).
+    invalidate_slide_metadata(request.slide_id)
+    return {"message": "Slide processing initiated.", "slide_id": request.slide_id, "job_id": job["id"], "status": job["status"]}
+
+
+@router.get("/jobs", tags=["WSI Processing"])
+async def list_processing_jobs(status: Optional[str] = None, slide_id: Optional[str] = None, limit: int = Query(100, ge=1, le=1000)):
+    """Lists ingestion jobs, most recent first, optionally filtered by status or slide."""
+    queue = get_job_queue()
+    jobs = await asyncio.to_thread(queue.list_jobs, status, slide_id, limit)
+    return {"jobs": jobs, "counts": await asyncio.to_thread(queue.stats)}
+
+
+@router.get("/jobs/{job_id}", tags=["WSI Processing"])
+async def get_processing_job(job_id: str):
+    """Returns an ingestion job with its status, attempts and progress."""
+    job = await asyncio.to_thread(get_job_queue().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
@@ -0,0 +1,57 @@
+import asyncio
+import importlib
+from fastapi import APIRouter, HTTPException
+from app.services.session_store import SqliteSessionService
+from app.common.stats_registry import get_stats_provider, stats_names
+
+router = APIRouter(prefix="/stats", tags=["Service Stats"])
+
+# Modules whose components register a stats provider when imported. Listed here so every provider is
+# registered before the first request, whichever modules the app happened to load.
+STATS_MODULES = (
+    "app.common.background",
+    "app.common.firestore_store",
+    "app.common.inference_cache",
+    "app.common.metadata_cache",
+    "app.common.slide_cache",
+    "app.common.slide_catalog",
+    "app.common.slide_io",
+    "app.common.snapshot_buffer",
+    "app.common.tiff_region_reader",
+    "app.common.tile_cache",
+    "app.common.tile_encoding",
+    "app.agents.fast_path",
+    "app.agents.tools.medgemma_tools",
+    "app.services.event_scheduler",
+    "app.services.slide_router",
+    "app.services.websocket_manager",
+)
+for module in STATS_MODULES:
+    importlib.import_module(module)
+
+
+@router.get("")
+async def list_stats():
+    """Lists the registered stats, each served at `/stats/{name}`."""
+    return {"stats": stats_names() + ["sessions"]}
+
+
+@router.get("/sessions")
+async def get_session_stats(limit: int = 50):
+    """Reports per-session event counts, stored bytes and estimated prompt tokens, largest first."""
+    from app.services.main import session_service
+
+    if not isinstance(session_service, SqliteSessionService):
+        return {"store": "memory"}
+    return {"store": "sqlite", **await asyncio.to_thread(session_service.stats, limit)}
+
+
+@router.get("/{name}")
+async def get_stats(name: str):
+    """Reports the counters of one registered component, e.g. `tile-cache` or `websockets`."""
+    provider = get_stats_provider(name)
+    if provider is None:
+        raise HTTPException(status_code=404, detail=f"No stats named '{name}'. Known: {', '.join(stats_names())}.")
+    if provider.blocking:
+        return await asyncio.to_thread(provider.collect)
+    return provider.collect()
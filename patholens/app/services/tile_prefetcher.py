@@ -0,0 +1,257 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.common.slide_io import get_slide_io
+from app.common.tile_cache import make_tile_key
+from app.common.tile_encoding import negotiate_format, resolve_quality
+
+
+class _SessionMotion:
+    """Viewport history of one session: last position, smoothed velocity and prefetch budget."""
+
+    def __init__(self, budget: float):
+        self.slide_id: Optional[str] = None
+        self.level: Optional[int] = None
+        self.center: Optional[Tuple[float, float]] = None
+        self.timestamp = 0.0
+        self.velocity = (0.0, 0.0)  # level-0 pixels per second
+        self.tokens = budget
+        self.refilled_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        # (format, quality) the session's own tile requests were served in.
+        self.encoding: Optional[Tuple[str, int]] = None
+
+
+class TilePrefetcher:
+    """
+    Warms the tile cache ahead of the viewer using viewport telemetry.
+
+    For each session it tracks pan velocity (exponentially smoothed), predicts where the viewport
+    will be shortly, and renders the ring of tiles around the current and predicted viewport plus
+    the overlapping tiles of the adjacent zoom levels. Work is low priority: each session has a
+    token-bucket budget, a newer viewport cancels the previous prefetch, and nothing is scheduled
+    while the decode pool is busy serving real requests.
+    """
+
+    def __init__(
+        self,
+        render_tile: Callable[..., Awaitable],
+        get_level_downsamples: Callable[[str], Awaitable[tuple]],
+        tile_size: int,
+        default_format: str,
+    ):
+        self.render_tile = render_tile
+        self.get_level_downsamples = get_level_downsamples
+        self.tile_size = tile_size
+        self.default_format = default_format
+        self.enabled = os.getenv("PREFETCH_ENABLED", "1") == "1"
+        self.ring = int(os.getenv("PREFETCH_RING", "1"))
+        self.lookahead_seconds = float(os.getenv("PREFETCH_LOOKAHEAD_SECONDS", "0.5"))
+        self.tiles_per_second = float(os.getenv("PREFETCH_TILES_PER_SECOND", "20"))
+        self.burst = float(os.getenv("PREFETCH_BURST", "60"))
+        self.max_concurrency = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+        self.busy_threshold = float(os.getenv("PREFETCH_BUSY_THRESHOLD", "0.5"))
+        self._sessions: Dict[str, _SessionMotion] = {}
+        # Last (format, quality) served per slide, for sessions whose tile requests are not tagged.
+        self._slide_encodings: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._downsamples: "OrderedDict[str, tuple]" = OrderedDict()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Keys warmed by the prefetcher and not yet requested, with the render time they cost.
+        self._prefetched: "OrderedDict[str, float]" = OrderedDict()
+        self._max_tracked = int(os.getenv("PREFETCH_TRACKED_KEYS", "20000"))
+        self._stats = {
+            "viewport_events": 0,
+            "tiles_prefetched": 0,
+            "tiles_skipped_budget": 0,
+            "tiles_skipped_busy": 0,
+            "prefetch_errors": 0,
+            "tile_requests": 0,
+            "prefetch_hits": 0,
+            "prefetched_unused": 0,
+            "latency_saved_seconds": 0.0,
+        }
+
+    # --- Telemetry input ---
+
+    def observe(self, session_id: str, payload: dict):
+        """Consumes a viewport_update payload and schedules prefetching without blocking the caller."""
+        if not self.enabled:
+            return
+        try:
+            slide_id = payload["slide_id"]
+            level = int(payload["level"])
+            x, y = float(payload["x"]), float(payload["y"])
+            width, height = float(payload["width"]), float(payload["height"])
+        except (KeyError, TypeError, ValueError):
+            return
+        self._stats["viewport_events"] += 1
+
+        motion = self._sessions.setdefault(session_id, _SessionMotion(self.burst))
+        now = time.monotonic()
+        motion.tokens = min(self.burst, motion.tokens + (now - motion.refilled_at) * self.tiles_per_second)
+        motion.refilled_at = now
+
+        if motion.task is not None and not motion.task.done():
+            motion.task.cancel()
+        motion.task = asyncio.ensure_future(
+            self._prefetch_viewport(motion, slide_id, level, x, y, width, height, now, payload.get("tile_format"))
+        )
+
+    def forget_session(self, session_id: str):
+        motion = self._sessions.pop(session_id, None)
+        if motion is not None and motion.task is not None:
+            motion.task.cancel()
+
+    def note_request(self, key: str, slide_id: str, fmt: str, quality: int, session_id: Optional[str] = None):
+        """
+        Called by the tile route for every request, to measure how often prefetching pays off and
+        to learn the encoding the viewer negotiates, so prefetched tiles land on the keys it requests.
+        """
+        self._stats["tile_requests"] += 1
+        if session_id is not None and session_id in self._sessions:
+            self._sessions[session_id].encoding = (fmt, quality)
+        self._slide_encodings[slide_id] = (fmt, quality)
+        self._slide_encodings.move_to_end(slide_id)
+        while len(self._slide_encodings) > 1024:
+            self._slide_encodings.popitem(last=False)
+        render_seconds = self._prefetched.pop(key, None)
+        if render_seconds is not None:
+            self._stats["prefetch_hits"] += 1
+            self._stats["latency_saved_seconds"] += render_seconds
+
+    # --- Prediction ---
+
+    async def _level_downsamples(self, slide_id: str) -> tuple:
+        downsamples = self._downsamples.get(slide_id)
+        if downsamples is None:
+            downsamples = await self.get_level_downsamples(slide_id)
+            self._downsamples[slide_id] = downsamples
+            while len(self._downsamples) > 256:
+                self._downsamples.popitem(last=False)
+        return downsamples
+
+    def _tiles_in_rect(self, x0: float, y0: float, x1: float, y1: float, downsample: float) -> List[Tuple[int, int]]:
+        """Level-0 origins of the grid tiles intersecting a level-0 rectangle."""
+        step = self.tile_size * downsample
+        cols = range(max(0, int(x0 // step)), int(max(x0, x1 - 1) // step) + 1)
+        rows = range(max(0, int(y0 // step)), int(max(y0, y1 - 1) // step) + 1)
+        return [(int(round(col * step)), int(round(row * step))) for row in rows for col in cols]
+
+    def _plan(self, motion: _SessionMotion, slide_id: str, level: int, x: float, y: float, width: float, height: float, now: float, downsamples: tuple) -> List[Tuple[int, int, int]]:
+        """Returns (level, x, y) tiles to warm, most useful first."""
+        downsample = downsamples[level]
+        view_w, view_h = width * downsample, height * downsample
+        center = (x + view_w / 2, y + view_h / 2)
+
+        if motion.slide_id == slide_id and motion.level == level and motion.center is not None:
+            dt = max(now - motion.timestamp, 1e-3)
+            instant = ((center[0] - motion.center[0]) / dt, (center[1] - motion.center[1]) / dt)
+            motion.velocity = (0.5 * motion.velocity[0] + 0.5 * instant[0], 0.5 * motion.velocity[1] + 0.5 * instant[1])
+        else:
+            motion.velocity = (0.0, 0.0)
+        motion.slide_id, motion.level, motion.center, motion.timestamp = slide_id, level, center, now
+
+        # The lead is capped at one viewport per axis: a jump (e.g. a minimap click) right after the
+        # previous update would otherwise predict a huge rectangle of tiles.
+        lead_x = max(-view_w, min(view_w, motion.velocity[0] * self.lookahead_seconds))
+        lead_y = max(-view_h, min(view_h, motion.velocity[1] * self.lookahead_seconds))
+        predicted = (center[0] + lead_x, center[1] + lead_y)
+        margin = self.ring * self.tile_size * downsample
+        # Union of the current and predicted viewport, grown by the ring.
+        x0 = min(center[0], predicted[0]) - view_w / 2 - margin
+        y0 = min(center[1], predicted[1]) - view_h / 2 - margin
+        x1 = max(center[0], predicted[0]) + view_w / 2 + margin
+        y1 = max(center[1], predicted[1]) + view_h / 2 + margin
+
+        # Tiles of the current viewport are already being requested by the viewer.
+        visible = set(self._tiles_in_rect(x, y, x + view_w, y + view_h, downsample))
+        ring = [tile for tile in self._tiles_in_rect(x0, y0, x1, y1, downsample) if tile not in visible]
+        step = self.tile_size * downsample
+        ring.sort(key=lambda t: math.hypot(t[0] + step / 2 - predicted[0], t[1] + step / 2 - predicted[1]))
+        plan = [(level, tx, ty) for tx, ty in ring]
+
+        # Adjacent zoom levels: the coarser level over the whole viewport, the finer one over its centre.
+        if level + 1 < len(downsamples):
+            plan += [(level + 1, tx, ty) for tx, ty in self._tiles_in_rect(x, y, x + view_w, y + view_h, downsamples[level + 1])]
+        if level > 0:
+            plan += [
+                (level - 1, tx, ty)
+                for tx, ty in self._tiles_in_rect(center[0] - view_w / 4, center[1] - view_h / 4, center[0] + view_w / 4, center[1] + view_h / 4, downsamples[level - 1])
+            ]
+        return plan
+
+    # --- Execution ---
+
+    def _decode_pool_busy(self) -> bool:
+        decode = get_slide_io().stats()["decode"]
+        return decode["pending"] >= decode["max_workers"] * self.busy_threshold
+
+    def _encoding_for(self, motion: _SessionMotion, slide_id: str, tile_format: Optional[str]) -> Tuple[str, int]:
+        """
+        The (format, quality) to warm: an explicit format from the telemetry, else what this session's
+        (or, untagged, this slide's) tile requests negotiated, else the route default.
+        """
+        if tile_format:
+            fmt = negotiate_format(None, tile_format, self.default_format)
+            return fmt, resolve_quality(fmt)
+        encoding = motion.encoding or self._slide_encodings.get(slide_id)
+        if encoding is not None:
+            return encoding
+        fmt = negotiate_format(None, None, self.default_format)
+        return fmt, resolve_quality(fmt)
+
+    async def _prefetch_viewport(self, motion: _SessionMotion, slide_id: str, level: int, x: float, y: float, width: float, height: float, now: float, tile_format: Optional[str]):
+        try:
+            downsamples = await self._level_downsamples(slide_id)
+            if not 0 <= level < len(downsamples):
+                return
+            fmt, quality = self._encoding_for(motion, slide_id, tile_format)
+            plan = self._plan(motion, slide_id, level, x, y, width, height, now, downsamples)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Tile prefetch planning failed for slide {slide_id}: {e}")
+            self._stats["prefetch_errors"] += 1
+            return
+
+        for tile_level, tx, ty in plan:
+            key = make_tile_key(slide_id, tile_level, tx, ty, self.tile_size, self.tile_size, fmt, quality)
+            if key in self._prefetched:
+                continue
+            if motion.tokens < 1:
+                self._stats["tiles_skipped_budget"] += 1
+                continue
+            if self._decode_pool_busy():
+                self._stats["tiles_skipped_busy"] += 1
+                return
+            motion.tokens -= 1
+            async with self._semaphore:
+                start = time.perf_counter()
+                try:
+                    await self.render_tile(slide_id, tile_level, tx, ty, fmt, quality)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self._stats["prefetch_errors"] += 1
+                    continue
+                self._remember(key, time.perf_counter() - start)
+
+    def _remember(self, key: str, render_seconds: float):
+        self._stats["tiles_prefetched"] += 1
+        self._prefetched[key] = render_seconds
+        while len(self._prefetched) > self._max_tracked:
+            self._prefetched.popitem(last=False)
+            self._stats["prefetched_unused"] += 1
+
+    def stats(self) -> dict:
+        requests = self._stats["tile_requests"]
+        return {
+            **self._stats,
+            "enabled": self.enabled,
+            "active_sessions": len(self._sessions),
+            "hit_rate": self._stats["prefetch_hits"] / requests if requests else 0.0,
+        }
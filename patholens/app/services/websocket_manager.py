@@ -1,32 +1,215 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
 from fastapi import WebSocket
-from typing import Dict, List
+
+from app.common.stats_registry import register_stats
+
+try:
+    import msgpack
+except ImportError:  # Binary framing is optional; clients asking for it get JSON text frames.
+    msgpack = None
+
+# Outbound messages buffered per connection before the slow-consumer policy applies.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do when a connection's queue is full: `drop_oldest` discards its oldest queued message,
+# `disconnect` closes the connection so the client reconnects and resynchronizes.
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# Close code sent to clients disconnected for falling behind ("try again later").
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+ENCODINGS = ("json", "msgpack")
+
+
+def _encode(message: dict, encoding: str):
+    if encoding == "msgpack":
+        return msgpack.packb(message, default=str)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class Connection:
+    """
+    One client socket: a bounded queue of encoded frames drained by its own writer task, so a slow
+    client only delays itself. Records queueing lag (enqueue to sent) for the stats endpoint.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, websocket: WebSocket, session_id: str, encoding: str, queue_size: int, policy: str):
+        self.id = next(self._ids)
+        self.websocket = websocket
+        self.session_id = session_id
+        self.encoding = encoding
+        self.queue_size = queue_size
+        self.policy = policy
+        self.connected_at = time.monotonic()
+        self.closed = False
+        self.close_code: Optional[int] = None
+        self._queue: Deque[Tuple[float, object]] = deque()
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self.stats = {"sent": 0, "dropped": 0, "bytes": 0, "lag_last_ms": 0.0, "lag_max_ms": 0.0, "lag_total_ms": 0.0}
+
+    def start(self):
+        self._writer = asyncio.ensure_future(self._drain())
+
+    def enqueue(self, frame) -> bool:
+        """Queues an encoded frame without waiting. Returns False if the connection is (now) closed."""
+        if self.closed:
+            return False
+        if len(self._queue) >= self.queue_size:
+            if self.policy == "disconnect":
+                print(f"WebSocket {self.id} of session {self.session_id} fell {len(self._queue)} messages behind; disconnecting")
+                self.close(SLOW_CONSUMER_CLOSE_CODE)
+                return False
+            self._queue.popleft()
+            self.stats["dropped"] += 1
+        self._queue.append((time.monotonic(), frame))
+        self._ready.set()
+        return True
+
+    async def _drain(self):
+        try:
+            while True:
+                if not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                queued_at, frame = self._queue.popleft()
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                lag_ms = (time.monotonic() - queued_at) * 1000
+                self.stats["sent"] += 1
+                self.stats["bytes"] += len(frame)
+                self.stats["lag_last_ms"] = lag_ms
+                self.stats["lag_max_ms"] = max(self.stats["lag_max_ms"], lag_ms)
+                self.stats["lag_total_ms"] += lag_ms
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"WebSocket {self.id} of session {self.session_id} failed to send: {e}")
+            self.close()
+
+    def close(self, code: Optional[int] = None):
+        """Stops the writer; with a `code`, also closes the socket so the receive loop ends."""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if code is not None:
+            asyncio.ensure_future(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def describe(self) -> dict:
+        sent = self.stats["sent"]
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "encoding": self.encoding,
+            "queued": len(self._queue),
+            "sent": sent,
+            "dropped": self.stats["dropped"],
+            "bytes": self.stats["bytes"],
+            "lag_last_ms": round(self.stats["lag_last_ms"], 2),
+            "lag_avg_ms": round(self.stats["lag_total_ms"] / sent, 2) if sent else None,
+            "lag_max_ms": round(self.stats["lag_max_ms"], 2),
+            "oldest_queued_ms": round((time.monotonic() - self._queue[0][0]) * 1000, 2) if self._queue else 0.0,
+            "connected_seconds": round(time.monotonic() - self.connected_at, 1),
+        }
+
 
 class WebSocketManager:
-    def __init__(self):
-        # A dictionary to hold active connections, keyed by session_id
-        self.active_connections: Dict[str, WebSocket] = {}
+    """
+    Tracks every open socket, several per session (one per tab). Sends never wait on the network:
+    messages are encoded once per encoding and queued on each target connection, whose writer task
+    delivers them. Full queues follow WS_SLOW_CONSUMER_POLICY.
+    """
+
+    def __init__(self, queue_size: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        if policy not in ("drop_oldest", "disconnect"):
+            raise ValueError(f"Unknown slow-consumer policy '{policy}'. Use 'drop_oldest' or 'disconnect'.")
+        self.queue_size = queue_size
+        self.policy = policy
+        # Active connections per session_id, keyed by connection id.
+        self.active_connections: Dict[str, Dict[int, Connection]] = {}
+        self._stats = {"connected": 0, "disconnected": 0, "slow_consumer_disconnects": 0}
 
-    async def connect(self, websocket: WebSocket, session_id: str):
-        """Accepts a new WebSocket connection."""
+    async def connect(self, websocket: WebSocket, session_id: str, encoding: str = "json") -> Connection:
+        """Accepts a new WebSocket connection. `encoding` is `json` (text frames) or `msgpack` (binary frames)."""
+        if encoding not in ENCODINGS:
+            encoding = "json"
+        if encoding == "msgpack" and msgpack is None:
+            print("msgpack is not installed; using JSON frames")
+            encoding = "json"
         await websocket.accept()
-        self.active_connections[session_id] = websocket
-        print(f"WebSocket connected for session: {session_id}")
+        connection = Connection(websocket, session_id, encoding, self.queue_size, self.policy)
+        connection.start()
+        self.active_connections.setdefault(session_id, {})[connection.id] = connection
+        self._stats["connected"] += 1
+        print(f"WebSocket {connection.id} connected for session: {session_id} ({encoding})")
+        return connection
+
+    def disconnect(self, connection: Connection):
+        """Stops a connection's writer and forgets it."""
+        connection.close()
+        connections = self.active_connections.get(connection.session_id, {})
+        if connections.pop(connection.id, None) is not None:
+            self._stats["disconnected"] += 1
+            print(f"WebSocket {connection.id} disconnected for session: {connection.session_id}")
+        if not connections:
+            self.active_connections.pop(connection.session_id, None)
 
-    def disconnect(self, session_id: str):
-        """Closes a WebSocket connection."""
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
-            print(f"WebSocket disconnected for session: {session_id}")
+    def _fan_out(self, message: dict, connections):
+        frames = {}
+        for connection in list(connections):
+            if connection.encoding not in frames:
+                frames[connection.encoding] = _encode(message, connection.encoding)
+            if not connection.enqueue(frames[connection.encoding]):
+                if connection.close_code == SLOW_CONSUMER_CLOSE_CODE:
+                    self._stats["slow_consumer_disconnects"] += 1
+                self.disconnect(connection)
 
     async def send_json(self, message: dict, session_id: str):
-        """Sends a JSON message to a specific client."""
-        if session_id in self.active_connections:
-            await self.active_connections[session_id].send_json(message)
+        """Queues a message for every connection of a session."""
+        self._fan_out(message, self.active_connections.get(session_id, {}).values())
+        # Lets writer tasks run between messages of a burst instead of after all of them.
+        await asyncio.sleep(0)
+
+    async def send_json_to(self, message: dict, connection: Connection):
+        """Queues a message for one connection."""
+        self._fan_out(message, [connection])
+        await asyncio.sleep(0)
 
     async def broadcast_json(self, message: dict):
-        """Sends a JSON message to all connected clients."""
-        for session_id, connection in self.active_connections.items():
-            await connection.send_json(message)
+        """Queues a message for all connected clients."""
+        self._fan_out(message, [c for connections in self.active_connections.values() for c in connections.values()])
+        await asyncio.sleep(0)
+
+    def stats(self) -> dict:
+        connections = [c for session in self.active_connections.values() for c in session.values()]
+        return {
+            **self._stats,
+            "policy": self.policy,
+            "queue_size": self.queue_size,
+            "sessions": len(self.active_connections),
+            "connections": [connection.describe() for connection in connections],
+        }
 
 # Create a single instance to be used throughout the application
 websocket_manager = WebSocketManager()
+register_stats("websockets", websocket_manager.stats)
@@ -0,0 +1,266 @@
+import argparse
+import csv
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import List, Optional, Tuple
+
+from google.cloud import storage
+
+from app.trident_processing.processor import (
+    _prerender_deepzoom,
+    _update_firestore_status,
+    download_slide,
+    embed_slide,
+    finalize_slide,
+    segment_slide,
+    upload_outputs,
+)
+
+# Passed down the pipeline after the last slide so each stage knows when to stop.
+_DONE = None
+
+
+class SlideTask:
+    """One slide moving through the pipeline, with its local paths and results."""
+
+    def __init__(self, slide_id: str, gcs_uri: str, workdir: str):
+        self.slide_id = slide_id
+        self.gcs_uri = gcs_uri
+        self.workdir = workdir
+        self.local_slide_path: Optional[str] = None
+        self.job_dir = os.path.join(workdir, "trident_output", slide_id)
+        self.dzi: Optional[dict] = None
+        self.slide_bytes = 0
+
+
+class ThroughputReport:
+    """Thread-safe counters for the end-of-run report."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.stage_seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.failures: List[Tuple[str, str, str]] = []
+
+    def add(self, stage: str, seconds: float, **counters):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def fail(self, slide_id: str, stage: str, error: BaseException):
+        with self._lock:
+            self.failures.append((slide_id, stage, str(error)))
+
+    def print(self):
+        wall = time.monotonic() - self.started_at
+        done = self.counters["slides_completed"]
+        print("\n=== Bulk ingestion report ===")
+        print(f"Slides completed: {done}, failed: {len(self.failures)}, wall time: {wall:.1f}s")
+        if wall > 0:
+            print(f"Throughput: {done * 3600 / wall:.1f} slides/hour")
+        for stage in ("download", "segment", "upload"):
+            seconds = self.stage_seconds[stage]
+            print(f"  {stage:<9} busy {seconds:8.1f}s ({100 * seconds / wall if wall else 0:5.1f}% of wall time)")
+        mib = 1024 ** 2
+        if self.stage_seconds["download"]:
+            print(f"  downloaded {self.counters['bytes_downloaded'] / mib:.1f} MiB "
+                  f"({self.counters['bytes_downloaded'] / mib / self.stage_seconds['download']:.1f} MiB/s per busy second)")
+        if self.stage_seconds["upload"]:
+            print(f"  uploaded {self.counters['bytes_uploaded'] / mib:.1f} MiB in {self.counters['files_uploaded']} files "
+                  f"({self.counters['bytes_uploaded'] / mib / self.stage_seconds['upload']:.1f} MiB/s per busy second); "
+                  f"skipped {self.counters['files_skipped']} unchanged files ({self.counters['bytes_skipped'] / mib:.1f} MiB)")
+        for slide_id, stage, error in self.failures:
+            print(f"  FAILED {slide_id} during {stage}: {error}")
+
+
+def read_manifest(path: str) -> List[Tuple[str, str]]:
+    """
+    Reads a manifest of slides: one `gs://` URI per line, or CSV rows of `slide_id,gcs_uri`.
+    Without an explicit ID, the file name without extension is used. Blank lines and `#` comments are ignored.
+    """
+    slides = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            row = [cell.strip() for cell in row if cell.strip()]
+            if not row or row[0].startswith("#"):
+                continue
+            if len(row) == 1:
+                gcs_uri = row[0]
+                slide_id = os.path.splitext(os.path.basename(gcs_uri))[0]
+            else:
+                slide_id, gcs_uri = row[0], row[1]
+            slides.append((slide_id, gcs_uri))
+    return slides
+
+
+def _download_stage(inbox: "queue.Queue", outbox: "queue.Queue", report: ThroughputReport, storage_client: storage.Client):
+    while True:
+        task = inbox.get()
+        if task is _DONE:
+            return
+        start = time.monotonic()
+        try:
+            _update_firestore_status(task.slide_id, "processing_started", "Downloading WSI from GCS.")
+            task.local_slide_path = download_slide(task.gcs_uri, os.path.join(task.workdir, "wsi_input"), storage_client)
+            task.slide_bytes = os.path.getsize(task.local_slide_path)
+        except Exception as e:
+            report.fail(task.slide_id, "download", e)
+            _update_firestore_status(task.slide_id, "failed", str(e))
+            shutil.rmtree(task.workdir, ignore_errors=True)
+            continue
+        finally:
+            report.add("download", time.monotonic() - start)
+        report.add("download", 0, bytes_downloaded=task.slide_bytes)
+        # Blocks while the segmentation stage is behind, which bounds the slides waiting on disk.
+        outbox.put(task)
+
+
+def _segment_stage(inbox: "queue.Queue", outbox: "queue.Queue", report: ThroughputReport, prerender_dzi: bool, embeddings: bool):
+    while True:
+        task = inbox.get()
+        if task is _DONE:
+            return
+        start = time.monotonic()
+        try:
+            _update_firestore_status(task.slide_id, "running_trident", "Segmentation and coordinate generation in progress.")
+            segment_slide(task.slide_id, task.local_slide_path, task.job_dir)
+            if embeddings:
+                embed_slide(task.slide_id, task.local_slide_path, task.job_dir)
+            if prerender_dzi:
+                task.dzi = _prerender_deepzoom(task.slide_id, task.local_slide_path)
+        except BaseException as e:
+            # Trident runs in-process; whatever it raises (even SystemExit) fails this slide only.
+            report.fail(task.slide_id, "segment", e)
+            _update_firestore_status(task.slide_id, "failed", str(e))
+            shutil.rmtree(task.workdir, ignore_errors=True)
+            continue
+        finally:
+            report.add("segment", time.monotonic() - start)
+        # The slide itself is no longer needed; free the disk before the upload runs.
+        os.remove(task.local_slide_path)
+        outbox.put(task)
+
+
+def _upload_stage(inbox: "queue.Queue", report: ThroughputReport, storage_client: storage.Client, output_gcs_base_path: str, upload_workers: int):
+    while True:
+        task = inbox.get()
+        if task is _DONE:
+            return
+        start = time.monotonic()
+        try:
+            _update_firestore_status(task.slide_id, "uploading_results", "Uploading Trident outputs to GCS.")
+            trident_output_path, counters = upload_outputs(task.slide_id, task.job_dir, output_gcs_base_path, storage_client, upload_workers)
+            finalize_slide(task.slide_id, trident_output_path, task.dzi)
+            report.add("upload", 0, slides_completed=1, **counters)
+        except Exception as e:
+            report.fail(task.slide_id, "upload", e)
+            _update_firestore_status(task.slide_id, "failed", str(e))
+        finally:
+            report.add("upload", time.monotonic() - start)
+            shutil.rmtree(task.workdir, ignore_errors=True)
+
+
+def _run_stage(name: str, stage, inbox: "queue.Queue", report: ThroughputReport, *args):
+    """
+    Runs a stage thread. If the stage dies, the slides still queued for it are failed until its
+    _DONE arrives, so the stages feeding it never block on a full queue and the run still ends.
+    """
+    try:
+        stage(inbox, *args)
+    except BaseException as e:
+        print(f"Bulk ingest {name} stage stopped: {e!r}")
+        while True:
+            task = inbox.get()
+            if task is _DONE:
+                return
+            report.fail(task.slide_id, name, e)
+            _update_firestore_status(task.slide_id, "failed", f"Bulk ingest {name} stage stopped: {e}")
+            shutil.rmtree(task.workdir, ignore_errors=True)
+
+
+def run_pipeline(
+    slides: List[Tuple[str, str]],
+    output_gcs_base_path: str,
+    workdir: str,
+    download_workers: int = 2,
+    upload_workers: int = 8,
+    queue_size: int = 2,
+    prerender_dzi: bool = False,
+    embeddings: bool = False,
+) -> ThroughputReport:
+    """
+    Ingests slides as a three-stage pipeline: download -> Trident segmentation -> upload. Stages
+    run concurrently on different slides and are connected by bounded queues, so at most
+    `queue_size` downloaded slides wait for segmentation and the same number of results wait for
+    upload. Segmentation runs on a single thread because Trident is driven through sys.argv.
+    """
+    storage_client = storage.Client()
+    report = ThroughputReport()
+    to_download = queue.Queue()
+    to_segment = queue.Queue(maxsize=queue_size)
+    to_upload = queue.Queue(maxsize=queue_size)
+
+    for slide_id, gcs_uri in slides:
+        to_download.put(SlideTask(slide_id, gcs_uri, os.path.join(workdir, slide_id)))
+    for _ in range(download_workers):
+        to_download.put(_DONE)
+
+    downloaders = [
+        threading.Thread(
+            target=_run_stage, args=("download", _download_stage, to_download, report, to_segment, report, storage_client), name=f"download-{i}",
+        )
+        for i in range(download_workers)
+    ]
+    segmenter = threading.Thread(
+        target=_run_stage, args=("segment", _segment_stage, to_segment, report, to_upload, report, prerender_dzi, embeddings), name="segment",
+    )
+    uploader = threading.Thread(
+        target=_run_stage, args=("upload", _upload_stage, to_upload, report, report, storage_client, output_gcs_base_path, upload_workers), name="upload",
+    )
+    for thread in downloaders + [segmenter, uploader]:
+        thread.start()
+
+    for thread in downloaders:
+        thread.join()
+    to_segment.put(_DONE)
+    segmenter.join()
+    to_upload.put(_DONE)
+    uploader.join()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a cohort of WSIs with Trident as a pipelined batch.")
+    parser.add_argument("manifest", help="File listing slides: one gs:// URI per line, or CSV rows of slide_id,gcs_uri.")
+    parser.add_argument("--output", default=f"gs://{os.getenv('WSI_BUCKET')}/processed/trident_output", help="GCS prefix for Trident outputs.")
+    parser.add_argument("--workdir", default=None, help="Scratch directory for slides and outputs (default: a temporary directory).")
+    parser.add_argument("--download-workers", type=int, default=2, help="Slides downloaded concurrently.")
+    parser.add_argument("--upload-workers", type=int, default=8, help="Files uploaded concurrently per slide.")
+    parser.add_argument("--queue-size", type=int, default=2, help="Slides buffered between stages.")
+    parser.add_argument("--prerender-dzi", action="store_true", default=os.getenv("DZI_PRERENDER", "0") == "1", help="Also pre-render low-zoom Deep Zoom levels.")
+    parser.add_argument("--embeddings", action="store_true", default=os.getenv("EMBEDDINGS_ENABLED", "0") == "1", help="Also extract patch embeddings.")
+    args = parser.parse_args()
+
+    slides = read_manifest(args.manifest)
+    print(f"Ingesting {len(slides)} slides from {args.manifest} into {args.output}")
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        report = run_pipeline(
+            slides, args.output, workdir,
+            download_workers=args.download_workers,
+            upload_workers=args.upload_workers,
+            queue_size=args.queue_size,
+            prerender_dzi=args.prerender_dzi,
+            embeddings=args.embeddings,
+        )
+    report.print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Optional, Tuple
+
+import h5py
+import numpy as np
+import openslide
+
+from app.common.patch_encoders import EMBEDDINGS_ENCODER, get_encoder
+from app.common.trident_outputs import DEFAULT_PATCH_SIZE_LEVEL0
+
+EMBEDDINGS_BATCH_SIZE = int(os.getenv("EMBEDDINGS_BATCH_SIZE", "64"))
+EMBEDDINGS_READ_WORKERS = int(os.getenv("EMBEDDINGS_READ_WORKERS", "4"))
+
+
+def find_patch_coords(job_dir: str) -> Optional[Tuple[np.ndarray, int]]:
+    """Reads the level-0 patch coordinates and patch size from Trident's output in `job_dir`."""
+    for root, _, files in os.walk(job_dir):
+        if os.path.basename(root) != "patches":
+            continue
+        for file in files:
+            if file.endswith(".h5"):
+                with h5py.File(os.path.join(root, file), "r") as f:
+                    dataset = f["coords"]
+                    return np.asarray(dataset[:], dtype=np.int64), int(dataset.attrs.get("patch_size_level0", DEFAULT_PATCH_SIZE_LEVEL0))
+    return None
+
+
+def extract_embeddings(slide_id: str, local_slide_path: str, job_dir: str, encoder_name: str = EMBEDDINGS_ENCODER) -> Optional[str]:
+    """
+    Embeds every Trident patch of a slide on CPU and writes them to `job_dir/embeddings/<encoder>/`:
+    `embeddings.npy` (float16, one row per patch, memory-mappable), `coords.npy` (level-0 origins in
+    the same order) and `meta.json`. Patches are read from the pyramid level closest to the
+    encoder's input resolution, a few batches ahead of the encoder. Returns the output directory,
+    or None if Trident produced no patches.
+    """
+    patches = find_patch_coords(job_dir)
+    if patches is None or len(patches[0]) == 0:
+        print(f"No Trident patches for {slide_id}; skipping embeddings.")
+        return None
+    coords, patch_size = patches
+    encoder = get_encoder(encoder_name)
+    out_dir = os.path.join(job_dir, "embeddings", encoder.name)
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = np.lib.format.open_memmap(os.path.join(out_dir, "embeddings.npy"), mode="w+", dtype=np.float16, shape=(len(coords), encoder.dim))
+
+    slide = openslide.OpenSlide(local_slide_path)
+    try:
+        level = slide.get_best_level_for_downsample(patch_size / encoder.input_size)
+        downsample = slide.level_downsamples[level]
+        read_size = max(1, int(round(patch_size / downsample)))
+
+        def read_batch(start: int):
+            # OpenSlide handles are safe for concurrent reads.
+            return [slide.read_region((int(x), int(y)), level, (read_size, read_size)) for x, y in coords[start:start + EMBEDDINGS_BATCH_SIZE]]
+
+        starts = iter(range(0, len(coords), EMBEDDINGS_BATCH_SIZE))
+        with ThreadPoolExecutor(max_workers=EMBEDDINGS_READ_WORKERS, thread_name_prefix="embed-read") as executor:
+            # A bounded window of batches is read ahead, so memory does not grow with the slide.
+            pending = deque((start, executor.submit(read_batch, start)) for start in islice(starts, EMBEDDINGS_READ_WORKERS))
+            while pending:
+                start, future = pending.popleft()
+                for next_start in islice(starts, 1):
+                    pending.append((next_start, executor.submit(read_batch, next_start)))
+                images = future.result()
+                embeddings[start:start + len(images)] = encoder.encode_images(images)
+    finally:
+        slide.close()
+
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(out_dir, "coords.npy"), coords.astype(np.int32))
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"encoder": encoder.name, "dim": encoder.dim, "count": len(coords), "patch_size_level0": patch_size}, f)
+    print(f"Extracted {len(coords)} {encoder.name} embeddings for {slide_id}")
+    return out_dir
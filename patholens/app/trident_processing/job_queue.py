@@ -0,0 +1,254 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List, Optional
+
+# Job states. A job is `queued` until a worker leases it, `running` while leased, and ends in
+# `succeeded` or `failed` (after its last attempt). Failed attempts with retries left go back to
+# `queued` with a later `available_at`.
+JOB_STATES = ("queued", "running", "succeeded", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    slide_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, created_at);
+CREATE INDEX IF NOT EXISTS jobs_slide ON jobs (slide_id, created_at);
+"""
+
+
+class LeaseLost(Exception):
+    """Raised when a worker reports on a job whose lease has passed to another worker."""
+
+
+class JobQueue:
+    """
+    Durable ingestion job queue in a SQLite file, shared by the API and the worker processes.
+
+    Workers lease jobs for `lease_seconds` and renew the lease while working. A job whose lease
+    expires (its worker crashed or was killed) is handed out again, so work resumes after a crash.
+    Failed attempts are retried with exponential backoff up to `max_attempts`. Progress and outcomes
+    are only accepted from the worker holding the lease; a stale worker gets LeaseLost.
+    """
+
+    def __init__(self, db_path: str, lease_seconds: float = 120, max_attempts: int = 3, backoff_seconds: float = 30):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Opens an autocommit connection for one operation; multi-statement updates use explicit transactions."""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def enqueue(self, slide_id: str, payload: dict, priority: int = 0, max_attempts: Optional[int] = None) -> dict:
+        """
+        Adds a job and returns it. If the slide already has a queued or running job, that job is
+        returned instead (with its priority raised if the new request is more urgent).
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE slide_id = ? AND status IN ('queued', 'running') ORDER BY created_at LIMIT 1",
+                    (slide_id,),
+                ).fetchone()
+                if row is not None:
+                    if priority > row["priority"]:
+                        conn.execute("UPDATE jobs SET priority = ?, updated_at = ? WHERE id = ?", (priority, now, row["id"]))
+                    job_id = row["id"]
+                else:
+                    job_id = uuid.uuid4().hex
+                    conn.execute(
+                        "INSERT INTO jobs (id, slide_id, payload, priority, status, max_attempts, available_at, stage, message, created_at, updated_at)"
+                        " VALUES (?, ?, ?, ?, 'queued', ?, ?, 'queued', 'Waiting for a worker.', ?, ?)",
+                        (job_id, slide_id, json.dumps(payload), priority, max_attempts or self.max_attempts, now, now, now),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def claim(self, worker_id: str) -> Optional[dict]:
+        """Leases the most urgent runnable job to `worker_id`, including jobs whose lease expired."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A job whose worker died on its last attempt is not resumed again.
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'Worker lost during the final attempt.',"
+                    " message = 'Failed after ' || attempts || ' attempts.', lease_owner = NULL, lease_expires_at = NULL,"
+                    " updated_at = ? WHERE status = 'running' AND lease_expires_at < ? AND attempts >= max_attempts",
+                    (now, now),
+                )
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' AND available_at <= ?)"
+                    " OR (status = 'running' AND lease_expires_at < ?)"
+                    " ORDER BY priority DESC, created_at LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                resumed = row["status"] == "running"
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?,"
+                    " message = ?, updated_at = ? WHERE id = ?",
+                    (worker_id, now + self.lease_seconds, "Resumed after a lost worker." if resumed else "Started.", now, row["id"]),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Renews a lease. Returns False if the worker no longer holds it."""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (now + self.lease_seconds, now, job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def report_progress(self, job_id: str, worker_id: str, stage: str, progress: float, message: str = ""):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET stage = ?, progress = ?, message = ?, updated_at = ?"
+                " WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (stage, progress, message, time.time(), job_id, worker_id),
+            )
+            if cursor.rowcount != 1:
+                raise LeaseLost(f"Worker {worker_id} no longer holds job {job_id}.")
+
+    def complete(self, job_id: str, worker_id: str, message: str = "Finished."):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'succeeded', stage = 'complete', progress = 1, message = ?, error = NULL,"
+                " lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (message, time.time(), job_id, worker_id),
+            )
+            if cursor.rowcount != 1:
+                raise LeaseLost(f"Worker {worker_id} no longer holds job {job_id}.")
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> Optional[float]:
+        """
+        Records a failed attempt. Returns the retry delay in seconds if the job will be retried,
+        or None if it has used up its attempts and is now `failed`.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                    (job_id, worker_id),
+                ).fetchone()
+                if row is None:
+                    delay = None
+                elif row["attempts"] < row["max_attempts"]:
+                    delay = self.backoff_seconds * 2 ** (row["attempts"] - 1)
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', available_at = ?, error = ?, message = ?,"
+                        " lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                        (now + delay, error, f"Attempt {row['attempts']} failed; retrying in {delay:.0f}s.", now, job_id),
+                    )
+                else:
+                    delay = None
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, message = ?, lease_owner = NULL, lease_expires_at = NULL,"
+                        " updated_at = ? WHERE id = ?",
+                        (error, f"Failed after {row['attempts']} attempts.", now, job_id),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            raise LeaseLost(f"Worker {worker_id} no longer holds job {job_id}.")
+        return delay
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._to_dict(row) if row is not None else None
+
+    def list_jobs(self, status: Optional[str] = None, slide_id: Optional[str] = None, limit: int = 100) -> List[dict]:
+        query, params = "SELECT * FROM jobs WHERE 1 = 1", []
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        if slide_id:
+            query += " AND slide_id = ?"
+            params.append(slide_id)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            return [self._to_dict(row) for row in conn.execute(query, params).fetchall()]
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {state: counts.get(state, 0) for state in JOB_STATES}
+
+
+job_queue_instance = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Lazy initializer for the ingestion job queue, configured from environment variables."""
+    global job_queue_instance
+    with _job_queue_lock:
+        if job_queue_instance is None:
+            db_path = os.getenv("INGEST_QUEUE_DB")
+            if not db_path:
+                db_path = os.path.join(tempfile.gettempdir(), "patholens_jobs.sqlite3")
+                print(f"INGEST_QUEUE_DB is not set; keeping the job queue in {db_path}, which may not survive a restart")
+            job_queue_instance = JobQueue(
+                db_path=db_path,
+                lease_seconds=float(os.getenv("INGEST_LEASE_SECONDS", "120")),
+                max_attempts=int(os.getenv("INGEST_MAX_ATTEMPTS", "3")),
+                backoff_seconds=float(os.getenv("INGEST_RETRY_BACKOFF_SECONDS", "30")),
+            )
+    return job_queue_instance
@@ -1,87 +1,252 @@
+import base64
 import os
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+import google_crc32c
+import openslide
 from google.cloud import storage, firestore
+from google.cloud.storage import transfer_manager
+from app.common.deepzoom import geometry_for_reader, prerender_levels
+from app.common.firestore_store import get_firestore_writer
+from app.common.metadata_cache import invalidate_slide_metadata
+from app.common.tile_encoding import normalize_format
+from app.common.tile_store import get_tile_store
+from app.trident_processing.job_queue import LeaseLost
 
 # Import the main function from Trident's script, as recommended in their docs
 from run_single_slide import main as run_trident_on_slide
 
+# Outputs at least this large are uploaded as concurrent chunks.
+MULTIPART_THRESHOLD_BYTES = int(os.getenv("UPLOAD_MULTIPART_THRESHOLD_BYTES", str(32 * 1024 ** 2)))
+MULTIPART_CHUNK_BYTES = int(os.getenv("UPLOAD_MULTIPART_CHUNK_BYTES", str(16 * 1024 ** 2)))
+# How long finalize_slide waits for the `complete` status to be committed.
+FINALIZE_FLUSH_SECONDS = float(os.getenv("FIRESTORE_FINALIZE_FLUSH_SECONDS", "30"))
+
 
 def _update_firestore_status(slide_id: str, status: str, details: str = ""):
     """Updates the slide's processing status in Firestore."""
     try:
-        db = firestore.Client()
-        doc_ref = db.collection("slide_metadata").document(slide_id)
-        doc_ref.set({"processing_status": status, "status_details": details, "last_updated": firestore.SERVER_TIMESTAMP}, merge=True)
-        print(f"Updated Firestore status for {slide_id} to {status}")
+        # Queued for a batched commit; the cached metadata is dropped once the new status is stored.
+        get_firestore_writer().set(
+            "slide_metadata", slide_id,
+            {"processing_status": status, "status_details": details, "last_updated": firestore.SERVER_TIMESTAMP},
+            merge=True, on_commit=lambda: invalidate_slide_metadata(slide_id),
+        )
+        print(f"Queued Firestore status for {slide_id}: {status}")
     except Exception as e:
         print(f"Error updating Firestore for {slide_id}: {e}")
 
 
-def process_wsi_with_trident(slide_id: str, input_gcs_uri: str, output_gcs_base_path: str):
+def _prerender_deepzoom(slide_id: str, local_slide_path: str) -> dict:
+    """
+    Renders the low-zoom Deep Zoom levels of a slide into the tile store, so the first screen of the
+    viewer is served without opening the WSI. Returns the pyramid description stored in Firestore.
+    """
+    # Stored under the canonical format name, which is what the tile route looks tiles up by.
+    fmt = normalize_format(os.getenv("DZI_FORMAT", "jpeg"))
+    quality = int(os.getenv("DZI_JPEG_QUALITY", "85")) if fmt == "jpeg" else None
+    max_dimension = int(os.getenv("DZI_PRERENDER_MAX_DIM", "4096"))
+    tile_store = get_tile_store()
+
+    slide = openslide.OpenSlide(local_slide_path)
+    try:
+        geometry = geometry_for_reader(slide, int(os.getenv("DZI_OVERLAP", "0")))
+        prerendered_max_level = -1
+        if tile_store is not None:
+            prerendered_max_level = prerender_levels(slide, geometry, tile_store, slide_id, max_dimension, fmt, quality)
+        else:
+            print("No Deep Zoom tile store configured; skipping pre-rendering.")
+    finally:
+        slide.close()
+    print(f"Pre-rendered Deep Zoom levels 0-{prerendered_max_level} for {slide_id}")
+    return {**geometry.to_dict(), "format": fmt, "prerendered_max_level": prerendered_max_level}
+
+
+def _run_trident(argv: list):
+    """
+    Calls Trident's main function with the given command line, restoring sys.argv afterwards.
+    Trident parses its arguments with argparse, which exits on bad input; that is raised as a
+    RuntimeError so callers handle it like any other failed slide.
+    """
+    saved_argv = sys.argv
+    sys.argv = argv
+    try:
+        run_trident_on_slide()
+    except SystemExit as e:
+        if e.code in (None, 0):
+            return
+        raise RuntimeError(f"Trident exited with status {e.code}") from e
+    finally:
+        sys.argv = saved_argv
+
+
+def download_slide(input_gcs_uri: str, local_dir: str, storage_client: storage.Client) -> str:
+    """Stage 1: downloads a WSI from GCS into `local_dir` and returns its local path."""
+    bucket_name, blob_name = input_gcs_uri.replace("gs://", "").split("/", 1)
+    blob = storage_client.bucket(bucket_name).blob(blob_name)
+    os.makedirs(local_dir, exist_ok=True)
+    local_slide_path = os.path.join(local_dir, os.path.basename(blob_name))
+    blob.download_to_filename(local_slide_path)
+    print(f"Successfully downloaded {input_gcs_uri} to {local_slide_path}")
+    return local_slide_path
+
+
+def segment_slide(slide_id: str, local_slide_path: str, job_dir: str):
+    """Stage 2: runs Trident segmentation and patch coordinate generation into `job_dir`."""
+    # Construct the arguments for Trident's main function as if they were command-line args
+    _run_trident([
+        "run_single_slide.py",
+        "--slide_path", local_slide_path,
+        "--job_dir", job_dir,
+        "--task", "seg", "coords",
+        "--segmenter", "hest",
+        "--mag", "20",
+        "--patch_size", "256",
+    ])
+    print(f"Trident processing complete for {slide_id}")
+
+
+def embed_slide(slide_id: str, local_slide_path: str, job_dir: str):
+    """Optional stage 2b: patch embeddings over the Trident coordinates, written into `job_dir` so they are uploaded with it."""
+    # Imported here so ingestion without embeddings does not need the encoders.
+    from app.trident_processing.embeddings import extract_embeddings
+    extract_embeddings(slide_id, local_slide_path, job_dir)
+
+
+def _local_crc32c(path: str) -> str:
+    """Base64 CRC32C of a file, in the format GCS reports for blobs."""
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+def _upload_file(bucket: storage.Bucket, local_path: str, blob_name: str, existing_crc32c: Optional[str]) -> Tuple[int, bool]:
+    """Uploads one file unless GCS already has identical content. Returns (bytes, uploaded)."""
+    size = os.path.getsize(local_path)
+    if existing_crc32c is not None and existing_crc32c == _local_crc32c(local_path):
+        return size, False
+    blob = bucket.blob(blob_name)
+    if size >= MULTIPART_THRESHOLD_BYTES:
+        # Large outputs are uploaded as parallel chunks composed server-side.
+        transfer_manager.upload_chunks_concurrently(local_path, blob, chunk_size=MULTIPART_CHUNK_BYTES, max_workers=4)
+    else:
+        blob.upload_from_filename(local_path)
+    return size, True
+
+
+def upload_outputs(slide_id: str, job_dir: str, output_gcs_base_path: str, storage_client: storage.Client, max_workers: int = 8) -> Tuple[str, dict]:
+    """
+    Stage 3: uploads a slide's Trident outputs in parallel. Files already present in GCS with a
+    matching CRC32C are skipped. Returns the output URI and upload counters.
+    """
+    output_bucket_name = output_gcs_base_path.replace("gs://", "").split("/")[0]
+    output_bucket = storage_client.bucket(output_bucket_name)
+    trident_results_path = f"{output_gcs_base_path.split('/', 3)[-1]}/{slide_id}"
+
+    # One listing call gives the checksums of everything already uploaded for this slide.
+    existing = {blob.name: blob.crc32c for blob in storage_client.list_blobs(output_bucket_name, prefix=trident_results_path + "/")}
+    uploads = []
+    for root, _, files in os.walk(job_dir):
+        for file in files:
+            local_file_path = os.path.join(root, file)
+            relative_path = os.path.relpath(local_file_path, job_dir)
+            output_blob_name = os.path.join(trident_results_path, relative_path)
+            uploads.append((local_file_path, output_blob_name, existing.get(output_blob_name)))
+
+    counters = {"files_uploaded": 0, "files_skipped": 0, "bytes_uploaded": 0, "bytes_skipped": 0}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="trident-upload") as executor:
+        for size, uploaded in executor.map(lambda upload: _upload_file(output_bucket, *upload), uploads):
+            counters["files_uploaded" if uploaded else "files_skipped"] += 1
+            counters["bytes_uploaded" if uploaded else "bytes_skipped"] += size
+    output_uri = f"gs://{output_bucket_name}/{trident_results_path}"
+    print(f"Successfully uploaded results for {slide_id} to {output_uri} "
+          f"({counters['files_uploaded']} uploaded, {counters['files_skipped']} unchanged)")
+    return output_uri, counters
+
+
+def finalize_slide(slide_id: str, trident_output_path: str, dzi: Optional[dict] = None):
+    """Stage 4: records the results and the `complete` status in Firestore."""
+    final_fields = {
+        "trident_output_path": trident_output_path,
+        "processing_status": "complete",
+        "status_details": "Trident processing finished successfully.",
+        "last_updated": firestore.SERVER_TIMESTAMP,
+    }
+    if dzi is not None:
+        final_fields["dzi"] = dzi
+    writer = get_firestore_writer()
+    writer.set("slide_metadata", slide_id, final_fields, merge=True, on_commit=lambda: invalidate_slide_metadata(slide_id))
+    # The slide is listed as soon as the job is reported done; if Firestore is unreachable the write
+    # stays queued and is committed later.
+    if not writer.flush(FINALIZE_FLUSH_SECONDS):
+        print(f"Completion of {slide_id} is queued but not yet committed to Firestore")
+
+
+def process_wsi_with_trident(
+    slide_id: str,
+    input_gcs_uri: str,
+    output_gcs_base_path: str,
+    prerender_dzi: bool = None,
+    progress: Optional[Callable[[str, str], None]] = None,
+    extract_patch_embeddings: bool = None,
+):
     """
     Downloads a WSI, processes it with Trident using its Python API, and uploads the results.
+    When `prerender_dzi` is set (default: the DZI_PRERENDER environment variable), the low-zoom
+    Deep Zoom levels are also rendered into the tile store. When `extract_patch_embeddings` is set
+    (default: EMBEDDINGS_ENABLED), every patch is embedded and the embeddings are uploaded too.
+
+    Each stage is reported to Firestore and, if given, to `progress(status, details)`. Errors are
+    recorded as a `failed` status and re-raised so the caller can retry.
     """
-    _update_firestore_status(slide_id, "processing_started", "Downloading WSI from GCS.")
+    if prerender_dzi is None:
+        prerender_dzi = os.getenv("DZI_PRERENDER", "0") == "1"
+    if extract_patch_embeddings is None:
+        extract_patch_embeddings = os.getenv("EMBEDDINGS_ENABLED", "0") == "1"
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_wsi_dir = os.path.join(tmpdir, "wsi_input")
-        local_output_dir = os.path.join(tmpdir, "trident_output")
-        os.makedirs(local_wsi_dir, exist_ok=True)
-        os.makedirs(local_output_dir, exist_ok=True)
+    def report(status: str, details: str):
+        # Progress first: it raises LeaseLost when a queue worker no longer owns the job, and such a
+        # run must not write the slide's status.
+        if progress is not None:
+            progress(status, details)
+        _update_firestore_status(slide_id, status, details)
 
+    report("processing_started", "Downloading WSI from GCS.")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
         try:
             # 1. Download WSI from GCS
             storage_client = storage.Client()
-            bucket_name, blob_name = input_gcs_uri.replace("gs://", "").split("/", 1)
-            bucket = storage_client.bucket(bucket_name)
-            blob = bucket.blob(blob_name)
-            local_slide_path = os.path.join(local_wsi_dir, os.path.basename(blob_name))
-            blob.download_to_filename(local_slide_path)
-            print(f"Successfully downloaded {input_gcs_uri} to {local_slide_path}")
+            local_slide_path = download_slide(input_gcs_uri, os.path.join(tmpdir, "wsi_input"), storage_client)
 
             # 2. Run Trident for segmentation and coordinate generation via its Python API
-            _update_firestore_status(slide_id, "running_trident", "Segmentation and coordinate generation in progress.")
-            job_dir = os.path.join(local_output_dir, slide_id)
-
-            # Construct the arguments for Trident's main function as if they were command-line args
-            sys.argv = [
-                "run_single_slide.py",
-                "--slide_path", local_slide_path,
-                "--job_dir", job_dir,
-                "--task", "seg", "coords",
-                "--segmenter", "hest",
-                "--mag", "20",
-                "--patch_size", "256",
-            ]
-            run_trident_on_slide()  # Call the imported main function
-            print(f"Trident processing complete for {slide_id}")
+            report("running_trident", "Segmentation and coordinate generation in progress.")
+            job_dir = os.path.join(tmpdir, "trident_output", slide_id)
+            segment_slide(slide_id, local_slide_path, job_dir)
+            if extract_patch_embeddings:
+                report("extracting_embeddings", "Extracting patch embeddings.")
+                embed_slide(slide_id, local_slide_path, job_dir)
 
             # 3. Upload results back to GCS
-            _update_firestore_status(slide_id, "uploading_results", "Uploading Trident outputs to GCS.")
-            output_bucket_name = output_gcs_base_path.replace("gs://", "").split("/")[0]
-            output_bucket = storage_client.bucket(output_bucket_name)
-            trident_results_path = f"{output_gcs_base_path.split('/', 3)[-1]}/{slide_id}"
-
-            for root, _, files in os.walk(job_dir):
-                for file in files:
-                    local_file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(local_file_path, job_dir)
-                    output_blob_name = os.path.join(trident_results_path, relative_path)
-                    output_blob = output_bucket.blob(output_blob_name)
-                    output_blob.upload_from_filename(local_file_path)
-            print(f"Successfully uploaded results for {slide_id} to gs://{output_bucket_name}/{trident_results_path}")
-
-            # 4. Update final status in Firestore, including the path to the results
-            db = firestore.Client()
-            doc_ref = db.collection("slide_metadata").document(slide_id)
-            doc_ref.set({
-                "trident_output_path": f"gs://{output_bucket_name}/{trident_results_path}",
-                "processing_status": "complete",
-                "status_details": "Trident processing finished successfully.",
-                "last_updated": firestore.SERVER_TIMESTAMP,
-            }, merge=True)
+            report("uploading_results", "Uploading Trident outputs to GCS.")
+            trident_output_path, _ = upload_outputs(slide_id, job_dir, output_gcs_base_path, storage_client)
+
+            # 4. Optionally pre-render the low-zoom Deep Zoom levels for the viewer
+            dzi = None
+            if prerender_dzi:
+                report("prerendering_tiles", "Pre-rendering low-zoom Deep Zoom tiles.")
+                dzi = _prerender_deepzoom(slide_id, local_slide_path)
+
+            # 5. Update final status in Firestore, including the path to the results
+            finalize_slide(slide_id, trident_output_path, dzi)
 
+        except LeaseLost:
+            raise
         except Exception as e:
             print(f"An error occurred during processing for {slide_id}: {e}")
             _update_firestore_status(slide_id, "failed", str(e))
+            raise
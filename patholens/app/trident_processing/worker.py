@@ -0,0 +1,147 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from typing import List
+
+from app.trident_processing.job_queue import LeaseLost, get_job_queue
+
+# Fraction of the job done when each processing stage starts, for progress reporting.
+STAGE_PROGRESS = {
+    "processing_started": 0.05,
+    "running_trident": 0.15,
+    "extracting_embeddings": 0.4,
+    "uploading_results": 0.7,
+    "prerendering_tiles": 0.85,
+}
+
+POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "2"))
+
+
+def _keep_lease(job_id: str, worker_id: str, stop: threading.Event, lost: threading.Event):
+    """
+    Renews the job's lease until `stop` is set, so a live worker never loses its job. Sets `lost` if
+    the lease has passed to another worker anyway (e.g. this one stalled past its expiry).
+    """
+    queue = get_job_queue()
+    while not stop.wait(queue.lease_seconds / 3):
+        try:
+            if not queue.heartbeat(job_id, worker_id):
+                print(f"Worker {worker_id} lost the lease on job {job_id}")
+                lost.set()
+                return
+        except Exception as e:
+            print(f"Worker {worker_id} could not renew the lease on job {job_id}: {e}")
+
+
+def run_job(job: dict, worker_id: str):
+    """
+    Runs one ingestion job and records its outcome in the queue. A run whose lease passed to another
+    worker stops at its next progress report, and its outcome is not recorded.
+    """
+    # Imported here so only worker processes load Trident and OpenSlide.
+    from app.trident_processing.processor import _update_firestore_status, process_wsi_with_trident
+
+    queue = get_job_queue()
+    payload = job["payload"]
+    stop = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(target=_keep_lease, args=(job["id"], worker_id, stop, lost), daemon=True)
+    heartbeat.start()
+
+    def progress(status: str, details: str):
+        if lost.is_set():
+            raise LeaseLost(f"Worker {worker_id} no longer holds job {job['id']}.")
+        queue.report_progress(job["id"], worker_id, status, STAGE_PROGRESS.get(status, 0.0), details)
+
+    try:
+        process_wsi_with_trident(
+            payload["slide_id"],
+            payload["gcs_uri"],
+            payload["output_gcs_base_path"],
+            payload.get("prerender_dzi"),
+            progress=progress,
+            extract_patch_embeddings=payload.get("extract_embeddings"),
+        )
+        queue.complete(job["id"], worker_id)
+    except LeaseLost as e:
+        print(f"Worker {worker_id} dropped its run of job {job['id']}: {e}")
+    except Exception as e:
+        try:
+            retry_in = queue.fail(job["id"], worker_id, str(e))
+        except LeaseLost as lost_error:
+            print(f"Worker {worker_id} dropped its run of job {job['id']}: {lost_error}")
+            return
+        if retry_in is not None:
+            _update_firestore_status(
+                payload["slide_id"], "retry_scheduled",
+                f"Attempt {job['attempts']} of {job['max_attempts']} failed ({e}); retrying in {retry_in:.0f}s.",
+            )
+    finally:
+        stop.set()
+
+
+def run_worker(worker_index: int = 0):
+    """Worker process main loop: leases jobs from the queue and runs them one at a time."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{worker_index}"
+    queue = get_job_queue()
+    print(f"Ingestion worker {worker_id} started")
+    while True:
+        try:
+            job = queue.claim(worker_id)
+        except Exception as e:
+            print(f"Worker {worker_id} could not poll the job queue: {e}")
+            job = None
+        if job is None:
+            time.sleep(POLL_SECONDS)
+            continue
+        print(f"Worker {worker_id} running job {job['id']} for slide {job['slide_id']} (attempt {job['attempts']})")
+        run_job(job, worker_id)
+
+
+def start_worker_pool(count: int) -> List[multiprocessing.Process]:
+    """
+    Starts `count` worker processes. They are spawned (not forked) so they do not inherit the API's
+    threads, and not daemonic because Trident may start processes of its own.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        process = context.Process(target=run_worker, args=(index,), name=f"ingest-worker-{index}")
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def stop_worker_pool(processes: List[multiprocessing.Process], timeout: float = 10):
+    """Stops worker processes. Jobs they were running are resumed by another worker once their lease expires."""
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run PathoLens ingestion workers.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("INGEST_WORKERS", "1")), help="Number of worker processes.")
+    args = parser.parse_args()
+
+    processes = start_worker_pool(args.workers)
+    try:
+        # Replace workers that die so the configured concurrency is maintained.
+        while True:
+            time.sleep(POLL_SECONDS)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    print(f"Ingestion worker {process.name} exited with code {process.exitcode}; restarting")
+                    replacement = multiprocessing.get_context("spawn").Process(target=run_worker, args=(index,), name=process.name)
+                    replacement.start()
+                    processes[index] = replacement
+    except KeyboardInterrupt:
+        stop_worker_pool(processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the service the same way it imports itself: `app.` from the patholens directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
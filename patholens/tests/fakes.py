@@ -0,0 +1,83 @@
+"""In-process stand-ins for Firestore used by the tests."""
+
+
+class FakeDocument:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeQuery:
+    def __init__(self, client, collection, filters=(), fields=None):
+        self.client, self.collection, self.filters, self.fields = client, collection, filters, fields
+
+    def where(self, filter):
+        return FakeQuery(self.client, self.collection, self.filters + (filter,), self.fields)
+
+    def select(self, fields):
+        return FakeQuery(self.client, self.collection, self.filters, list(fields))
+
+    def _matches(self, data):
+        for f in self.filters:
+            value = data.get(f.field_path)
+            if value is None:
+                return False
+            if f.op_string == ">=" and not value >= f.value:
+                return False
+            if f.op_string == "==" and value != f.value:
+                return False
+        return True
+
+    def stream(self):
+        for doc_id, data in list(self.client.docs.get(self.collection, {}).items()):
+            if self._matches(data):
+                self.client.reads += 1
+                projected = {k: v for k, v in data.items() if self.fields is None or k in self.fields}
+                yield FakeDocument(doc_id, projected)
+
+    def document(self, doc_id):
+        return (self.collection, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+
+    def commit(self):
+        self.client.commit_batch(self.ops)
+
+
+class FakeFirestore:
+    """Keeps documents in dicts; `fail_commits` makes the next N batch commits raise."""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+        self.commits = 0
+        self.fail_commits = 0
+        self.reject = lambda ref, data: False
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def commit_batch(self, ops):
+        if self.fail_commits:
+            self.fail_commits -= 1
+            raise RuntimeError("unavailable")
+        if any(self.reject(ref, data) for ref, data, _ in ops):
+            raise ValueError("invalid document")
+        self.commits += 1
+        for (collection, doc_id), data, merge in ops:
+            docs = self.docs.setdefault(collection, {})
+            docs[doc_id] = {**docs.get(doc_id, {}), **data} if merge else dict(data)
@@ -0,0 +1,70 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("run_single_slide")
+
+from app.trident_processing import bulk_ingest, processor
+
+SLIDES = [(f"slide{i}", f"gs://bucket/slide{i}.svs") for i in range(4)]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Replaces GCS, Trident and Firestore with local stand-ins; `segment` decides each slide's outcome."""
+    monkeypatch.setattr(bulk_ingest.storage, "Client", lambda: None)
+    monkeypatch.setattr(bulk_ingest, "_update_firestore_status", lambda *args: None)
+    monkeypatch.setattr(bulk_ingest, "finalize_slide", lambda *args: None)
+    monkeypatch.setattr(bulk_ingest, "upload_outputs", lambda slide_id, *args: (f"gs://out/{slide_id}", {}))
+
+    def download(gcs_uri, local_dir, storage_client):
+        os.makedirs(local_dir, exist_ok=True)
+        path = os.path.join(local_dir, os.path.basename(gcs_uri))
+        with open(path, "wb") as f:
+            f.write(b"slide")
+        return path
+
+    monkeypatch.setattr(bulk_ingest, "download_slide", download)
+
+
+def _run(tmp_path):
+    """Runs the pipeline on a thread so a hang fails the test instead of blocking it."""
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("report", bulk_ingest.run_pipeline(SLIDES, "gs://out", str(tmp_path), queue_size=1)))
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "run_pipeline did not return"
+    return result["report"]
+
+
+def test_trident_exiting_fails_only_that_slide(pipeline, monkeypatch, tmp_path):
+    def segment(slide_id, local_slide_path, job_dir):
+        if slide_id == "slide1":
+            raise SystemExit(2)
+        os.makedirs(job_dir, exist_ok=True)
+
+    monkeypatch.setattr(bulk_ingest, "segment_slide", segment)
+    report = _run(tmp_path)
+    assert report.counters["slides_completed"] == 3
+    assert [(slide_id, stage) for slide_id, stage, _ in report.failures] == [("slide1", "segment")]
+
+
+def test_a_dead_stage_fails_the_remaining_slides_instead_of_hanging(pipeline, monkeypatch, tmp_path):
+    def crashing_stage(inbox, *args):
+        inbox.get()
+        raise RuntimeError("segment thread crashed")
+
+    monkeypatch.setattr(bulk_ingest, "_segment_stage", crashing_stage)
+    report = _run(tmp_path)
+    assert report.counters["slides_completed"] == 0
+    assert len(report.failures) == 3
+
+
+def test_trident_argument_errors_are_raised_as_runtime_errors(monkeypatch):
+    def trident():
+        raise SystemExit(2)
+
+    monkeypatch.setattr(processor, "run_trident_on_slide", trident)
+    with pytest.raises(RuntimeError, match="status 2"):
+        processor._run_trident(["run_single_slide.py", "--bad"])
@@ -0,0 +1,56 @@
+import asyncio
+
+from app.services.event_scheduler import SessionEventScheduler, SessionSchedulers
+
+
+def test_connections_of_a_session_share_one_scheduler():
+    async def scenario():
+        handled = []
+
+        async def handle(raw_message, user_id):
+            handled.append(raw_message)
+
+        schedulers = SessionSchedulers()
+        first = schedulers.acquire("session-1", handle)
+        second = schedulers.acquire("session-1", handle)
+        other = schedulers.acquire("session-2", handle)
+        assert first is second and first is not other
+
+        assert not schedulers.release("session-1")
+        second.submit("roi", "roi_marked", "user")
+        await asyncio.sleep(0.01)
+        assert handled == ["roi"]
+
+        assert schedulers.release("session-1")
+        assert schedulers.acquire("session-1", handle) is not first
+        schedulers.release("session-1")
+        schedulers.release("session-2")
+
+    asyncio.run(scenario())
+
+
+def test_close_finishes_queued_events_and_cancels_viewport_work():
+    async def scenario():
+        finished, cancelled = [], []
+
+        async def handle(raw_message, user_id):
+            try:
+                await asyncio.sleep(0.02)
+            except asyncio.CancelledError:
+                cancelled.append(raw_message)
+                raise
+            finished.append(raw_message)
+
+        scheduler = SessionEventScheduler("session-1", handle, debounce_seconds=0)
+        scheduler.submit("viewport", "viewport_update", "user")
+        await asyncio.sleep(0.005)
+        scheduler.submit("roi-1", "roi_marked", "user")
+        scheduler.submit("roi-2", "roi_marked", "user")
+        scheduler.close()
+        scheduler.submit("roi-3", "roi_marked", "user")
+        await asyncio.wait_for(scheduler._worker, timeout=1)
+        return finished, cancelled
+
+    finished, cancelled = asyncio.run(scenario())
+    assert cancelled == ["viewport"]
+    assert finished == ["roi-1", "roi-2"]
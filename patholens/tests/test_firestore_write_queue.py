@@ -0,0 +1,75 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+from app.common.firestore_store import FirestoreWriteQueue
+from fakes import FakeFirestore
+
+
+def _queue(tmp_path, client, **options):
+    options = {"batch_size": 3, "flush_seconds": 0.01, "max_backoff_seconds": 0.02, **options}
+    return FirestoreWriteQueue(str(tmp_path / "spill.sqlite3"), client_factory=lambda: client, **options)
+
+
+def test_writes_are_committed_in_batches_with_merge_and_callbacks(tmp_path):
+    client = FakeFirestore()
+    queue = _queue(tmp_path, client)
+    committed = threading.Event()
+    timestamp = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    queue.set("slide_metadata", "s1", {"processing_status": "queued", "last_updated": timestamp})
+    for i in range(6):
+        queue.set("pathology_notes", f"n{i}", {"summary_text": f"note {i}"})
+    queue.set("slide_metadata", "s1", {"processing_status": "complete"}, merge=True, on_commit=committed.set)
+
+    assert queue.flush(timeout=5)
+    assert committed.is_set()
+    assert client.docs["slide_metadata"]["s1"] == {"processing_status": "complete", "last_updated": timestamp}
+    assert len(client.docs["pathology_notes"]) == 6
+    stats = queue.stats()
+    assert (stats["committed"], stats["pending"], stats["awaiting_commit_here"]) == (8, 0, 0)
+    assert client.commits >= 3
+
+
+def test_failed_commits_are_retried(tmp_path):
+    client = FakeFirestore()
+    client.fail_commits = 2
+    queue = _queue(tmp_path, client)
+    queue.set("pathology_notes", "n1", {"summary_text": "note"})
+    assert queue.flush(timeout=5)
+    assert client.docs["pathology_notes"]["n1"] == {"summary_text": "note"}
+    assert queue.stats()["failed_commits"] == 2
+
+
+def test_a_write_that_keeps_failing_is_set_aside(tmp_path):
+    client = FakeFirestore()
+    client.reject = lambda ref, data: ref == ("pathology_notes", "bad")
+    queue = _queue(tmp_path, client, max_attempts=3)
+    called = []
+    queue.set("pathology_notes", "bad", {"summary_text": "bad"}, on_commit=lambda: called.append("bad"))
+    queue.set("pathology_notes", "good", {"summary_text": "good"}, on_commit=lambda: called.append("good"))
+
+    assert queue.flush(timeout=5)
+    assert client.docs["pathology_notes"] == {"good": {"summary_text": "good"}}
+    assert called == ["good"]
+    stats = queue.stats()
+    assert (stats["dead"], stats["dead_in_spill_file"], stats["pending"]) == (1, 1, 0)
+
+
+def test_writes_left_in_the_spill_file_are_replayed_on_start(tmp_path):
+    unreachable = FakeFirestore()
+    # A writer that never gets to flush, like a process killed right after queueing.
+    stalled = _queue(tmp_path, unreachable, batch_size=100, flush_seconds=3600)
+    stalled.set("pathology_notes", "n1", {"summary_text": "note"})
+    assert unreachable.commits == 0
+
+    client = FakeFirestore()
+    replaying = _queue(tmp_path, client)
+    for _ in range(500):
+        if replaying.stats()["pending"] == 0:
+            break
+        time.sleep(0.01)
+    assert client.docs["pathology_notes"]["n1"] == {"summary_text": "note"}
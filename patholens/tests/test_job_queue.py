@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from app.trident_processing.job_queue import JobQueue, LeaseLost
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=60, max_attempts=3, backoff_seconds=0)
+
+
+def _expire_lease(queue, job_id):
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ?", (time.time() - 1, job_id))
+
+
+def test_lease_holder_records_progress_and_outcome(queue):
+    job = queue.enqueue("slide-1", {})
+    assert queue.claim("worker-a")["id"] == job["id"]
+    queue.report_progress(job["id"], "worker-a", "running_trident", 0.15, "Segmenting.")
+    queue.complete(job["id"], "worker-a")
+    assert queue.get(job["id"])["status"] == "succeeded"
+
+
+def test_stale_worker_cannot_report_on_a_reclaimed_job(queue):
+    job = queue.enqueue("slide-1", {})
+    queue.claim("worker-a")
+    _expire_lease(queue, job["id"])
+    assert queue.claim("worker-b")["id"] == job["id"]
+
+    assert not queue.heartbeat(job["id"], "worker-a")
+    with pytest.raises(LeaseLost):
+        queue.report_progress(job["id"], "worker-a", "uploading_results", 0.7)
+    with pytest.raises(LeaseLost):
+        queue.fail(job["id"], "worker-a", "boom")
+    with pytest.raises(LeaseLost):
+        queue.complete(job["id"], "worker-a")
+
+    current = queue.get(job["id"])
+    assert (current["status"], current["lease_owner"], current["stage"]) == ("running", "worker-b", "queued")
+    queue.complete(job["id"], "worker-b")
+    assert queue.get(job["id"])["status"] == "succeeded"
+
+
+def test_failed_attempt_is_retried_then_failed(queue):
+    job = queue.enqueue("slide-1", {}, max_attempts=2)
+    queue.claim("worker-a")
+    assert queue.fail(job["id"], "worker-a", "boom") == 0
+    queue.claim("worker-a")
+    assert queue.fail(job["id"], "worker-a", "boom") is None
+    assert queue.get(job["id"])["status"] == "failed"
@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.cloud.aiplatform")
+
+from app.common.medgemma_batcher import MedGemmaBatcher
+from app.common.medgemma_client import MedGemmaClient
+
+
+class EchoEndpoint:
+    """Answers each instance with its prompt and records the size of every predict call."""
+
+    def __init__(self, error=None, drop_last=False):
+        self.calls = []
+        self.error = error
+        self.drop_last = drop_last
+        self._lock = threading.Lock()
+
+    def predict(self, instances):
+        with self._lock:
+            self.calls.append([instance["prompt"] for instance in instances])
+        if self.error is not None:
+            raise self.error
+        predictions = [f"answer to {instance['prompt']}" for instance in instances]
+        return SimpleNamespace(predictions=predictions[:-1] if self.drop_last else predictions)
+
+
+def _batcher(endpoint, **options):
+    return MedGemmaBatcher(MedGemmaClient(None, None, None, endpoint=endpoint), **options)
+
+
+def _summaries(batcher, prompts, group_key=None):
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        return list(executor.map(
+            lambda prompt: batcher.generate_summary("gs://bucket/image.jpg", prompt, "sys", group_key=group_key(prompt) if group_key else None),
+            prompts,
+        ))
+
+
+def test_full_batch_is_sent_as_one_call_and_answers_each_caller():
+    endpoint = EchoEndpoint()
+    batcher = _batcher(endpoint, max_batch_size=4, max_wait_ms=10000)
+    prompts = [f"p{i}" for i in range(4)]
+    assert _summaries(batcher, prompts) == [f"answer to sys {prompt}" for prompt in prompts]
+    assert len(endpoint.calls) == 1 and sorted(endpoint.calls[0]) == [f"sys {prompt}" for prompt in prompts]
+    assert batcher.stats()["full_batches"] == 1
+
+
+def test_partial_batch_is_sent_after_max_wait():
+    endpoint = EchoEndpoint()
+    batcher = _batcher(endpoint, max_batch_size=8, max_wait_ms=20)
+    assert _summaries(batcher, ["p0"]) == ["answer to sys p0"]
+    stats = batcher.stats()
+    assert (stats["batches"], stats["timed_out_batches"], stats["pending_requests"]) == (1, 1, 0)
+
+
+def test_groups_are_batched_separately():
+    endpoint = EchoEndpoint()
+    batcher = _batcher(endpoint, max_batch_size=2, max_wait_ms=10000)
+    _summaries(batcher, ["a1", "b1", "a2", "b2"], group_key=lambda prompt: prompt[0])
+    assert sorted(sorted(call) for call in endpoint.calls) == [["sys a1", "sys a2"], ["sys b1", "sys b2"]]
+
+
+def test_failed_batch_answers_every_caller_with_an_error():
+    endpoint = EchoEndpoint(error=RuntimeError("endpoint down"))
+    batcher = _batcher(endpoint, max_batch_size=2, max_wait_ms=10000)
+    answers = _summaries(batcher, ["p0", "p1"])
+    assert all(answer.startswith("Error:") and "endpoint down" in answer for answer in answers)
+    assert batcher.stats()["failed_batches"] == 1
+
+
+def test_missing_predictions_become_empty_answers():
+    batcher = _batcher(EchoEndpoint(drop_last=True), max_batch_size=2, max_wait_ms=10000)
+    assert sorted(_summaries(batcher, ["p0", "p1"]))[0] == ""
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.adk")
+pytest.importorskip("google.cloud.aiplatform")
+
+try:
+    from app.agents.tools import medgemma_tools
+except AttributeError as e:  # google-adk releases without FunctionTool.from_function
+    pytest.skip(f"installed google-adk is not supported: {e}", allow_module_level=True)
+
+from app.common import inference_cache
+from app.common.inference_cache import InferenceCache
+from app.common.medgemma_batcher import MedGemmaBatcher
+from app.common.medgemma_client import MedGemmaClient
+from app.common.stream_bus import stream_bus
+
+IMAGE_URI = "gs://bucket/snapshot.jpg"
+
+
+class StreamingEndpoint:
+    """Streams `chunks`, then raises `error` if one is given."""
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def stream_raw_predict(self, body, headers):
+        for chunk in self.chunks:
+            yield SimpleNamespace(data=json.dumps({"predictions": [chunk]}).encode())
+        if self.error is not None:
+            raise self.error
+
+
+class GatedEndpoint:
+    """Streams one chunk, then waits for `release` before streaming the rest."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def stream_raw_predict(self, body, headers):
+        yield SimpleNamespace(data=json.dumps({"predictions": ["Benign "]}).encode())
+        self.release.wait(timeout=5)
+        yield SimpleNamespace(data=json.dumps({"predictions": ["tissue."]}).encode())
+
+
+class BatchingEndpoint(StreamingEndpoint):
+    """Records the size of every predict call and streams a fixed answer."""
+
+    def __init__(self):
+        super().__init__(["Benign ", "tissue."])
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def predict(self, instances):
+        with self._lock:
+            self.batch_sizes.append(len(instances))
+        return SimpleNamespace(predictions=["Benign tissue."] * len(instances))
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = InferenceCache(max_entries=16, disk_dir=None, max_disk_bytes=0, ttl=60)
+    cache.record_image(IMAGE_URI, "sha256:image")
+    monkeypatch.setattr(inference_cache, "inference_cache_instance", cache)
+    return cache
+
+
+def _use_endpoint(monkeypatch, endpoint):
+    monkeypatch.setattr(medgemma_tools, "medgemma_client_instance", MedGemmaClient(None, None, None, endpoint=endpoint))
+    monkeypatch.setattr(medgemma_tools, "medgemma_batcher_instance", None)
+
+
+TOOL_CONTEXT = SimpleNamespace(session=SimpleNamespace(id="session-1"))
+
+
+def _invoke(monkeypatch, endpoint):
+    """Runs invoke_medgemma for a session with a stream subscriber; returns (summary, messages)."""
+    _use_endpoint(monkeypatch, endpoint)
+
+    async def scenario():
+        queue = stream_bus.subscribe("session-1")
+        try:
+            summary = await medgemma_tools.invoke_medgemma(IMAGE_URI, "snapshot_summary", TOOL_CONTEXT)
+            await asyncio.sleep(0)
+            messages = []
+            while not queue.empty():
+                messages.append(queue.get_nowait())
+            return summary, messages
+        finally:
+            stream_bus.unsubscribe("session-1", queue)
+
+    return asyncio.run(scenario())
+
+
+def test_completed_stream_is_cached(monkeypatch, cache):
+    summary, messages = _invoke(monkeypatch, StreamingEndpoint(["Benign ", "tissue."]))
+    assert summary == "Benign tissue."
+    assert messages[-1]["done"] and messages[-1]["text"] == summary
+    assert cache.stats()["stores"] == 1
+
+
+def test_stream_failing_midway_is_an_error_and_not_cached(monkeypatch, cache):
+    summary, messages = _invoke(monkeypatch, StreamingEndpoint(["Benign "], RuntimeError("connection reset")))
+    assert summary.startswith("Error:")
+    assert [m.get("delta") for m in messages if not m["done"]] == ["Benign "]
+    assert messages[-1]["done"] and messages[-1]["error"] == summary and "text" not in messages[-1]
+    assert cache.stats()["stores"] == 0
+
+
+def test_partial_output_reaches_subscribers_before_the_completion(monkeypatch, cache):
+    endpoint = GatedEndpoint()
+    _use_endpoint(monkeypatch, endpoint)
+
+    async def scenario():
+        queue = stream_bus.subscribe("session-1")
+        try:
+            task = asyncio.ensure_future(medgemma_tools.invoke_medgemma(IMAGE_URI, "snapshot_summary", TOOL_CONTEXT))
+            first = await asyncio.wait_for(queue.get(), timeout=5)
+            pending = not task.done()
+            endpoint.release.set()
+            summary = await task
+            last = await asyncio.wait_for(queue.get(), timeout=5)
+            while not last["done"]:
+                last = await asyncio.wait_for(queue.get(), timeout=5)
+            return first, pending, summary, last
+        finally:
+            stream_bus.unsubscribe("session-1", queue)
+
+    first, pending, summary, last = asyncio.run(scenario())
+    assert first == {**first, "delta": "Benign ", "done": False}
+    assert pending
+    assert summary == "Benign tissue." and last["text"] == summary
+
+
+def _invoke_concurrently(monkeypatch, endpoint, streaming_sessions=()):
+    """Runs invoke_medgemma for two sessions at once; sessions in `streaming_sessions` have a client asking for partial output."""
+    client = MedGemmaClient(None, None, None, endpoint=endpoint)
+    monkeypatch.setattr(medgemma_tools, "medgemma_client_instance", client)
+    monkeypatch.setattr(medgemma_tools, "medgemma_batcher_instance", MedGemmaBatcher(client, max_batch_size=2, max_wait_ms=5000))
+
+    async def scenario():
+        queues = {session_id: stream_bus.subscribe(session_id) for session_id in streaming_sessions}
+        try:
+            return await asyncio.gather(*(
+                medgemma_tools.invoke_medgemma(f"gs://bucket/{session_id}.jpg", "snapshot_summary", SimpleNamespace(session=SimpleNamespace(id=session_id)))
+                for session_id in ("ws-session-1", "ws-session-2")
+            ))
+        finally:
+            for session_id, queue in queues.items():
+                stream_bus.unsubscribe(session_id, queue)
+
+    return asyncio.run(scenario())
+
+
+def test_concurrent_sessions_without_streaming_clients_are_batched(monkeypatch, cache):
+    endpoint = BatchingEndpoint()
+    assert _invoke_concurrently(monkeypatch, endpoint) == ["Benign tissue.", "Benign tissue."]
+    assert endpoint.batch_sizes == [2]
+
+
+def test_only_sessions_asking_for_partial_output_are_streamed(monkeypatch, cache):
+    endpoint = BatchingEndpoint()
+    summaries = _invoke_concurrently(monkeypatch, endpoint, streaming_sessions=("ws-session-1", "ws-session-2"))
+    assert summaries == ["Benign tissue.", "Benign tissue."]
+    assert endpoint.batch_sizes == []
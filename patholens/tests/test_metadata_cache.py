@@ -0,0 +1,51 @@
+import time
+
+from app.common.metadata_cache import TTLCache, _slide_metadata_ttl
+
+
+def test_loaded_values_use_their_own_ttl():
+    cache = TTLCache(ttl=60, negative_ttl=10, max_entries=10, ttl_for=lambda value: value["ttl"])
+    loads = []
+
+    def loader(value):
+        def load():
+            loads.append(value)
+            return value
+        return load
+
+    cache.get_or_load("short", loader({"ttl": 0.05}))
+    cache.get_or_load("long", loader({"ttl": 60}))
+    time.sleep(0.1)
+    cache.get_or_load("short", loader({"ttl": 0.05}))
+    cache.get_or_load("long", loader({"ttl": 60}))
+    assert loads == [{"ttl": 0.05}, {"ttl": 60}, {"ttl": 0.05}]
+
+
+def test_slides_being_processed_expire_sooner():
+    assert _slide_metadata_ttl({"processing_status": "running_trident"}) < _slide_metadata_ttl({"processing_status": "complete"})
+
+
+def test_load_many_reads_only_uncached_keys_in_one_call():
+    cache = TTLCache(ttl=60, negative_ttl=10, max_entries=10)
+    cache.get_or_load("a", lambda: {"id": "a"})
+    calls = []
+
+    def loader(keys):
+        calls.append(keys)
+        return {"b": {"id": "b"}}
+
+    assert cache.load_many(["a", "b", "c", "b"], loader) == 2
+    assert calls == [["b", "c"]]
+    assert cache.get_or_load("b", lambda: None) == {"id": "b"}
+    assert cache.get_or_load("c", lambda: {"id": "c"}) is None
+
+
+def test_load_many_does_not_cache_keys_invalidated_during_the_load():
+    cache = TTLCache(ttl=60, negative_ttl=10, max_entries=10)
+
+    def loader(keys):
+        cache.invalidate("a")
+        return {"a": {"version": 1}}
+
+    cache.load_many(["a"], loader)
+    assert cache.get_or_load("a", lambda: {"version": 2}) == {"version": 2}
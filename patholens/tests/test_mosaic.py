@@ -0,0 +1,41 @@
+import threading
+
+from PIL import Image
+
+from app.common import mosaic
+
+
+class SingleLevelReader:
+    """A slide without a pyramid: left half tissue-coloured, right half glass."""
+
+    level_count = 1
+
+    def __init__(self, width, height):
+        self.level_dimensions = ((width, height),)
+        self.level_downsamples = (1.0,)
+        self.pixels_read = 0
+        self._lock = threading.Lock()
+
+    def read_region(self, location, level, size):
+        with self._lock:
+            self.pixels_read += size[0] * size[1]
+        colour = (180, 90, 160) if location[0] + size[0] / 2 < self.level_dimensions[0][0] / 2 else (245, 245, 245)
+        return Image.new("RGBA", size, colour + (255,))
+
+
+def test_shallow_pyramid_is_sampled_within_the_read_budget(monkeypatch):
+    monkeypatch.setattr(mosaic, "THUMBNAIL_MAX_READ_PIXELS", 2048 * 2048)
+    reader = SingleLevelReader(40000, 20000)
+    thumbnail, downsample = mosaic.read_thumbnail(reader)
+    assert thumbnail.shape == (512, 1024, 3)
+    assert downsample == 40000 / 1024
+    assert reader.pixels_read <= 2048 * 2048
+    mask = mosaic.tissue_mask(thumbnail)
+    assert mask[:, :500].all() and not mask[:, 524:].any()
+
+
+def test_small_level_is_read_whole():
+    reader = SingleLevelReader(2000, 1000)
+    thumbnail, _ = mosaic.read_thumbnail(reader)
+    assert thumbnail.shape == (512, 1024, 3)
+    assert reader.pixels_read == 2000 * 1000
@@ -0,0 +1,61 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+pytest.importorskip("google.adk")
+pytest.importorskip("google.cloud.storage")
+
+try:
+    from app.services import slide_router
+except (AttributeError, ImportError) as e:  # google-adk releases with a different tools API
+    pytest.skip(f"installed google-adk is not supported: {e}", allow_module_level=True)
+
+from app.common import similarity
+from app.common.models import SimilarRegionRequest
+from test_similarity import clustered_vectors, make_slide
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    slides = {slide_id: make_slide(tmp_path, slide_id, clustered_vectors(rng, 200)) for slide_id in ("slide-a", "slide-b")}
+
+    async def get_metadata(slide_id):
+        return {"gcs_original_path": f"gs://bucket/{slide_id}.svs", "trident_output_path": f"gs://bucket/trident/{slide_id}"}
+
+    monkeypatch.setattr(similarity, "SIMILARITY_INDEX", "exact")
+    monkeypatch.setattr(slide_router, "get_slide_metadata_async", get_metadata)
+    monkeypatch.setattr(slide_router, "load_slide_embeddings", lambda slide_id, path, encoder: slides.get(slide_id))
+    monkeypatch.setattr(slide_router, "_load_cohort_embeddings", lambda encoder: list(slides.values()))
+    return slides
+
+
+def _similar(slide_id, **request):
+    return asyncio.run(slide_router.find_similar_regions(slide_id, SimilarRegionRequest(**request)))
+
+
+def test_similar_regions_of_a_slide_exclude_the_query_patches(cohort):
+    response = _similar("slide-a", x=256 * 10, y=0, width=256, height=256, k=5, encoder="reference")
+    assert response["method"] == "exact"
+    assert response["query"] == {"source": "patches", "patches": 1}
+    results = response["results"]
+    assert len(results) == 5 and {r["slide_id"] for r in results} == {"slide-a"}
+    assert (256 * 10, 0) not in [(r["x"], r["y"]) for r in results]
+    assert [r["score"] for r in results] == sorted((r["score"] for r in results), reverse=True)
+
+
+def test_cohort_scope_searches_every_slide(cohort):
+    query_vector = np.asarray(cohort["slide-a"].vectors[10], dtype=np.float32)
+    best_b = int(np.argmax(similarity._normalize(cohort["slide-b"].vectors) @ similarity._normalize(query_vector)))
+    response = _similar("slide-a", x=256 * 10, y=0, width=256, height=256, k=400, scope="cohort", encoder="reference")
+    results = response["results"]
+    assert len(results) == 399 and {r["slide_id"] for r in results} == {"slide-a", "slide-b"}
+    assert {"slide_id": "slide-b", "x": best_b * 256, "y": 0} in [{k: r[k] for k in ("slide_id", "x", "y")} for r in results]
+
+
+def test_unknown_encoder_is_rejected(cohort):
+    with pytest.raises(HTTPException) as error:
+        _similar("slide-a", x=0, y=0, width=256, height=256, encoder="nope")
+    assert error.value.status_code == 400
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from PIL import Image
+
+from app.common import similarity
+from app.common.patch_encoders import ReferenceEncoder
+from app.common.similarity import CohortIndexManager, IVFPQIndex, SlideEmbeddings, cohort_fingerprint, cosine_top_k, search
+
+
+def write_embeddings(directory, vectors, patch_size=256, encoder="reference"):
+    """Writes a slide's embeddings in the layout ingestion uploads; patches lie on a row at y=0."""
+    os.makedirs(directory, exist_ok=True)
+    coords = np.stack([np.arange(len(vectors)) * patch_size, np.zeros(len(vectors))], axis=1).astype(np.int64)
+    np.save(os.path.join(directory, "embeddings.npy"), np.asarray(vectors, dtype=np.float16))
+    np.save(os.path.join(directory, "coords.npy"), coords)
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"encoder": encoder, "patch_size_level0": patch_size}, f)
+
+
+def make_slide(tmp_path, slide_id, vectors):
+    write_embeddings(str(tmp_path / slide_id), vectors)
+    return SlideEmbeddings(slide_id, str(tmp_path / slide_id))
+
+
+def clustered_vectors(rng, count, dim=32, clusters=8):
+    centres = rng.normal(size=(clusters, dim))
+    return centres[rng.integers(0, clusters, count)] + 0.05 * rng.normal(size=(count, dim))
+
+
+def test_reference_encoder_is_deterministic_and_separates_colours():
+    encoder = ReferenceEncoder()
+    pink = Image.new("RGB", (100, 100), (200, 100, 180))
+    purple = Image.new("RGB", (60, 60), (90, 40, 140))
+    vectors = encoder.encode_images([pink, pink, purple])
+    assert vectors.shape == (3, encoder.dim) and vectors.dtype == np.float32
+    assert np.array_equal(vectors[0], vectors[1])
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert unit[0] @ unit[1] > unit[0] @ unit[2]
+
+
+def test_cosine_top_k_matches_a_full_scan_across_blocks(monkeypatch):
+    monkeypatch.setattr(similarity, "_SCAN_ROWS", 64)
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 16)).astype(np.float16)
+    query = similarity.query_vector(rng.normal(size=(1, 16)))
+    exclude = np.array([3, 70, 499])
+
+    scores, ids = cosine_top_k(vectors, query, 10, exclude)
+
+    unit = vectors.astype(np.float32) / np.linalg.norm(vectors.astype(np.float32), axis=1, keepdims=True)
+    expected = unit @ query
+    expected[exclude] = -np.inf
+    assert list(ids) == list(np.argsort(-expected)[:10])
+    assert np.allclose(scores, expected[ids], atol=1e-5)
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_cosine_top_k_returns_fewer_rows_than_k_when_excluded():
+    vectors = np.eye(3, dtype=np.float16)
+    scores, ids = cosine_top_k(vectors, np.array([1, 0, 0], dtype=np.float32), 5, np.array([1]))
+    assert sorted(ids) == [0, 2] and len(scores) == 2
+
+
+def test_ivfpq_search_finds_the_exact_nearest_patches(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    slides = [make_slide(tmp_path, f"slide-{i}", clustered_vectors(rng, 600)) for i in range(3)]
+    fingerprint = cohort_fingerprint(slides)
+    IVFPQIndex.build(slides, fingerprint, str(tmp_path / "index"), seed=0)
+    index = IVFPQIndex(str(tmp_path / "index"))
+    assert index.fingerprint == fingerprint and index.slide_ids == ["slide-0", "slide-1", "slide-2"]
+
+    manager = CohortIndexManager(str(tmp_path / "cohort"))
+    manager._index = index
+    monkeypatch.setattr(similarity, "cohort_index", manager)
+    monkeypatch.setattr(similarity, "SIMILARITY_INDEX", "ivfpq")
+
+    query = similarity.query_vector(np.asarray(slides[1].vectors[[42]]))
+    approximate, method = search(slides, query, 5)
+    assert method == "ivfpq"
+    monkeypatch.setattr(similarity, "SIMILARITY_INDEX", "exact")
+    exact, method = search(slides, query, 5)
+    assert method == "exact"
+    assert approximate[0][:2] == exact[0][:2] == ("slide-1", 42)
+    assert len({(s, r) for s, r, _ in approximate} & {(s, r) for s, r, _ in exact}) >= 4
+
+
+def test_search_excludes_the_query_region(tmp_path, monkeypatch):
+    monkeypatch.setattr(similarity, "SIMILARITY_INDEX", "exact")
+    rng = np.random.default_rng(2)
+    slide = make_slide(tmp_path, "slide-0", clustered_vectors(rng, 100))
+    query = similarity.query_vector(np.asarray(slide.vectors[[7]]))
+    matches, _ = search([slide], query, 3, exclude=("slide-0", np.array([7])))
+    assert 7 not in [row for _, row, _ in matches]
+
+
+@pytest.fixture
+def downloads(tmp_path, monkeypatch):
+    """Replaces the GCS download with one serving `available` slides from tmp_path; records every call."""
+    monkeypatch.setattr(similarity, "_slide_embeddings", similarity.OrderedDict())
+    monkeypatch.setattr(similarity, "_slide_embeddings_loading", {})
+    state = SimpleNamespace(calls=[], available=set(), error=None, gate=None)
+
+    def download(slide_id, trident_output_path, encoder):
+        state.calls.append(slide_id)
+        if state.gate is not None:
+            state.gate.wait(timeout=5)
+        if state.error is not None:
+            raise state.error
+        if slide_id not in state.available:
+            return None
+        return make_slide(tmp_path, slide_id, np.eye(4))
+
+    monkeypatch.setattr(similarity, "_download_slide_embeddings", download)
+    return state
+
+
+def test_slides_without_embeddings_are_rechecked_after_the_ttl(downloads, monkeypatch):
+    monkeypatch.setattr(similarity, "EMBEDDINGS_MISSING_TTL", 0.05)
+    assert similarity.load_slide_embeddings("s1", "gs://b/s1", "reference") is None
+    assert similarity.load_slide_embeddings("s1", "gs://b/s1", "reference") is None
+    assert downloads.calls == ["s1"]
+    # Re-ingested with embeddings: visible once the negative entry expires.
+    downloads.available.add("s1")
+    time.sleep(0.1)
+    assert len(similarity.load_slide_embeddings("s1", "gs://b/s1", "reference")) == 4
+    assert similarity.load_slide_embeddings("s1", "gs://b/s1", "reference") is not None
+    assert downloads.calls == ["s1", "s1"]
+
+
+def test_failed_downloads_are_not_cached(downloads):
+    downloads.error = OSError("transient")
+    assert similarity.load_slide_embeddings("s1", "gs://b/s1", "reference") is None
+    downloads.error = None
+    downloads.available.add("s1")
+    assert similarity.load_slide_embeddings("s1", "gs://b/s1", "reference") is not None
+    assert downloads.calls == ["s1", "s1"]
+
+
+def test_cohort_downloads_run_in_parallel_and_concurrent_loads_share_one(downloads):
+    downloads.available.update({"s1", "s2", "s3"})
+    downloads.gate = threading.Barrier(3)
+    slides = [{"slide_id": s, "trident_output_path": f"gs://b/{s}"} for s in ("s1", "s2", "s3")]
+    # Each download waits until all three have started, so sequential loading would time out.
+    loaded = similarity.load_cohort_embeddings(slides, "reference")
+    assert [embeddings.slide_id for embeddings in loaded] == ["s1", "s2", "s3"]
+
+    downloads.gate = threading.Event()
+    downloads.available.add("s4")
+    threads = [threading.Thread(target=similarity.load_slide_embeddings, args=("s4", "gs://b/s4", "reference")) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    downloads.gate.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert downloads.calls.count("s4") == 1
+
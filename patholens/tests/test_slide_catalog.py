@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+from app.common import slide_catalog as catalog_module
+from app.common.slide_catalog import SlideCatalog
+from tests.fakes import FakeFirestore
+
+T0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeFirestore()
+    client.docs["slide_metadata"] = {
+        f"s{i:03d}": {
+            "original_filename": f"file-{(i * 37) % 100:02d}.svs",
+            "processing_status": "complete" if i % 3 else "failed",
+            "trident_output_path": f"gs://bucket/out/s{i:03d}",
+            "last_updated": T0 + datetime.timedelta(seconds=i),
+            "dzi": {"large": "x" * 100},
+        }
+        for i in range(60)
+    }
+    monkeypatch.setattr(catalog_module, "get_firestore_client", lambda: client)
+    return client
+
+
+def test_pages_cover_every_matching_slide_in_order(client):
+    catalog = SlideCatalog(refresh_seconds=0)
+    seen, cursor = [], None
+    while True:
+        items, cursor, _ = catalog.page(sort="-filename", limit=7, cursor=cursor)
+        seen += items
+        if cursor is None:
+            break
+    expected = sorted(
+        ((d["original_filename"], slide_id) for slide_id, d in client.docs["slide_metadata"].items() if d["processing_status"] == "complete"),
+        reverse=True,
+    )
+    assert [(item["filename"], item["slide_id"]) for item in seen] == expected
+    assert set(seen[0]) == {"slide_id", "filename"}
+
+
+def test_refresh_reads_only_updated_documents_and_changes_digest(client):
+    catalog = SlideCatalog(refresh_seconds=0)
+    _, _, digest = catalog.page()
+    client.reads = 0
+    client.docs["slide_metadata"]["s000"].update(processing_status="complete", last_updated=T0 + datetime.timedelta(hours=1))
+    items, _, new_digest = catalog.page(limit=1)
+    assert client.reads <= 2
+    assert items == [{"slide_id": "s000", "filename": "file-00.svs"}]
+    assert new_digest != digest
+    assert catalog.page(limit=1)[2] == new_digest
+
+
+def test_slides_lists_complete_slides_with_output_paths(client):
+    slides = SlideCatalog().slides("complete")
+    assert len(slides) == 40
+    assert slides[0]["slide_id"] == "s001"
+    assert slides[0]["trident_output_path"] == "gs://bucket/out/s001"
+
+
+def test_invalid_cursor_is_rejected(client):
+    with pytest.raises(ValueError):
+        SlideCatalog().page(cursor="not-a-cursor")
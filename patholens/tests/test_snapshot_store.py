@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.adk")
+pytest.importorskip("diskcache")
+
+try:
+    from app.agents.tools import wsi_tools
+except (AttributeError, ImportError) as e:  # google-adk releases with a different tools API
+    pytest.skip(f"installed google-adk is not supported: {e}", allow_module_level=True)
+
+from PIL import Image
+
+from app.common import inference_cache
+from app.common.inference_cache import InferenceCache
+from app.common.snapshot_buffer import SnapshotBuffer
+
+
+class ArtifactService:
+    bucket_name = "bucket"
+
+    def get_artifact_path(self, tool_context, filename):
+        return f"artifacts/{tool_context.session.id}/{filename}"
+
+
+class ToolContext:
+    def __init__(self, fail=False, session_id="session-1"):
+        self.session = SimpleNamespace(app_name="patholens", user_id="user", id=session_id)
+        self.artifact_service = ArtifactService()
+        self.fail = fail
+        self.saved = []
+
+    def save_artifact(self, filename, part):
+        if self.fail:
+            raise OSError("bucket unavailable")
+        self.saved.append(filename)
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    cache = InferenceCache(max_entries=64, disk_dir=None, max_disk_bytes=0, ttl=60)
+    buffer = SnapshotBuffer(max_bytes=1024 ** 2)
+    monkeypatch.setattr(inference_cache, "inference_cache_instance", cache)
+    monkeypatch.setattr(wsi_tools, "snapshot_buffer", buffer)
+    monkeypatch.setattr(wsi_tools, "_save_artifact", lambda tool_context, filename, content, media_type: tool_context.save_artifact(filename, content))
+    return SimpleNamespace(cache=cache, buffer=buffer)
+
+
+IMAGE = Image.new("RGB", (64, 64), (200, 120, 160))
+SCOPE = "patholens/user/session-1"
+
+
+def _store(tool_context, settle=False):
+    async def scenario():
+        uri = await wsi_tools.store_snapshot(tool_context, "snapshot.jpg", IMAGE, "slide")
+        if settle:
+            await asyncio.gather(*wsi_tools._pending_artifact_writes, return_exceptions=True)
+            await asyncio.sleep(0)
+        return uri
+
+    return asyncio.run(scenario())
+
+
+def test_local_snapshot_is_buffered_again_on_a_dedup_hit(monkeypatch, stores):
+    monkeypatch.setattr(wsi_tools, "SNAPSHOT_PERSIST_MODE", "off")
+    uri = _store(ToolContext())
+    assert uri.startswith(wsi_tools.LOCAL_SNAPSHOT_SCHEME)
+    stores.buffer._images.clear()
+    assert _store(ToolContext()) == uri
+    assert stores.buffer.contains(uri)
+
+
+def test_background_write_is_reused_only_after_it_succeeded(monkeypatch, stores):
+    monkeypatch.setattr(wsi_tools, "SNAPSHOT_PERSIST_MODE", "async")
+    failing = ToolContext(fail=True)
+    uri = _store(failing, settle=True)
+    assert stores.cache.image_for_artifact(uri) is not None
+    assert stores.cache.artifact_for_image(SCOPE, stores.cache.image_for_artifact(uri)) is None
+
+    working = ToolContext()
+    assert _store(working, settle=True) == uri
+    assert working.saved == ["snapshot.jpg"]
+    assert stores.cache.artifact_for_image(SCOPE, stores.cache.image_for_artifact(uri)) == uri
+
+
+def test_sessions_do_not_reuse_each_others_artifacts(monkeypatch, stores):
+    monkeypatch.setattr(wsi_tools, "SNAPSHOT_PERSIST_MODE", "sync")
+    first, second = ToolContext(), ToolContext(session_id="session-2")
+    first_uri = _store(first)
+    assert _store(first) == first_uri
+    second_uri = _store(second)
+    assert second_uri != first_uri and "session-2" in second_uri
+    assert first.saved == second.saved == ["snapshot.jpg"]
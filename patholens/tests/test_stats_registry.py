@@ -0,0 +1,47 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.common import stats_registry
+from app.common.stats_registry import register_stats
+
+pytest.importorskip("google.adk")
+
+try:
+    from app.services import stats_router
+except (AttributeError, ImportError) as e:  # google-adk releases without FunctionTool.from_function
+    pytest.skip(f"installed google-adk is not supported: {e}", allow_module_level=True)
+
+
+@pytest.fixture(autouse=True)
+def isolated_registry(monkeypatch):
+    monkeypatch.setattr(stats_registry, "_providers", dict(stats_registry._providers))
+
+
+def test_importing_the_router_registers_every_component():
+    names = set(stats_registry.stats_names())
+    assert names >= {
+        "slide-cache", "streaming-reader", "tile-cache", "encoding", "slide-io", "metadata-cache", "prefetch", "ui-events",
+        "inference-cache", "medgemma-batcher", "snapshot-buffer", "ui-latency", "tissue-index", "background-tiles",
+        "firestore-writes", "slide-catalog", "websockets",
+    }
+
+
+def test_registered_stats_are_served_by_name():
+    register_stats("example", lambda: {"hits": 3})
+    assert asyncio.run(stats_router.get_stats("example")) == {"hits": 3}
+    assert "example" in asyncio.run(stats_router.list_stats())["stats"]
+
+
+def test_blocking_stats_are_collected_off_the_event_loop():
+    loop_thread = threading.get_ident()
+    register_stats("blocking", lambda: {"thread": threading.get_ident()}, blocking=True)
+    assert asyncio.run(stats_router.get_stats("blocking"))["thread"] != loop_thread
+
+
+def test_unknown_stats_are_404():
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(stats_router.get_stats("missing"))
+    assert excinfo.value.status_code == 404
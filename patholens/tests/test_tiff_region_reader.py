@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip("tifffile")
+
+from app.common.range_reader import LocalRangeSource, RangeReader
+from app.common.tiff_region_reader import StreamingSlidePool, TiffRegionReader
+
+
+@pytest.fixture
+def tiled_tiff(tmp_path):
+    """A two-level tiled RGB pyramid whose sizes are not multiples of the tile size."""
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, size=(300, 420, 3), dtype=np.uint8)
+    path = tmp_path / "slide.tif"
+    with tifffile.TiffWriter(path) as tif:
+        tif.write(base, tile=(64, 64), photometric="rgb", subifds=1)
+        tif.write(base[::2, ::2], tile=(64, 64), photometric="rgb", subfiletype=1)
+    return str(path), base
+
+
+def _open(path, block_size=4096):
+    return TiffRegionReader(RangeReader(LocalRangeSource(path), block_size=block_size, max_cached_blocks=8))
+
+
+def test_region_across_tile_boundaries_matches_full_page(tiled_tiff):
+    path, _ = tiled_tiff
+    reader = _open(path)
+    full = tifffile.imread(path, level=0)
+    # Spans 3x3 tiles, starting and ending inside tiles.
+    region = np.asarray(reader.read_region((50, 40), 0, (156, 100)))
+    np.testing.assert_array_equal(region, full[40:140, 50:206])
+
+
+def test_partial_edge_tiles_and_outside_area_are_white(tiled_tiff):
+    path, base = tiled_tiff
+    reader = _open(path)
+    region = np.asarray(reader.read_region((400, 280), 0, (64, 64)))
+    np.testing.assert_array_equal(region[:20, :20], base[280:300, 400:420])
+    assert (region[20:, :] == 255).all() and (region[:, 20:] == 255).all()
+
+
+def test_lower_level_reads_use_level_zero_location(tiled_tiff):
+    path, _ = tiled_tiff
+    reader = _open(path)
+    assert reader.level_count == 2
+    level1 = tifffile.imread(path, level=1)
+    region = np.asarray(reader.read_region((130, 70), 1, (90, 70)))
+    np.testing.assert_array_equal(region, level1[35:105, 65:155])
+
+
+class SlowOpenPool(StreamingSlidePool):
+    """Opens local slides; opens of `gs://bucket/cold.tif` wait for `release`."""
+
+    def __init__(self, path):
+        super().__init__(max_open=4, block_size=4096, max_cached_blocks=8)
+        self.path = path
+        self.opens = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _open(self, slide_gcs_uri):
+        self.opens.append(slide_gcs_uri)
+        if slide_gcs_uri == "gs://bucket/cold.tif":
+            self.started.set()
+            self.release.wait(timeout=5)
+        if slide_gcs_uri.startswith("gs://bucket/unsupported"):
+            return None
+        return _open(self.path)
+
+
+def test_cold_open_does_not_block_other_slides_and_is_collapsed(tiled_tiff):
+    path, _ = tiled_tiff
+    pool = SlowOpenPool(path)
+    warm = pool.get_reader("gs://bucket/warm.tif")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        cold = [executor.submit(pool.get_reader, "gs://bucket/cold.tif") for _ in range(3)]
+        assert pool.started.wait(timeout=5)
+        # The pool lock is free while the cold slide opens.
+        assert pool.get_reader("gs://bucket/warm.tif") is warm
+        pool.release.set()
+        readers = [future.result(timeout=5) for future in cold]
+    assert readers[0] is not None and all(reader is readers[0] for reader in readers)
+    assert pool.opens.count("gs://bucket/cold.tif") == 1
+
+
+def test_unsupported_slides_are_remembered_within_a_bound(tiled_tiff):
+    path, _ = tiled_tiff
+    pool = SlowOpenPool(path)
+    pool.max_unsupported = 2
+    for i in range(3):
+        assert pool.get_reader(f"gs://bucket/unsupported{i}.tif") is None
+    assert list(pool._unsupported) == ["gs://bucket/unsupported1.tif", "gs://bucket/unsupported2.tif"]
+    pool.get_reader("gs://bucket/unsupported2.tif")
+    assert pool.opens.count("gs://bucket/unsupported2.tif") == 1
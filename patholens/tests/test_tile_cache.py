@@ -0,0 +1,120 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("diskcache")
+
+from app.common.tile_cache import TileCache
+
+
+def _cache():
+    return TileCache(max_memory_bytes=1024 ** 2, disk_dir=None, max_disk_bytes=0)
+
+
+def test_waiter_survives_cancelled_leader():
+    async def scenario():
+        cache = _cache()
+        started = asyncio.Event()
+        calls = []
+
+        async def slow_producer():
+            calls.append("prefetch")
+            started.set()
+            await asyncio.sleep(10)
+            return b"never", "image/png"
+
+        async def viewer_producer():
+            calls.append("viewer")
+            return b"tile", "image/png"
+
+        prefetch = asyncio.ensure_future(cache.get_or_create_async("k", slow_producer))
+        await started.wait()
+        viewer = asyncio.ensure_future(cache.get_or_create_async("k", viewer_producer))
+        await asyncio.sleep(0)
+        prefetch.cancel()
+        tile = await asyncio.wait_for(viewer, 1)
+        with pytest.raises(asyncio.CancelledError):
+            await prefetch
+        return tile, calls, cache.stats()
+
+    tile, calls, stats = asyncio.run(scenario())
+    assert tile.content == b"tile"
+    assert calls == ["prefetch", "viewer"]
+    assert stats["abandoned"] == 1 and stats["coalesced"] == 1
+
+
+def test_cancelled_waiter_does_not_fail_the_leader():
+    async def scenario():
+        cache = _cache()
+        release = asyncio.Event()
+
+        async def producer():
+            await release.wait()
+            return b"tile", "image/png"
+
+        leader = asyncio.ensure_future(cache.get_or_create_async("k", producer))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_create_async("k", producer))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        release.set()
+        return await leader
+
+    assert asyncio.run(scenario()).content == b"tile"
+
+
+def test_producer_errors_reach_waiters():
+    cache = _cache()
+
+    def failing():
+        raise OSError("read failed")
+
+    with pytest.raises(OSError):
+        cache.get_or_create("k", failing)
+    # The failure is not cached; the next caller produces the tile again.
+    assert cache.get_or_create("k", lambda: (b"ok", "image/png")).content == b"ok"
+
+
+class RecordingDisk(dict):
+    """Stands in for the diskcache store and records the thread of every access."""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get(self, key, default=None):
+        self.threads.append(threading.get_ident())
+        return super().get(key, default)
+
+    def set(self, key, value):
+        self.threads.append(threading.get_ident())
+        self[key] = value
+
+    def volume(self):
+        return sum(len(value[0]) for value in self.values())
+
+
+def test_async_callers_use_the_disk_tier_off_the_event_loop():
+    async def scenario():
+        cache = _cache()
+        cache._disk = RecordingDisk()
+        tile = await cache.get_or_create_async("k", producer)
+        for _ in range(100):
+            if "k" in cache._disk:
+                break
+            await asyncio.sleep(0.01)
+        # A fresh memory tier, so the next lookup is answered from disk.
+        cache._memory.clear()
+        cache._memory_bytes = 0
+        again = await cache.get_or_create_async("k", producer)
+        return tile, again, cache._disk.threads, threading.get_ident(), cache.stats()
+
+    async def producer():
+        return b"tile", "image/png"
+
+    tile, again, threads, loop_thread, stats = asyncio.run(scenario())
+    assert again == tile
+    assert len(threads) == 3 and loop_thread not in threads
+    assert stats["disk_hits"] == 1 and stats["misses"] == 1
+
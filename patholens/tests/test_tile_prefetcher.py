@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from app.common.tile_encoding import negotiate_format, resolve_quality
+from app.services.tile_prefetcher import TilePrefetcher
+
+BROWSER_ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+
+
+def _run_prefetch(note):
+    async def scenario():
+        rendered = []
+
+        async def render_tile(slide_id, level, x, y, fmt, quality):
+            rendered.append((level, fmt, quality))
+
+        async def downsamples(slide_id):
+            return (1.0, 4.0)
+
+        prefetcher = TilePrefetcher(render_tile, downsamples, tile_size=256, default_format="png")
+        prefetcher.observe("session-1", {"slide_id": "s", "level": 0, "x": 0, "y": 0, "width": 512, "height": 512})
+        await prefetcher._sessions["session-1"].task
+        note(prefetcher)
+        rendered.clear()
+        prefetcher.observe("session-1", {"slide_id": "s", "level": 0, "x": 2048, "y": 2048, "width": 512, "height": 512})
+        await prefetcher._sessions["session-1"].task
+        return rendered
+
+    return asyncio.run(scenario())
+
+
+def test_prefetches_in_the_format_the_session_negotiated():
+    fmt = negotiate_format(BROWSER_ACCEPT, None, "png")
+    assert fmt != "png"
+    quality = resolve_quality(fmt)
+    rendered = _run_prefetch(lambda p: p.note_request("key", "s", fmt, quality, "session-1"))
+    assert rendered and {(f, q) for _, f, q in rendered} == {(fmt, quality)}
+
+
+def test_untagged_requests_set_the_slide_encoding():
+    rendered = _run_prefetch(lambda p: p.note_request("key", "s", "jpeg", 70))
+    assert rendered and {(f, q) for _, f, q in rendered} == {("jpeg", 70)}
+
+
+def test_prefetch_state_outlives_all_but_the_last_connection():
+    from app.services.event_scheduler import SessionSchedulers
+
+    async def scenario():
+        async def render_tile(slide_id, level, x, y, fmt, quality):
+            pass
+
+        async def downsamples(slide_id):
+            return (1.0,)
+
+        async def handle(raw_message, user_id):
+            pass
+
+        prefetcher = TilePrefetcher(render_tile, downsamples, tile_size=256, default_format="png")
+        schedulers = SessionSchedulers()
+        schedulers.acquire("session-1", handle)
+        schedulers.acquire("session-1", handle)
+        prefetcher.observe("session-1", {"slide_id": "s", "level": 0, "x": 0, "y": 0, "width": 512, "height": 512})
+        await prefetcher._sessions["session-1"].task
+
+        # Mirrors the websocket teardown in main.py.
+        alive = []
+        for _ in range(2):
+            if schedulers.release("session-1"):
+                prefetcher.forget_session("session-1")
+            alive.append("session-1" in prefetcher._sessions)
+        return alive
+
+    assert asyncio.run(scenario()) == [True, False]